@@ -42,6 +42,7 @@ Example: for an input filename like document1.soclog.seg.csv, the pair
 
 from __future__ import print_function
 from xml.etree.ElementTree import Element, SubElement, Comment
+from bisect import bisect_left
 from collections import namedtuple
 from itertools import islice, takewhile
 import argparse
@@ -109,8 +110,15 @@ def edu_spans(text, pieces):
     Return a list of tuples representing the spans from one segment
     to another
     """
+    return _edu_spans_from(len(text), pieces)
+
+
+def _edu_spans_from(offset, pieces):
+    """
+    `edu_spans` for pieces appended to a text of the given length
+    """
     spans = []
-    next_seg_left = len(text)
+    next_seg_left = offset
     for tseg in pieces:
         tseg_l = tseg.lstrip()
         tseg_lr = tseg_l.rstrip()
@@ -208,6 +216,88 @@ def read_events(previous, current, turns):
                   trades=trades[-1] if trades else None)
 
 
+def _is_server(turn):
+    "if a turn is a server turn"
+    return turn.emitter in ['Server', 'UI']
+
+
+class EventIndex(object):
+    """
+    The server turns of a list of turns, indexed in a single pass so
+    that `read` gives the same results as `read_events` without
+    rescanning the turns before each dialogue boundary
+    """
+
+    def __init__(self, turns):
+        self.turns = turns
+        # index of the first player turn at or after each turn
+        self.run_end = [len(turns)] * (len(turns) + 1)
+        # indices of the server turns reporting a trade
+        self.trades = []
+        for i in range(len(turns) - 1, -1, -1):
+            turn = turns[i]
+            if _is_server(turn):
+                self.run_end[i] = self.run_end[i + 1]
+                if 'traded' in turn.rawtext:
+                    self.trades.append(i)
+            else:
+                self.run_end[i] = i
+        self.trades.reverse()
+
+    def read(self, previous, current):
+        """
+        Events for a dialogue boundary (see `read_events`)
+        """
+        after = [x.rawtext for x in
+                 self.turns[current:self.run_end[current]]]
+        # last trade in [previous, current)
+        pos = bisect_left(self.trades, current)
+        if pos > 0 and self.trades[pos - 1] >= previous:
+            trades = self.turns[self.trades[pos - 1]].rawtext
+        else:
+            trades = None
+        return Events(rolls=[x for x in after if 'rolled a' in x],
+                      resources=[x for x in after if 'gets' in x],
+                      trades=trades)
+
+
+class TextBuilder(object):
+    """
+    Text that we build up a piece at a time, keeping track of its
+    length (repeatedly concatenating strings would make building the
+    text of a game quadratic in its length)
+    """
+
+    def __init__(self, text=u''):
+        self._chunks = [text] if text else []
+        self._length = len(text)
+
+    def __len__(self):
+        return self._length
+
+    def append(self, chunk):
+        "add some text to the end"
+        self._chunks.append(chunk)
+        self._length += len(chunk)
+
+    def startswith(self, prefix):
+        "if the text starts with the given prefix"
+        head = []
+        size = 0
+        for chunk in self._chunks:
+            if size >= len(prefix):
+                break
+            head.append(chunk)
+            size += len(chunk)
+        return ''.join(head).startswith(prefix)
+
+    def getvalue(self):
+        "the text so far"
+        text = ''.join(self._chunks)
+        self._chunks = [text] if text else []
+        return text
+
+
 # ---------------------------------------------------------------------
 # building output
 # ---------------------------------------------------------------------
@@ -395,8 +485,17 @@ def process_turn(root, dialoguetext, turn, is_player):
 
     Return the augmented text
     """
+    builder = TextBuilder(dialoguetext)
+    _process_turn(root, builder, turn, is_player)
+    return builder.getvalue()
+
+
+def _process_turn(root, dialoguetext, turn, is_player):
+    """
+    `process_turn`, extending a `TextBuilder` (which we return)
+    """
     prefix = " : ".join([turn.number, turn.emitter, ""])
-    dialoguetext += prefix
+    dialoguetext.append(prefix)
     if is_player:
         # split on '&'
         # NEW except if it is escaped (preceded by '\'); then delete the
@@ -416,13 +515,13 @@ def process_turn(root, dialoguetext, turn, is_player):
         turn_text = '. '.join(turn_segments)
 
     turn_text = ''.join(turn_segments)
-    seg_spans = edu_spans(dialoguetext, turn_segments)
+    seg_spans = _edu_spans_from(len(dialoguetext), turn_segments)
 
     # .ac buffer
-    dialoguetext += turn_text + " "
+    dialoguetext.append(turn_text + " ")
     # .aa typographic annotations
 
-    if dialoguetext.index(turn_text) != 0:
+    if not dialoguetext.startswith(turn_text):
         typstart = (len(dialoguetext) -
                     len(turn_text) -
                     len(prefix) -
@@ -458,7 +557,8 @@ def process_turns(turns, gen):
                    )
     root.append(Comment('Generated by csvtoglozz.py'))
 
-    dialoguetext = " "  # for the .ac file
+    dialoguetext = TextBuilder(" ")  # for the .ac file
+    event_index = EventIndex(turns)
     prev_dialogue = None
     i_old = 0
 
@@ -473,8 +573,8 @@ def process_turns(turns, gen):
 
             # player turns
             if turn.emitter not in ["Server", "UI"]:
-                dialoguetext = process_turn(root, dialoguetext, turn,
-                                            is_player=True)
+                dialoguetext = _process_turn(root, dialoguetext, turn,
+                                             is_player=True)
                 continue
 
             # cut immediately after
@@ -492,7 +592,7 @@ def process_turns(turns, gen):
                     i_old = i
                     # ignore consecutive dice rolls
                 else:
-                    event = read_events(i_old, i, turns)
+                    event = event_index.read(i_old, i)
                     i_old = i
                     # Generate the actual annotation !
                     append_dialogue(root, event, span)
@@ -522,15 +622,15 @@ def process_turns(turns, gen):
                     i_old = i
                     # ignore consecutive dice rolls (??)
                 else:
-                    event = read_events(i_old, i, turns)
+                    event = event_index.read(i_old, i)
                     i_old = i
                     # Generate the actual annotation !
                     append_dialogue(root, event, span)
 
             # player turns
             if turn.emitter not in ["Server", "UI"]:
-                dialoguetext = process_turn(root, dialoguetext, turn,
-                                            is_player=True)
+                dialoguetext = _process_turn(root, dialoguetext, turn,
+                                             is_player=True)
                 continue
 
             # currently, all dialogue splits are triggered by a message
@@ -561,7 +661,7 @@ def process_turns(turns, gen):
                                     i_old = i
                                     # ignore consecutive dice rolls (??)
                                 else:
-                                    event = read_events(i_old, i, turns)
+                                    event = event_index.read(i_old, i)
                                     i_old = i
                                     # Generate the actual annotation !
                                     append_dialogue(root, event, span)
@@ -583,7 +683,7 @@ def process_turns(turns, gen):
                                     i_old = i
                                     # ignore consecutive dice rolls (??)
                                 else:
-                                    event = read_events(i_old, i, turns)
+                                    event = event_index.read(i_old, i)
                                     i_old = i
                                     # Generate the actual annotation !
                                     append_dialogue(root, event, span)
@@ -598,7 +698,7 @@ def process_turns(turns, gen):
                         i_old = i
                         # ignore consecutive dice rolls (??)
                     else:
-                        event = read_events(i_old, i, turns)
+                        event = event_index.read(i_old, i)
                         i_old = i
                         # Generate the actual annotation !
                         append_dialogue(root, event, span)
@@ -606,8 +706,8 @@ def process_turns(turns, gen):
         # server turns
         if (gen >= 3 and
             " you" not in turn.rawtext):
-            dialoguetext = process_turn(root, dialoguetext, turn,
-                                        is_player=False)
+            dialoguetext = _process_turn(root, dialoguetext, turn,
+                                         is_player=False)
 
     # last dialogue : only if it doesn't end in a Server's statement !!
     if ((prev_dialogue is None or
@@ -617,7 +717,7 @@ def process_turns(turns, gen):
                     right=len(dialoguetext))
         append_dialogue(root, None, span)
 
-    return dialoguetext, root
+    return dialoguetext.getvalue(), root
 
 
 def parse_args():
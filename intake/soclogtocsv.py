@@ -34,9 +34,12 @@ import argparse
 import codecs
 from collections import namedtuple, OrderedDict
 from itertools import chain
+import json
+import os
 import re
 import string
 import sys
+import time
 
 from educe.stac.util import csv as stac_csv
 
@@ -200,6 +203,167 @@ OTHER_EVENTS = {
 }
 
 
+# Handlers for the OTHER_EVENTS: given the named groups matched in the
+# line (mutable), the parsing state (mutable, see `parse_line`) and the
+# previous line, return True if the line should generate a turn.
+# Events without a handler always generate one.
+
+def _on_game_state(evt_fields, parsing_state, _):
+    "keep only the first 'game state 0'"
+    game_state_cur = parsing_state.get('game_state')
+    game_state_nxt = evt_fields['game_state']
+    # update parsing state
+    parsing_state['game_state'] = game_state_nxt
+    return game_state_nxt == '0' and game_state_nxt != game_state_cur
+
+
+def _on_start_game(_, parsing_state, __):
+    "keep only the first 'start game'"
+    if 'start game' in parsing_state:
+        return False
+    parsing_state['start game'] = True
+    return True
+
+
+def _on_join_game(evt_fields, _, __):
+    "keep only the latest 'join game' event"
+    return evt_fields['host'] == 'dummyhost'
+
+
+def _on_sit_down(evt_fields, parsing_state, _):
+    """
+    sit down generates two messages, the first one with
+    nickname "dummy" should be ignored
+    """
+    if evt_fields['name'] == 'dummy':
+        return False
+    # store mapping from player number to nickname
+    pl_nb = evt_fields['plnb']
+    pl_name = evt_fields['name']
+    if 'plnb2name' not in parsing_state:
+        parsing_state['plnb2name'] = dict()
+    parsing_state['plnb2name'][pl_nb] = pl_name
+    return True
+
+
+def _on_begin_turn(evt_fields, parsing_state, _):
+    "remember the current player (no message)"
+    pl_nb = evt_fields['plnb']
+    parsing_state['cur_plnb'] = pl_nb
+    pl_name = parsing_state['plnb2name'][pl_nb]
+    parsing_state['cur_name'] = pl_name
+    return False
+
+
+def _on_end_turn(evt_fields, parsing_state, _):
+    "retrieve name of current player from context"
+    evt_fields['name'] = parsing_state['cur_name']
+    return True
+
+
+def _on_clear_offer(evt_fields, parsing_state, _):
+    """
+    store the last player involved in this type of event
+    so we know which player is trying to trade (useful to
+    display an informative message for failed trades)
+    """
+    pl_nb = evt_fields['plnb']
+    if pl_nb != '-1':
+        pl_name = parsing_state['plnb2name'][pl_nb]
+        parsing_state['offering_player'] = pl_name
+    return False
+
+
+def _on_make_offer(evt_fields, parsing_state, _):
+    "message only for the second occurrence of the offer"
+    make_offer_cur = parsing_state.get('make_offer', False)
+    if not make_offer_cur:
+        # mark the first occurrence of the "make offer" event
+        # as seen, don't generate any message
+        parsing_state['make_offer'] = True
+        return False
+    # second occurrence: prepare message
+    pls_tgt = evt_fields['pls_tgt']
+    tgt_idc = [i for i, x in enumerate(pls_tgt.split(','))
+               if x == 'true']
+    evt_fields['names_tgt'] = 'or '.join(
+        parsing_state['plnb2name'][str(i)]
+        for i in tgt_idc)
+    # and discharge the "make offer" marker
+    parsing_state['make_offer'] = False
+    return True
+
+
+def _nonzero_resources(snippet):
+    "eg. '1 sheep, 2 wood' for clay=0|sheep=1|wood=2"
+    res = []
+    for x in snippet.split('|'):
+        resource, qty = x.split('=')
+        if int(qty) > 0:
+            res.append((resource, int(qty)))
+    return ', '.join('{} {}'.format(qty, resource)
+                     for resource, qty in res)
+
+
+def _on_bank_trade(evt_fields, parsing_state, _):
+    "prepare clean information for message"
+    evt_fields['give_nz'] = _nonzero_resources(evt_fields['give'])
+    evt_fields['get_nz'] = _nonzero_resources(evt_fields['get'])
+    # retrieve player name from context
+    evt_fields['name'] = parsing_state['offering_player']
+    return True
+
+
+def _on_reject_offer(_, __, line_prev):
+    """
+    reject offer generates two identical messages, the
+    second one should be ignored
+    """
+    return not _OTHER_EVENT_RES['reject offer'].search(line_prev)
+
+
+_OTHER_EVENT_HANDLERS = {
+    'game state': _on_game_state,
+    'start game': _on_start_game,
+    'join game': _on_join_game,
+    'sit down': _on_sit_down,
+    'begin turn': _on_begin_turn,
+    'end turn': _on_end_turn,
+    'clear offer': _on_clear_offer,
+    'make offer': _on_make_offer,
+    'bank trade': _on_bank_trade,
+    'reject offer': _on_reject_offer,
+}
+
+_OTHER_EVENT_RES = {k: re.compile(evt_re)
+                    for k, (evt_re, _) in OTHER_EVENTS.items()}
+
+
+def _mk_dispatch_table():
+    """
+    SOC message type -> the events we look for in lines of that type
+    (key, compiled regex, message, field names in the message)
+
+    We find the message type(s) in a line with a single regex, and then
+    only try the event regexes for those
+    """
+    table = {}
+    for k, (evt_re, evt_msg) in sorted(OTHER_EVENTS.items()):
+        keyword = re.match(r'SOC[A-Za-z0-9]+', evt_re).group(0)
+        # extract the field names from the "format string"
+        msg_fnames = frozenset(name for _, name, _, _
+                               in string.Formatter().parse(evt_msg))
+        table.setdefault(keyword, []).append(
+            (k, _OTHER_EVENT_RES[k], evt_msg, msg_fnames))
+    return table
+
+
+_OTHER_EVENT_DISPATCH = _mk_dispatch_table()
+
+_OTHER_EVENT_KEYWORDS = re.compile(
+    '|'.join(sorted(_OTHER_EVENT_DISPATCH, key=len, reverse=True)))
+
+
 class TurnCounter(object):
     """
     counter for turn identifiers (which work a bit like
@@ -231,8 +395,19 @@ class TurnCounter(object):
         return 1 + len(self._stack)
 
     def __str__(self):
-        version = self._stack + [self._top]
-        return '.'.join(str(x) for x in version)
+        return '.'.join(str(x) for x in self.version())
+
+    def version(self):
+        'the counter as a list of ints (eg. [3, 4, 9])'
+        return self._stack + [self._top]
+
+    @classmethod
+    def from_version(cls, version):
+        'counter picking up from the given `version()`'
+        ctr = cls()
+        ctr._stack = list(version[:-1])
+        ctr._top = version[-1]
+        return ctr
 
     def incr_at_gen(self, gen):
         'increment this counter according to the current generation'
@@ -284,6 +459,8 @@ class State(namedtuple('State',
 
 EMPTY_STATE = State(OrderedDict(), OrderedDict())
 
+_BUILDUP_VALUE = re.compile(r'^\[(.*)\]$')
+
 
 def parse_state(snippet):
     """
@@ -297,7 +474,7 @@ def parse_state(snippet):
         if value.isdigit():
             resources[key] = value
             continue
-        num_match = re.match(r'^\[(.*)\]$', value)
+        num_match = _BUILDUP_VALUE.match(value)
         if num_match:
             nums = num_match.group(1).split(',')
             buildups[key] = nums
@@ -413,158 +590,117 @@ def parse_line(ctr, line, sel_gen=3, parsing_state=None):
         if sel_gen < gen:
             return None
 
-        for k, evt_re_msg in OTHER_EVENTS.items():
-            evt_re, evt_msg = evt_re_msg  # unpack the event regex and msg
-            evt_re_obj = re.compile(evt_re)
-            evt_search = evt_re_obj.search(line)
-            if not evt_search:
-                continue
-
-            # get named groups from regex
-            evt_fields = evt_search.groupdict()
-            if k == 'game state':
-                game_state_cur = parsing_state.get('game_state')
-                game_state_nxt = evt_fields['game_state']
-                # update parsing state
-                parsing_state['game_state'] = game_state_nxt
-                # keep only the first "game state 0"
-                if (game_state_nxt != '0' or
-                    game_state_nxt == game_state_cur):
-                    continue
-            elif k == 'start game':
-                # keep only the first "start game"
-                if 'start game' in parsing_state:
-                    continue
-                else:
-                    parsing_state['start game'] = True
-            elif k == 'join game':
-                # keep only the latest "join game" event
-                if evt_fields['host'] != 'dummyhost':
-                    continue
-            elif k == 'sit down':
-                # sit down generates two messages, the first one with
-                # nickname "dummy" should be ignored
-                if evt_fields['name'] == 'dummy':
-                    continue
-                # store mapping from player number to nickname
-                pl_nb = evt_fields['plnb']
-                pl_name = evt_fields['name']
-                if 'plnb2name' not in parsing_state:
-                    parsing_state['plnb2name'] = dict()
-                parsing_state['plnb2name'][pl_nb] = pl_name
-            elif k == 'begin turn':
-                pl_nb = evt_fields['plnb']
-                parsing_state['cur_plnb'] = pl_nb
-                pl_name = parsing_state['plnb2name'][pl_nb]
-                parsing_state['cur_name'] = pl_name
-                continue
-            elif k == 'end turn':
-                # retrieve name of current player from context
-                evt_fields['name'] = parsing_state['cur_name']
-            elif k == 'clear offer':
-                # store the last player involved in this type of event
-                # so we know which player is trying to trade (useful to
-                # display an informative message for failed trades)
-                pl_nb = evt_fields['plnb']
-                if pl_nb != '-1':
-                    pl_name = parsing_state['plnb2name'][pl_nb]
-                    parsing_state['offering_player'] = pl_name
+        seen = set()
+        for kw_match in _OTHER_EVENT_KEYWORDS.finditer(line):
+            keyword = kw_match.group(0)
+            if keyword in seen:
                 continue
-            elif k == 'make offer':
-                make_offer_cur = parsing_state.get('make_offer', False)
-                if not make_offer_cur:
-                    # mark the first occurrence of the "make offer" event
-                    # as seen, don't generate any message
-                    parsing_state['make_offer'] = True
+            seen.add(keyword)
+            for k, evt_re_obj, evt_msg, msg_fnames in\
+                    _OTHER_EVENT_DISPATCH[keyword]:
+                evt_search = evt_re_obj.search(line)
+                if not evt_search:
                     continue
-                # second occurrence: prepare message
-                pls_tgt = evt_fields['pls_tgt']
-                tgt_idc = [i for i, x in enumerate(pls_tgt.split(','))
-                           if x == 'true']
-                evt_fields['names_tgt'] = 'or '.join(
-                    parsing_state['plnb2name'][str(i)]
-                    for i in tgt_idc)
-                # and discharge the "make offer" marker
-                parsing_state['make_offer'] = False
-            elif k == 'bank trade':
-                # prepare clean information for message
-                # * give
-                res_give = []
-                for x in evt_fields['give'].split('|'):
-                    resource, qty = x.split('=')
-                    if int(qty) > 0:
-                        res_give.append((resource, int(qty)))
-                evt_fields['give_nz'] = ', '.join(
-                    '{} {}'.format(qty, resource)
-                    for resource, qty in res_give
-                )
-                # * get
-                res_get = []
-                for x in evt_fields['get'].split('|'):
-                    resource, qty = x.split('=')
-                    if int(qty) > 0:
-                        res_get.append((resource, int(qty)))
-                evt_fields['get_nz'] = ', '.join(
-                    '{} {}'.format(qty, resource)
-                    for resource, qty in res_get
-                )
-                # * retrieve player name from context
-                evt_fields['name'] = parsing_state['offering_player']
-            elif k == 'reject offer':
-                reject_re_obj = re.compile(OTHER_EVENTS['reject offer'][0])
-                # reject offer generates two identical messages, the
-                # second one should be ignored
-                reject_prev = reject_re_obj.search(line_prev)
-                if reject_prev:
+
+                # get named groups from regex
+                evt_fields = evt_search.groupdict()
+                handler = _OTHER_EVENT_HANDLERS.get(k)
+                if handler is not None and\
+                        not handler(evt_fields, parsing_state, line_prev):
                     continue
 
-            # this line matches a known pattern: generate a nonling turn
-            gen = 3
-            ctr.incr_at_gen(gen)
-            # extract the field names from the "format string"
-            msg_fnames = [name for text, name, spec, conv
-                          in string.Formatter().parse(evt_msg)]
-            # if a player name is expected but the soclog line only
-            # provides a player number, map it
-            if 'name' in msg_fnames and 'name' not in evt_fields:
-                if 'plnb' in evt_fields:
-                    # use player name instead of number, in the generated
-                    # message
-                    pl_nb = evt_fields['plnb']
-                    evt_fields['name'] = parsing_state['plnb2name'][pl_nb]
-                else:
-                    raise ValueError("Fail to find required player name")
-            return mk_turn(str(ctr),
-                           'UI',  # custom emitter
-                           evt_msg.format(**evt_fields),  # defined text
-                           state=None)
+                # this line matches a known pattern: generate a nonling turn
+                ctr.incr_at_gen(gen)
+                # if a player name is expected but the soclog line only
+                # provides a player number, map it
+                if 'name' in msg_fnames and 'name' not in evt_fields:
+                    if 'plnb' in evt_fields:
+                        # use player name instead of number, in the
+                        # generated message
+                        pl_nb = evt_fields['plnb']
+                        evt_fields['name'] =\
+                            parsing_state['plnb2name'][pl_nb]
+                    else:
+                        raise ValueError("Fail to find required player name")
+                return mk_turn(str(ctr),
+                               'UI',  # custom emitter
+                               evt_msg.format(**evt_fields),  # defined text
+                               state=None)
         # end WIP
 
         # last resort case
         return None
 
 
-def soclog_to_turns(soclog, sel_gen=3):
-    """Generator from soclog to Turn objects.
+def _spectator_turn(ctr, line, next_line):
+    """
+    Turn for a spectator message, given the line that follows it
+    in the soclog (from which we take the timestamp)
+    """
+    gen = 2
+    match_spect = SPECTATOR.search(line)
+    # get timestamp from the next line (we won't use it anyway)
+    timestamp = next_line.split(":+", 1)[0]
+    timestamp = ":".join(timestamp.split(":")[-4:])
+    # increase counter, 2nd generation
+    ctr.incr_at_gen(gen)
+    # these messages have no game state
+    state = EMPTY_STATE
+    # create turn
+    return stac_csv.Turn(number=str(ctr),
+                         timestamp=timestamp,
+                         emitter=match_spect.group("name"),
+                         res=state.resources_string() or YUCK,
+                         builds=state.buildups_string() or YUCK,
+                         rawtext=match_spect.group(
+                             "text").replace('&', r'\&'),
+                         annot=YUCK,
+                         comment=YUCK)
+
+
+class SoclogStream(object):
+    """Resumable conversion of a soclog that we get a bit at a time.
+
+    Lines can be pushed in as they come (eg. from a socket), or read
+    from a soclog file that is still being written (see `read_new` and
+    `follow`). Either way we only emit turns for new lines, picking up
+    from the turn counter and parsing state we had so far.
+
+    All of our state can be saved to a (JSON) checkpoint file and
+    restored from it, eg. to convert a running game across several
+    invocations of this script.
 
     Parameters
     ----------
-    soclog : File
-        The soclog file
     sel_gen : int, optional
-        Select generation for the extraction script: 1st gen corresponds
-        to intake scripts until 2016-01, gen2 adds spectator messages,
-        gen3 is for situated communication.
+        See `soclog_to_turns`
+    ctr : TurnCounter, optional
+        Turn counter to start from (mutated)
+    parsing_state : dictionary, optional
+        Parsing state to start from (mutated, see `parse_line`)
     """
-    # WIP keep parsing state ; currently stores mapping from player number
-    # to name
-    parsing_state = dict()
 
-    ctr = TurnCounter()
-    for line in soclog:
+    def __init__(self, sel_gen=3, ctr=None, parsing_state=None):
+        self.sel_gen = sel_gen
+        self.ctr = TurnCounter() if ctr is None else ctr
+        self.parsing_state = {} if parsing_state is None else parsing_state
+        # spectator message waiting for the next line (timestamp)
+        self.spectator = None
+        # incomplete last line of the text pushed so far
+        self.partial = u''
+        # bytes of the soclog file read so far (see `read_new`)
+        self.offset = 0
+
+    def push_line(self, line):
+        """
+        Turn for the next line of the soclog (or None)
+        """
+        if self.spectator is not None:
+            spectator, self.spectator = self.spectator, None
+            return _spectator_turn(self.ctr, spectator, line)
         line = line.strip()
         if not line:
-            continue
+            return None
         # line: <timestamp>:<SOCevent>:<description>
         # timestamp is in fact formatted as
         # year:month:day:hour:min:sec:millisec:timezone
@@ -577,42 +713,151 @@ def soclog_to_turns(soclog, sel_gen=3):
 
         if len(timestamp_ht) == 2:
             # timestamped line
-            turn = parse_line(ctr, line, sel_gen=sel_gen,
-                              parsing_state=parsing_state)
-            if turn is not None:
-                yield turn
+            return parse_line(self.ctr, line, sel_gen=self.sel_gen,
+                              parsing_state=self.parsing_state)
         elif len(timestamp_ht) == 1:
             # non-timestamped lines were included from gen2 on
             gen = 2
-            if sel_gen < gen:
-                continue
+            if self.sel_gen < gen:
+                return None
             # gen2 linguistic info: spectator messages
-            match_spect = SPECTATOR.search(line)
-            if match_spect:
-                # get timestamp from the next line (we won't use it anyway)
-                next_line = next(soclog)
-                timestamp = next_line.split(":+", 1)[0]
-                timestamp = ":".join(timestamp.split(":")[-4:])
-                # increase counter, 2nd generation
-                ctr.incr_at_gen(gen)
-                # these messages have no game state
-                state = EMPTY_STATE
-                # create turn
-                turn = stac_csv.Turn(number=str(ctr),
-                                     timestamp=timestamp,
-                                     emitter=match_spect.group("name"),
-                                     res=state.resources_string() or YUCK,
-                                     builds=state.buildups_string() or YUCK,
-                                     rawtext=match_spect.group(
-                                         "text").replace('&', r'\&'),
-                                     annot=YUCK,
-                                     comment=YUCK)
-                yield turn
+            if SPECTATOR.search(line):
+                self.spectator = line
+                return None
             else:
                 raise ValueError("Weird line with no timestamp: " + line)
         else:
             raise ValueError("You should not be here")
 
+    def push_lines(self, lines):
+        """
+        Turns for the next (complete) lines of the soclog
+        """
+        turns = (self.push_line(l) for l in lines)
+        return [t for t in turns if t is not None]
+
+    def push(self, text):
+        """
+        Turns for the next chunk of soclog text, which need not end on
+        a line boundary (we hold on to any incomplete line until the
+        rest of it comes in)
+        """
+        lines = (self.partial + text).splitlines(True)
+        if lines and not lines[-1].endswith('\n'):
+            self.partial = lines.pop()
+        else:
+            self.partial = u''
+        return self.push_lines(lines)
+
+    def read_new(self, path):
+        """
+        Generate turns for the complete lines added to a soclog file
+        since we last read it (`self.offset` is updated as we go)
+        """
+        with open(path, 'rb') as fin:
+            fin.seek(0, os.SEEK_END)
+            if fin.tell() < self.offset:
+                raise ValueError("{} is shorter than the {} bytes we have "
+                                 "already read".format(path, self.offset))
+            fin.seek(self.offset)
+            for line in iter(fin.readline, b''):
+                if not line.endswith(b'\n'):
+                    break  # still being written
+                self.offset += len(line)
+                turn = self.push_line(line.decode('utf-8'))
+                if turn is not None:
+                    yield turn
+
+    def follow(self, path, interval=1.0, idle_timeout=None):
+        """
+        Generate turns for a soclog file as it grows (like `tail -f`).
+
+        We poll the file every `interval` seconds and stop once it has
+        not grown for `idle_timeout` seconds (never if None)
+        """
+        last_growth = time.time()
+        while True:
+            offset = self.offset
+            for turn in self.read_new(path):
+                yield turn
+            if self.offset != offset:
+                last_growth = time.time()
+            elif idle_timeout is not None and\
+                    time.time() - last_growth >= idle_timeout:
+                return
+            else:
+                time.sleep(interval)
+
+    def checkpoint(self):
+        """
+        Our state, as a JSON serialisable dictionary
+        """
+        return {'sel_gen': self.sel_gen,
+                'counter': self.ctr.version(),
+                'parsing_state': self.parsing_state,
+                'spectator': self.spectator,
+                'partial': self.partial,
+                'offset': self.offset}
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint):
+        """
+        Stream picking up from a `checkpoint()`
+        """
+        stream = cls(sel_gen=checkpoint['sel_gen'],
+                     ctr=TurnCounter.from_version(checkpoint['counter']),
+                     parsing_state=checkpoint['parsing_state'])
+        stream.spectator = checkpoint['spectator']
+        stream.partial = checkpoint['partial']
+        stream.offset = checkpoint['offset']
+        return stream
+
+    def save(self, path):
+        """
+        Save a checkpoint to a file (atomically)
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump(self.checkpoint(), fout)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Stream picking up from a checkpoint file
+        """
+        with open(path) as fin:
+            return cls.from_checkpoint(json.load(fin))
+
+
+def soclog_to_turns(soclog, sel_gen=3, ctr=None, parsing_state=None):
+    """Generator from soclog to Turn objects.
+
+    Parameters
+    ----------
+    soclog : File
+        The soclog file (or any iterator over its lines)
+    sel_gen : int, optional
+        Select generation for the extraction script: 1st gen corresponds
+        to intake scripts until 2016-01, gen2 adds spectator messages,
+        gen3 is for situated communication.
+    ctr : TurnCounter, optional
+        Turn counter to start from, eg. if we are continuing from
+        where a previous call left off (mutated)
+    parsing_state : dictionary, optional
+        Parsing state to start from (mutated, see `parse_line`)
+
+    See `SoclogStream` if you want to pick up where this left off
+    """
+    # WIP keep parsing state ; currently stores mapping from player number
+    # to name
+    stream = SoclogStream(sel_gen=sel_gen, ctr=ctr,
+                          parsing_state=parsing_state)
+    for line in soclog:
+        turn = stream.push_line(line)
+        if turn is not None:
+            yield turn
+
 
 def main():
     """
@@ -624,15 +869,49 @@ def main():
     psr.add_argument('--output', metavar='FILE',
                      type=argparse.FileType('wb'),
                      default=sys.stdout)
-    psr.add_argument('--gen', metavar='N', type=int, default=3,
-                     help='generation of turns to include (1, 2, 3)')
+    psr.add_argument('--gen', metavar='N', type=int,
+                     help='generation of turns to include (1, 2, 3; '
+                     'default: 3, or that of the checkpoint)')
+    psr.add_argument('--follow', action='store_true',
+                     help='keep following the soclog as it grows '
+                     '(like tail -f)')
+    psr.add_argument('--checkpoint', metavar='FILE',
+                     help='pick up from (and save) our progress in this '
+                     'file, so that we only output new turns')
     args = psr.parse_args()
 
-    with codecs.open(args.soclog, 'r', 'utf-8') as soclog:
-        outcsv = stac_csv.mk_csv_writer(args.output)
+    if args.checkpoint is None and not args.follow:
+        with codecs.open(args.soclog, 'r', 'utf-8') as soclog:
+            outcsv = stac_csv.mk_csv_writer(args.output)
+            outcsv.writeheader()
+            for turn in soclog_to_turns(soclog, sel_gen=args.gen or 3):
+                outcsv.writerow(turn.to_dict())
+        return
+
+    if args.checkpoint is not None and os.path.exists(args.checkpoint):
+        stream = SoclogStream.load(args.checkpoint)
+        if args.gen is not None and args.gen != stream.sel_gen:
+            sys.exit("Checkpoint {} was made with --gen {}, not {} "
+                     "(delete it to start over)".format(args.checkpoint,
+                                                       stream.sel_gen,
+                                                       args.gen))
+    else:
+        stream = SoclogStream(sel_gen=args.gen or 3)
+    outcsv = stac_csv.mk_csv_writer(args.output)
+    if stream.offset == 0:
         outcsv.writeheader()
-        for turn in soclog_to_turns(soclog, sel_gen=args.gen):
+    turns = stream.follow(args.soclog) if args.follow else\
+        stream.read_new(args.soclog)
+    try:
+        for turn in turns:
             outcsv.writerow(turn.to_dict())
+            args.output.flush()
+            if args.checkpoint is not None:
+                stream.save(args.checkpoint)
+    except KeyboardInterrupt:
+        pass
+    if args.checkpoint is not None:
+        stream.save(args.checkpoint)
 
 
 if __name__ == '__main__':
@@ -6,13 +6,17 @@
 
 """
 Helper functions for EDU segmentation
+
+The work is done by a `Segmenter`, which compiles its rules once
+and can segment many texts at a time (optionally sharded over a
+pool of processes). The module level functions are wrappers around
+a default segmenter.
 """
 
 from   itertools import chain
+import multiprocessing
 import re
-import sys
 
-from nltk.tokenize import sent_tokenize
 import nltk.data
 
 tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
@@ -35,160 +39,261 @@ def span_text(text, sp):
     """
     return text[sp[0]:sp[1]]
 
-def segment_turn(orig_text):
-    """
-    Segment a piece of text corresponding to a STAC turn.
-    This is a segment wrapper that chops off the turn number and
-    emitter prefixes.
-    """
-    # hmm, interesting that the turn number is considered part of the text
-    # for the annotations
-    drop_turn_prefix = re.compile(r'^\d* : [^:]* : (.*)')
-    match = drop_turn_prefix.match(orig_text)
-    if match:
-        text = match.group(1)
-        post_process = lambda xs: [ shift_span(match.start(1), x) for x in xs ]
-    else:
-        text = orig_text
-        post_process = lambda x: x
-    return post_process(segment(text))
+def _sub_re(xs):
+    return '(' + '|'.join(xs) + ')'
 
-def segment(t):
-    """
-    Given a piece of text, return a list of text spans corresponding
-    to segments of the text. The segments follow each other
-    consecutively but there may be gaps (no guarantee of adjacency)
-    """
-    spans1 = tokenizer.span_tokenize(t)
-    spans2 = concat([ resegment(t,s) for s in spans1 ])
-    spans3 = fuse_segments(t,spans2)
-    spans4 = ungap_segments(spans3)
-    return spans4
+def _mk_group(name, *args):
+    return '(?P<' + name + '>' + "".join(args) + ')'
 
-def resegment(t,seg):
+def _bracket(s):
+    return '(' + s + ')'
+
+# ---------------------------------------------------------------------
+# rules
+# ---------------------------------------------------------------------
+
+# hmm, interesting that the turn number is considered part of the text
+# for the annotations
+TURN_PREFIX = r'^\d* : [^:]* : (.*)'
+
+# lhs things that trigger a split
+LHS_WORDS = [ 'yeah', 'sure', 'ok', 'okay', 'no(pe)?'
+            , 'right', 'well'
+            , '(sorry|apologies)'
+            , 'tch', '[ao]h well', 'uh oh'
+            ]
+LHS_PUNCT = [ ',', r'\.\.\.', '!', ' -' ]
+
+# rhs things that trigger a split
+RHS_WORDS = [ 'sorry'
+            , 'thanks'
+            , 'haha', 'doh!'
+            #, r'[:;]-?[PD\(\)/\\]'
+            ]
+
+EMPTY = r'((^$)|^[\?\.!]*$)'
+
+RESOURCE_ALLOC = r'(.* gets \d* (wheat|wood|clay|sheep|ore)[,\.])'
+INTERJECTIONS = [ r'a+r*g*h+'
+                , 'bah'
+                , 'eww'
+                , 'huh'
+                , 'oh' # notice this cancels out the 'oh' split above
+                , 'woo'
+                , 'wow'
+                ]
+
+# should be fused with its left neighbour
+FUSIBLE_LEFT = [r'^XXXXXXXXXXXXXX$']
+
+# should be fused with its right neighbour
+FUSIBLE_RIGHT = [ RESOURCE_ALLOC
+                , r'(^' + '|'.join(map(_bracket, INTERJECTIONS)) + '$)'
+                ]
+
+# ---------------------------------------------------------------------
+# segmenter
+# ---------------------------------------------------------------------
+
+class Segmenter(object):
     """
-    Apply hand-crafted segmentation rules. This is very crude: we hunt for
-    entries that would correspond to the left and right hand sides of a split.
-    For LHS splits, we also require a bit of separating punctuation between the
-    two sides. We also allow an arbitrary number of LHS splits, whereas we only
-    allow a single RHS split.
+    EDU segmenter: sentence tokenisation followed by some hand-crafted
+    rules for splitting and fusing segments (see `resegment` and
+    `fuse_segments`). The rules are compiled once, when the segmenter
+    is created.
     """
-    seg_start = seg[0]
-    fragment  = span_text(t,seg)
+    def __init__(self,
+                 lhs_words=None, lhs_punct=None, rhs_words=None,
+                 fusible_left=None, fusible_right=None):
+        def pick(xs, default):
+            return default if xs is None else xs
 
-    def sub_re(xs):
-        return '(' + '|'.join(xs) + ')'
+        lhs = _mk_group('prefix', r'\s*',
+                        _sub_re(pick(lhs_words, LHS_WORDS)),
+                        _sub_re(pick(lhs_punct, LHS_PUNCT)))\
+            + _mk_group('suffix', '.+$')
+        rhs = _mk_group('prefix', '.+')\
+            + _mk_group('suffix', r'\s',
+                        _sub_re(pick(rhs_words, RHS_WORDS)), '.*$')
+        self.turn_prefix_re = re.compile(TURN_PREFIX)
+        self.lhs_re = re.compile(lhs, flags=re.IGNORECASE)
+        self.rhs_re = re.compile(rhs, flags=re.IGNORECASE)
+        self.empty_re = re.compile(EMPTY)
+        self.fusible_left_re =\
+            re.compile('|'.join(pick(fusible_left, FUSIBLE_LEFT)),
+                       flags=re.IGNORECASE)
+        self.fusible_right_re =\
+            re.compile('|'.join(pick(fusible_right, FUSIBLE_RIGHT)),
+                       flags=re.IGNORECASE)
 
-    def mk_group(name, *args):
-        return '(?P<' + name + '>' + "".join(args) + ')'
+    def segment_turn(self, orig_text):
+        """
+        Segment a piece of text corresponding to a STAC turn.
+        This is a segment wrapper that chops off the turn number and
+        emitter prefixes.
+        """
+        match = self.turn_prefix_re.match(orig_text)
+        if match:
+            return [shift_span(match.start(1), x)
+                    for x in self.segment(match.group(1))]
+        else:
+            return self.segment(orig_text)
 
-    def get_span(m,group):
-        return shift_span(seg_start,m.span(group))
+    def segment(self, t):
+        """
+        Given a piece of text, return a list of text spans corresponding
+        to segments of the text. The segments follow each other
+        consecutively but there may be gaps (no guarantee of adjacency)
+        """
+        spans1 = tokenizer.span_tokenize(t)
+        spans2 = concat([ self.resegment(t,s) for s in spans1 ])
+        spans3 = self.fuse_segments(t,spans2)
+        spans4 = ungap_segments(spans3)
+        return spans4
 
-    def from_match(m):
-        lhs_span = get_span(m,'prefix')
-        rhs_span = get_span(m,'suffix')
-        return (lhs_span, rhs_span)
+    def segment_many(self, texts, pool=None, chunksize=100):
+        """
+        Segment each of the given texts (see `segment`), returning
+        their spans in the same order.
 
-    # lhs things that trigger a split
-    lhs_words = [ 'yeah', 'sure', 'ok', 'okay', 'no(pe)?'
-                , 'right', 'well'
-                , '(sorry|apologies)'
-                , 'tch', '[ao]h well', 'uh oh'
-                ]
-    lhs_punct = [ ',', '\.\.\.', '!', ' -' ]
-    lhs       = mk_group('prefix', r'\s*', sub_re(lhs_words), sub_re(lhs_punct))\
-              + mk_group('suffix', '.+$')
-    lhs_re    = re.compile(lhs, flags=re.IGNORECASE)
-    match_lhs = lhs_re.match(fragment)
-
-    # rhs things that trigger a split
-    rhs_words  = [ 'sorry'
-                 , 'thanks'
-                 , 'haha', 'doh!'
-                 #, r'[:;]-?[PD\(\)/\\]'
-                 ]
-    rhs       = mk_group('prefix', '.+')\
-              + mk_group('suffix', r'\s', sub_re(rhs_words), '.*$')
-    rhs_re    = re.compile(rhs, flags=re.IGNORECASE)
-    match_rhs = rhs_re.match(fragment)
-
-    if match_lhs:
-        (prefix, suffix)=from_match(match_lhs)
-        return [prefix] + resegment(t,suffix)
-    elif match_rhs:
-        (prefix, suffix)=from_match(match_rhs)
-        return [prefix, suffix]
-    else:
-        return [seg]
+        If you supply a pool (see `mk_pool`), the texts are sent to
+        its workers in chunks of `chunksize`
+        """
+        if pool is None:
+            return [self.segment(t) for t in texts]
+        texts = list(texts)
+        chunks = [texts[i:i + chunksize]
+                  for i in range(0, len(texts), chunksize)]
+        return concat(pool.map(_segment_chunk, chunks))
 
-def fuse_segments(t,xs):
+    def mk_pool(self, n_jobs=None):
+        """
+        Pool of processes that segment with (a copy of) this segmenter,
+        for use with `segment_many` (`n_jobs` of None or less than 1
+        for one process per CPU)
+        """
+        if n_jobs is not None and n_jobs < 1:
+            n_jobs = None
+        return multiprocessing.Pool(n_jobs,
+                                    initializer=_init_worker,
+                                    initargs=(self,))
+
+    def resegment(self, t, seg):
+        """
+        Apply hand-crafted segmentation rules. This is very crude: we hunt for
+        entries that would correspond to the left and right hand sides of a split.
+        For LHS splits, we also require a bit of separating punctuation between the
+        two sides. We also allow an arbitrary number of LHS splits, whereas we only
+        allow a single RHS split.
+        """
+        segs = []
+        while True:
+            fragment = span_text(t, seg)
+            match = self.lhs_re.match(fragment) or self.rhs_re.match(fragment)
+            if match is None:
+                segs.append(seg)
+                return segs
+            prefix = shift_span(seg[0], match.span('prefix'))
+            suffix = shift_span(seg[0], match.span('suffix'))
+            segs.append(prefix)
+            if match.re is self.rhs_re:
+                segs.append(suffix)
+                return segs
+            seg = suffix
+
+    def fuse_segments(self, t, xs):
+        """
+        Given a list of adjacent segments, return a list of segments
+        such that some things which have been wrongly broken into segments
+        are fused back into one.
+
+        A segment is fused with its left neighbour if it is empty (or just
+        punctuation) or matches a `FUSIBLE_LEFT` rule, and with its right
+        neighbour (as it stands after fusing) if it matches a
+        `FUSIBLE_RIGHT` rule.
+        """
+        def txt(idx):
+            return span_text(t, xs[idx])
+
+        ys = []
+        start = None # start of segments waiting to be fused rightwards
+        i = 0
+        while i < len(xs):
+            if i + 1 < len(xs) and (self.empty_re.match(txt(i + 1)) or
+                                    self.fusible_left_re.match(txt(i + 1))):
+                seg = (xs[i][0], xs[i + 1][1])
+                i += 2
+            elif i + 1 < len(xs) and self.fusible_right_re.match(txt(i)):
+                if start is None:
+                    start = xs[i][0]
+                i += 1
+                continue
+            else:
+                seg = xs[i]
+                i += 1
+            if start is not None:
+                seg = (start, seg[1])
+                start = None
+            ys.append(seg)
+        return ys
+
+# ---------------------------------------------------------------------
+# pool workers
+# ---------------------------------------------------------------------
+
+_WORKER_SEGMENTER = None
+
+def _init_worker(segmenter):
+    global _WORKER_SEGMENTER
+    _WORKER_SEGMENTER = segmenter
+
+def _segment_chunk(texts):
+    return [_WORKER_SEGMENTER.segment(t) for t in texts]
+
+# ---------------------------------------------------------------------
+# default segmenter
+# ---------------------------------------------------------------------
+
+_SEGMENTER = Segmenter()
+
+def segment_turn(orig_text):
     """
-    Given a list of adjacent segments, return a list of segments
-    such that some things which have been wrongly broken into segments
-    are fused back into one.
-    """
-
-    def bracket(s):
-        return '(' + s + ')'
-    def fuse(ys):
-        return (ys[0][0],ys[-1][1])
-    def txt(idx):
-        return span_text(t,xs[idx])
-
-    empty          = r'((^$)|^[\?\.!]*$)'
-    empty_re       = re.compile(empty)
-
-    resource_alloc = r'(.* gets \d* (wheat|wood|clay|sheep|ore)[,\.])'
-    interjections  = [ r'a+r*g*h+'
-                     , 'bah'
-                     , 'eww'
-                     , 'huh'
-                     , 'oh' # notice this cancels out the 'oh' split above
-                     , 'woo'
-                     , 'wow'
-                     ]
-    interjection   = r'(^' + '|'.join(map(bracket, interjections)) + '$)'
-
-    # should be fused with its left neighbour
-    fusible_left     = [r'^XXXXXXXXXXXXXX$']
-    fusible_left_re  = re.compile('|'.join(fusible_left), flags=re.IGNORECASE)
-
-    # should be fused with its right neighbour
-    fusible_right    = [resource_alloc, interjection]
-    fusible_right_re = re.compile('|'.join(fusible_right), flags=re.IGNORECASE)
-
-    if len(xs) < 2:
-        return xs
+    Segment a piece of text corresponding to a STAC turn
+    (see `Segmenter.segment_turn`)
+    """
+    return _SEGMENTER.segment_turn(orig_text)
 
-    elif empty_re.match(txt(1)):
-        fused = fuse(xs[0:2])
-        return [fused] + fuse_segments(t,xs[2:])
+def segment(t):
+    """
+    Segment a piece of text (see `Segmenter.segment`)
+    """
+    return _SEGMENTER.segment(t)
 
-    elif fusible_left_re.match(txt(1)):
-        fused = fuse(xs[0:2])
-        return [fused] + fuse_segments(t,xs[2:])
+def segment_many(texts, pool=None, chunksize=100):
+    """
+    Segment several pieces of text (see `Segmenter.segment_many`)
+    """
+    return _SEGMENTER.segment_many(texts, pool=pool, chunksize=chunksize)
 
-    elif fusible_right_re.match(txt(0)):
-        head  = xs[0]
-        rest  = fuse_segments(t,xs[1:])
-        if len(rest) > 0:
-            fused = fuse([head,rest[0]])
-            return [fused] + rest[1:]
-        else:
-            return [head]
+def resegment(t,seg):
+    """
+    Apply hand-crafted segmentation rules (see `Segmenter.resegment`)
+    """
+    return _SEGMENTER.resegment(t, seg)
 
-    else: # default case, just keep walking
-        head  = xs[0]
-        return [head] + fuse_segments(t,xs[1:])
+def fuse_segments(t,xs):
+    """
+    Fuse back wrongly broken segments (see `Segmenter.fuse_segments`)
+    """
+    return _SEGMENTER.fuse_segments(t, xs)
 
 def ungap_segments(xs):
     """
     Given a list of adjacent segments, anytime there is a gap between two segments
     L and R, absorb the gap into the right-hand segment
     """
-    last=xs[0][1]
     if len(xs) > 1:
+        last=xs[0][1]
         ys=[xs[0]]
         for x in xs[1:]:
             if x[0] == last:
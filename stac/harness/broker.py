@@ -0,0 +1,285 @@
+# License: CeCILL-B (French BSD3-like)
+
+"""
+Request broker for the parsing server
+
+Clients talk to a ZeroMQ ROUTER socket (plain REQ sockets will do, as
+before). The broker passes requests on to a pool of worker processes
+over a second ROUTER socket, one request per worker at a time, and
+queues the rest. All requests for a session (game) are routed to the
+same worker, so that it can hold on to the state for that game.
+
+A request is either a single frame (soclog lines; the session is the
+game they mention) or two frames (session identifier, soclog lines).
+A request consisting of just `status` is answered by the broker
+itself with a summary of the workers, their queues and sessions.
+
+A session is forgotten once its game is over, or once it has been idle
+for `SESSION_TIMEOUT` seconds. A worker that dies is replaced. The
+requests it was working on or had queued get an empty reply (as for
+requests that fail), and its sessions go to other workers.
+"""
+
+from __future__ import print_function
+from collections import deque
+import multiprocessing
+import re
+import sys
+import time
+import traceback
+
+import zmq
+
+WORKER_READY = b"READY"
+"sent by a worker when it is ready to accept requests"
+
+STATUS_REQUEST = b"status"
+"request for a summary of the broker state"
+
+DEFAULT_SESSION = b"default"
+"session for requests that don't mention any game"
+
+SESSION_TIMEOUT = 60 * 60
+"seconds after which we forget about an idle session"
+
+POLL_INTERVAL = 1
+"seconds between checks on the workers (and idle sessions)"
+
+_GAME_RE = re.compile(br"game=([^|\]]+)")
+_GAME_OVER = b"has won the game"
+
+# pylint: disable=no-member
+
+
+def read_request(frames):
+    """
+    Return the session and payload for a (multipart) request ::
+
+        [bytes] -> (bytes, bytes)
+    """
+    if len(frames) > 1:
+        return frames[0], frames[-1]
+    payload = frames[0]
+    match = _GAME_RE.search(payload)
+    return (match.group(1) if match else DEFAULT_SESSION), payload
+
+
+def ends_session(payload):
+    """
+    If a request (soclog lines) marks the end of its game, after which
+    we have nothing to keep for its session
+    """
+    return _GAME_OVER in payload
+
+
+def worker_loop(address, identity, handle):
+    """
+    Serve requests from the broker at the given address until killed
+
+    :param handle: request handler
+    :type handle: `(bytes, bytes) -> bytes` (session, payload -> reply)
+    """
+    context = zmq.Context()
+    socket = context.socket(zmq.DEALER)
+    socket.setsockopt(zmq.IDENTITY, identity)
+    socket.connect(address)
+    socket.send(WORKER_READY)
+    while True:
+        client, session, payload = socket.recv_multipart()
+        try:
+            reply = handle(session, payload)
+        except Exception:  # pylint: disable=broad-except
+            # a bad request shouldn't bring down the whole worker
+            # (and leave its other sessions hanging)
+            traceback.print_exc(file=sys.stderr)
+            reply = b""
+        socket.send_multipart([client, reply])
+
+
+class _WorkerState(object):
+    """
+    What the broker knows about a worker
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, process):
+        self.process = process
+        self.ready = False
+        self.current = None  # request we are waiting on
+        self.queue = deque()
+        self.sessions = set()
+
+    @property
+    def busy(self):
+        "if the worker is working on a request"
+        return self.current is not None
+
+    @property
+    def load(self):
+        "requests that are queued on or running in this worker"
+        return len(self.queue) + (1 if self.busy else 0)
+
+    def pending(self, session):
+        "if we have queued or running requests for a session"
+        return any(r[1] == session for r in self.queue) or\
+            (self.busy and self.current[1] == session)
+
+
+class Broker(object):
+    """
+    Route requests from clients on the frontend address to a pool of
+    worker processes.
+
+    :param start_worker: called in each worker process with the address
+                         of the broker backend and the worker identity;
+                         should eventually call `worker_loop`
+    :type start_worker: `(string, bytes) -> IO ()`
+    """
+
+    def __init__(self, address, n_workers, start_worker):
+        self.address = address
+        self.n_workers = n_workers
+        self.start_worker = start_worker
+        self.workers = {}
+        self.session_workers = {}
+        self.session_seen = {}  # session to time of last request
+        self.backend_address = None
+        self.n_started = 0
+
+    def _assign(self, session):
+        """
+        Worker for the given session (new sessions go to whichever
+        worker is least loaded)
+        """
+        if session not in self.session_workers:
+            ident = min(self.workers,
+                        key=lambda k: (self.workers[k].load,
+                                       len(self.workers[k].sessions)))
+            self.session_workers[session] = ident
+            self.workers[ident].sessions.add(session)
+        self.session_seen[session] = time.time()
+        return self.session_workers[session]
+
+    def _release(self, session):
+        "forget about a session"
+        ident = self.session_workers.pop(session, None)
+        if ident in self.workers:
+            self.workers[ident].sessions.discard(session)
+        self.session_seen.pop(session, None)
+
+    def _expire(self):
+        "forget about the sessions that have been idle for too long"
+        now = time.time()
+        for session, seen in list(self.session_seen.items()):
+            ident = self.session_workers.get(session)
+            if now - seen > SESSION_TIMEOUT and\
+                    not (ident in self.workers and
+                         self.workers[ident].pending(session)):
+                self._release(session)
+
+    def _start(self):
+        "start a new worker process"
+        ident = "worker-{}".format(self.n_started).encode('utf-8')
+        self.n_started += 1
+        process = multiprocessing.Process(target=self.start_worker,
+                                          args=(self.backend_address, ident))
+        process.daemon = True
+        process.start()
+        self.workers[ident] = _WorkerState(process)
+
+    def _dispatch(self, backend, ident):
+        """
+        Send the next queued request to the worker if it is free
+        """
+        worker = self.workers[ident]
+        if worker.ready and not worker.busy and worker.queue:
+            worker.current = worker.queue.popleft()
+            client, session, payload = worker.current
+            backend.send_multipart([ident, client, session, payload])
+
+    def _replace_dead(self, frontend):
+        """
+        Replace the workers that died, failing their requests and
+        letting their sessions go to other workers
+        """
+        for ident, worker in list(self.workers.items()):
+            if worker.process.is_alive():
+                continue
+            print("[broker] {} died (exit code {}); restarting it".format(
+                ident.decode('utf-8'), worker.process.exitcode),
+                file=sys.stderr)
+            del self.workers[ident]
+            lost = list(worker.queue)
+            if worker.busy:
+                lost.insert(0, worker.current)
+            for client, _, _ in lost:
+                frontend.send_multipart([client, b"", b""])
+            for session in worker.sessions:
+                self.session_workers.pop(session, None)
+            self._start()
+
+    def status(self):
+        """
+        Summary of the workers, their queue depth and sessions
+        """
+        lines = []
+        for ident in sorted(self.workers):
+            worker = self.workers[ident]
+            state = ("busy" if worker.busy else
+                     "idle" if worker.ready else "starting")
+            lines.append("{}: {} ({} queued) sessions: {}".format(
+                ident.decode('utf-8'),
+                state,
+                len(worker.queue),
+                b", ".join(sorted(worker.sessions)).decode('utf-8')))
+        return "\n".join(lines).encode('utf-8')
+
+    def run(self):
+        """
+        Start the workers and route requests forever
+        """
+        context = zmq.Context()
+        frontend = context.socket(zmq.ROUTER)
+        frontend.bind(self.address)
+        backend = context.socket(zmq.ROUTER)
+        port = backend.bind_to_random_port("tcp://127.0.0.1")
+
+        self.backend_address = "tcp://127.0.0.1:{}".format(port)
+        for _ in range(self.n_workers):
+            self._start()
+
+        poller = zmq.Poller()
+        poller.register(frontend, zmq.POLLIN)
+        poller.register(backend, zmq.POLLIN)
+        while True:
+            self._replace_dead(frontend)
+            self._expire()
+            for sock, _ in poller.poll(POLL_INTERVAL * 1000):
+                if sock is backend:
+                    frames = backend.recv_multipart()
+                    ident, rest = frames[0], frames[1:]
+                    worker = self.workers.get(ident)
+                    if worker is None:
+                        continue  # replaced in the meantime
+                    if rest == [WORKER_READY]:
+                        worker.ready = True
+                    else:
+                        client, reply = rest
+                        frontend.send_multipart([client, b"", reply])
+                        session, payload = worker.current[1:]
+                        worker.current = None
+                        if ends_session(payload) and\
+                                not worker.pending(session):
+                            self._release(session)
+                    self._dispatch(backend, ident)
+                else:
+                    frames = frontend.recv_multipart()
+                    client, request = frames[0], frames[2:]
+                    if request == [STATUS_REQUEST]:
+                        frontend.send_multipart([client, b"",
+                                                 self.status()])
+                        continue
+                    session, payload = read_request(request)
+                    ident = self._assign(session)
+                    self.workers[ident].queue.append((client, session,
+                                                      payload))
+                    self._dispatch(backend, ident)
@@ -0,0 +1,290 @@
+# License: CeCILL-B (French BSD3-like)
+
+"""
+Caches for the parser pipeline
+
+The stage cache is content-addressed: a stage that declares its
+inputs and outputs (see `Stage`) is keyed on a hash of its name, the
+identity of the models and tools we parse with (see `stamp_paths`),
+and the contents of its inputs. If we have seen that key before, we copy the cached
+outputs into place instead of running the stage.
+
+Entries are stored as directories named after their key, written to
+a scratch name first and renamed into place (so concurrent parsers
+can share a cache). The cache is kept under a size bound by evicting
+the least recently used entries.
+
+We also have a persistent cache of results for snippets of text (eg.
+for the sentence parses and part of speech tags of individual turns),
+see `TextCache`.
+"""
+
+from __future__ import print_function
+from os import path as fp
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from attelo.harness.util import makedirs
+
+CACHE_VERSION = '1'
+"bump to invalidate existing cache entries"
+
+_SIZE_FILE = 'SIZE'
+
+
+def _walk_files(path):
+    """
+    Files in a directory (recursively; paths relative to the
+    directory) in a stable order
+    """
+    for parent, dirs, files in os.walk(path):
+        dirs.sort()
+        for fname in sorted(files):
+            yield fp.relpath(fp.join(parent, fname), path)
+
+
+def _hash_file(digest, path):
+    "update a digest with the contents of a file"
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(65536), b''):
+            digest.update(block)
+
+
+def hash_paths(digest, paths, root=None):
+    """
+    Update a digest with the names and contents of the given files
+    or directories (names relative to `root` if they are inside it,
+    basenames otherwise). Missing paths count too.
+    """
+    for path in paths:
+        if root is not None and fp.abspath(path).startswith(root + os.sep):
+            name = fp.relpath(path, root)
+        else:
+            name = fp.basename(path)
+        digest.update(b'\0path\0' + name.encode('utf-8'))
+        if fp.isdir(path):
+            for relpath in _walk_files(path):
+                digest.update(b'\0file\0' + relpath.encode('utf-8'))
+                _hash_file(digest, fp.join(path, relpath))
+        elif fp.exists(path):
+            _hash_file(digest, path)
+        else:
+            digest.update(b'\0missing')
+
+
+def stamp_paths(paths):
+    """
+    A string that changes whenever the given files or directories do
+    (as far as their names, sizes and modification times tell; this is
+    for models and tools, which are too big to hash every time)
+    """
+    stamps = []
+    for path in paths:
+        path = fp.realpath(path)
+        if fp.isdir(path):
+            relpaths = list(_walk_files(path))
+        elif fp.exists(path):
+            relpaths = ['.']
+        else:
+            stamps.append(path + ' missing')
+            continue
+        stamps.append(path)
+        for relpath in relpaths:
+            fname = fp.normpath(fp.join(path, relpath))
+            stamps.append('{0} {1} {2!r}'.format(relpath,
+                                                 fp.getsize(fname),
+                                                 fp.getmtime(fname)))
+    return '\n'.join(stamps)
+
+
+def _copy(src, tgt):
+    "copy a file or directory, replacing the target"
+    if fp.isdir(tgt) and not fp.islink(tgt):
+        shutil.rmtree(tgt)
+    elif fp.lexists(tgt):
+        os.unlink(tgt)
+    if fp.isdir(src):
+        shutil.copytree(src, tgt)
+    else:
+        makedirs(fp.dirname(tgt))
+        shutil.copy2(src, tgt)
+
+
+def _du(path):
+    "total size of the files in a directory"
+    return sum(fp.getsize(fp.join(path, f)) for f in _walk_files(path))
+
+
+def evict(cache_dir, max_size):
+    """
+    Delete the least recently used entries (subdirectories) of a
+    cache directory until their total size is below `max_size` bytes.
+
+    Entries record their own size in a `SIZE` file (so we don't need to
+    walk all of them); their mtime is their last use
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = fp.join(cache_dir, name)
+        size_file = fp.join(path, _SIZE_FILE)
+        if not fp.isfile(size_file):
+            continue  # not an entry, or not finished writing
+        with open(size_file) as fin:
+            size = int(fin.read().strip() or 0)
+        entries.append((fp.getmtime(path), size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+class StageCache(object):
+    """
+    Cache for the outputs of pipeline stages
+
+    :param cache_dir: where to keep the entries
+    :param max_size: bytes; least recently used entries are evicted
+                     beyond this
+    :param identity: what else the stage outputs depend on besides
+                     their inputs (eg. `stamp_paths` of the models)
+    """
+
+    def __init__(self, cache_dir, max_size, identity):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.identity = identity
+        makedirs(cache_dir)
+
+    def key(self, lconf, stage):
+        """
+        Cache key for a stage in the given configuration (None if the
+        stage does not declare its inputs and outputs)
+        """
+        if stage.inputs is None or stage.outputs is None:
+            return None
+        digest = hashlib.sha1()
+        for part in [CACHE_VERSION, self.identity, stage.logname]:
+            digest.update(part.encode('utf-8') + b'\0')
+        hash_paths(digest, stage.inputs(lconf), root=lconf.tmp_dir)
+        return digest.hexdigest()
+
+    def fetch(self, lconf, stage, key):
+        """
+        Copy the cached outputs for a key into place; return True if
+        there were any
+        """
+        entry = fp.join(self.cache_dir, key)
+        if not fp.isfile(fp.join(entry, _SIZE_FILE)):
+            return False
+        try:
+            for i, path in enumerate(stage.outputs(lconf)):
+                _copy(fp.join(entry, str(i)), path)
+            os.utime(entry, None)
+        except (IOError, OSError):
+            # evicted from under our feet (or some other such
+            # trouble); just run the stage
+            return False
+        return True
+
+    def store(self, lconf, stage, key):
+        """
+        Save the outputs of a stage that was just run (unless some of
+        them are missing)
+        """
+        outputs = stage.outputs(lconf)
+        if not all(fp.exists(p) for p in outputs):
+            return
+        scratch = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        for i, path in enumerate(outputs):
+            _copy(path, fp.join(scratch, str(i)))
+        with open(fp.join(scratch, _SIZE_FILE), 'w') as fout:
+            print(_du(scratch), file=fout)
+        try:
+            os.rename(scratch, fp.join(self.cache_dir, key))
+        except OSError:
+            # somebody beat us to it
+            shutil.rmtree(scratch, ignore_errors=True)
+        evict(self.cache_dir, self.max_size)
+
+
+class TextCache(object):
+    """
+    Persistent cache of results (bytes) for snippets of text.
+
+    Results are stored in an sqlite database, which several processes
+    can share, and keyed by their text along with a salt (which should
+    identify the tool and settings they were computed with). Past
+    `max_size` bytes, we evict the least recently used results.
+    """
+
+    def __init__(self, path, max_size, salt):
+        self.max_size = max_size
+        self.salt = salt
+        makedirs(fp.dirname(fp.abspath(path)))
+        self.db = sqlite3.connect(path, timeout=60)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS entries "
+                            "(key TEXT PRIMARY KEY, value BLOB, "
+                            "size INTEGER, used REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_used "
+                            "ON entries (used)")
+
+    def key(self, text):
+        "cache key for a text"
+        digest = hashlib.sha1()
+        digest.update(self.salt.encode('utf-8') + b'\0')
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_many(self, texts):
+        """
+        Cached results for the given texts (dictionary from text to
+        result; texts we have nothing for are left out)
+        """
+        keys = {self.key(t): t for t in texts}
+        found = {}
+        key_list = list(keys)
+        for i in range(0, len(key_list), 500):
+            batch = key_list[i:i + 500]
+            query = ("SELECT key, value FROM entries WHERE key IN (" +
+                     ",".join("?" * len(batch)) + ")")
+            for key, value in self.db.execute(query, batch):
+                found[keys[key]] = bytes(value)
+        if found:
+            now = time.time()
+            with self.db:
+                self.db.executemany("UPDATE entries SET used = ? "
+                                    "WHERE key = ?",
+                                    [(now, self.key(t)) for t in found])
+        return found
+
+    def put_many(self, results):
+        """
+        Save results (dictionary from text to bytes) and evict old
+        ones if we have grown too large
+        """
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO entries "
+                                "VALUES (?, ?, ?, ?)",
+                                [(self.key(t), sqlite3.Binary(v),
+                                  len(v), now)
+                                 for t, v in results.items()])
+            total = self.db.execute("SELECT TOTAL(size) FROM entries")\
+                .fetchone()[0]
+            if total <= self.max_size:
+                return
+            doomed = []
+            for key, size in self.db.execute("SELECT key, size FROM entries "
+                                             "ORDER BY used"):
+                if total <= self.max_size:
+                    break
+                doomed.append((key,))
+                total -= size
+            self.db.executemany("DELETE FROM entries WHERE key = ?", doomed)
@@ -6,6 +6,7 @@ irit-rst-dt subcommands
 # License: CeCILL-B (French BSD3)
 
 from . import (clean,
+               corenlp,
                count,
                evaluate,
                gather,
@@ -25,5 +26,6 @@ SUBCOMMANDS =\
         model,
         parse,
         serve,
+        corenlp,
         stop,
     ]
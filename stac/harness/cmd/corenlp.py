@@ -0,0 +1,58 @@
+# License: CeCILL-B (French BSD3-like)
+
+"""
+launch and look after the corenlp servers
+"""
+
+from __future__ import print_function
+from os import path as fp
+import sys
+
+from ..corenlp import (ServerConfig, CoreNlpError, get_pool)
+from ..corenlp_stub import stub_command
+from ..local import (CORENLP_SERVER_DIR, CORENLP_ADDRESSES)
+
+NAME = 'corenlp'
+
+# the STAC root dir, which our paths in `stac.harness.local` are
+# relative to (we may not be run from there)
+_ROOT_DIR = fp.abspath(fp.join(fp.dirname(__file__), '..', '..', '..'))
+
+
+def config_argparser(psr):
+    """
+    Subcommand flags.
+
+    You should create and pass in the subparser to which the flags
+    are to be added.
+    """
+    psr.set_defaults(func=main)
+    psr.add_argument("--stub",
+                     action='store_true',
+                     help="launch stand-in servers instead of the real "
+                     "thing (for testing)")
+    psr.add_argument("--interval", metavar="SECONDS",
+                     type=int, default=5,
+                     help="how often to check on the servers")
+
+
+def main(args):
+    """
+    Subcommand main.
+
+    You shouldn't need to call this yourself if you're using
+    `config_argparser`
+    """
+    config = ServerConfig(address=CORENLP_ADDRESSES,
+                          directory=fp.join(_ROOT_DIR, CORENLP_SERVER_DIR),
+                          output=sys.stderr)
+    pool = get_pool(config)
+    if args.stub:
+        pool.command = stub_command
+    try:
+        pool.supervise(interval=args.interval)
+    except CoreNlpError as err:
+        pool.stop()
+        sys.exit(str(err))
+    except KeyboardInterrupt:
+        pool.stop()
@@ -10,7 +10,6 @@ from os import path as fp
 import os
 
 from attelo.harness.config import (DataConfig, RuntimeConfig)
-from attelo.harness.parse import (learn)
 from attelo.harness.util import (call, force_symlink)
 from attelo.io import (load_multipack, Torpor)
 
@@ -21,6 +20,9 @@ from ..pipeline import (dact_features_path,
                         dact_model_path,
                         latest_snap,
                         link_files)
+from ..training import (TrainingJob,
+                        run_jobs,
+                        training_plan)
 from ..util import (exit_ungathered,
                     latest_tmp)
 import stac.unit_annotations as stac_unit
@@ -57,8 +59,23 @@ def _mk_dialogue_act_model(hconf):
         stac_unit.learn_and_save(learner, fpath, mpath)
 
 
+# cost of the dialogue act model (one maxent over the edus, which
+# are much fewer than the edu pairs of the other models)
+_DIALOGUE_ACT_COST = 1
+
+
+def _learn_dialogue_acts(hconf, _):
+    "training job for the dialogue acts model"
+    _mk_dialogue_act_model(hconf)
+
+
 def _do_corpus(hconf):
-    "Run evaluation on a corpus"
+    """
+    Run evaluation on a corpus
+
+    The models are learned in parallel (as many jobs as the runtime
+    config says), biggest first
+    """
     paths = hconf.mpack_paths(test_data=False)
     if not fp.exists(paths[0]):
         exit_ungathered()
@@ -71,9 +88,11 @@ def _do_corpus(hconf):
                        folds=None)
     # (re)learn combined model (we shouldn't assume
     # it's in some scratch directory)
-    for econf in hconf.evaluations:
-        learn(hconf, econf, dconf, None)
-    _mk_dialogue_act_model(hconf)
+    jobs = training_plan(hconf, None)
+    jobs.append(TrainingJob(cost=_DIALOGUE_ACT_COST,
+                            task=_learn_dialogue_acts,
+                            args=()))
+    run_jobs(hconf, dconf, jobs, hconf.runcfg.n_jobs)
 
 # ---------------------------------------------------------------------
 # main
@@ -7,15 +7,21 @@ parse a soclog file
 
 from __future__ import print_function
 from os import path as fp
+import glob
+import multiprocessing
 import os
 import shutil
+import sys
 import tempfile
+import traceback
 
 from attelo.harness.util import (makedirs, call, force_symlink)
 import sh
 
-from ..local import (CORENLP_SERVER_DIR, CORENLP_ADDRESS,
-                     TAGGER_JAR, LEX_DIR,
+from ..local import (CORENLP_SERVER_DIR, CORENLP_ADDRESSES,
+                     CORENLP_CACHE, CORENLP_CACHE_SIZE,
+                     TAGGER_JAR, TAGGER_CACHE, TAGGER_CACHE_SIZE,
+                     LEX_DIR,
                      DIALOGUE_ACT_LEARNER,
                      EVALUATIONS)
 from ..pipeline import\
@@ -24,18 +30,30 @@ from ..pipeline import\
      check_3rd_party,
      dact_features_path,
      dact_model_path,
+     annotation_inputs,
      decode,
+     load_parser,
      minicorpus_path,
      minicorpus_doc_path,
      minicorpus_stage_path,
+     features_paths,
      parsed_bname,
+     parsed_path,
+     pos_tagged_path,
      resource_np_path,
      attelo_result_path,
-     seg_path,
      stub_name,
-     unannotated_stub_path,
      unannotated_dir_path,
-     unseg_path)
+     units_path)
+from ..documents import (build_document,
+                         read_turns,
+                         save_glozz,
+                         segment_turns,
+                         unannotated_corpus)
+from ..resident import (ResidentParser,
+                        DOCUMENT_STAGES,
+                        TURN_STAGES)
+from .. import tagger
 
 
 NAME = 'parse'
@@ -47,62 +65,35 @@ _DEBUG = 0
 # ---------------------------------------------------------------------
 
 
-def _soclog_to_csv(lconf, log):
+def _soclog_to_glozz(lconf, _):
     """
-    extract annotations from a soclog file and
-    convert to the csv format more familiar to the
-    rest of the scripts
-    """
-    turns_path = lconf.tmp("turns")
-    with open(turns_path, "w") as turns_file:
-        lconf.pyt("txt2csv/extract_turns.py", lconf.soclog,
-                  stdout=turns_file)
-    lconf.pyt("txt2csv/extract_annot.py", turns_path,
-              stdout=log)
-    os.rename(turns_path + "csv", unseg_path(lconf))
-    os.unlink(turns_path)
-
-
-def _segment_into_edus(lconf, log):
-    """
-    segment (csv -> csv)
-    """
-    lconf.pyt("segmentation/simple-segments",
-              "--csv", unseg_path(lconf),
-              seg_path(lconf),
-              stderr=log)
-
+    extract turns from the soclog file, segment them,
+    and convert them to an unannotated document, all in
+    memory (see `stac.harness.documents`)
 
-def _segmented_to_glozz(lconf, log):
+    We save the document in glozz format (because
+    that's what some of our other tools expect), but
+    the tagger reads it straight from memory
     """
-    convert the segmented CSV into glozz format
-    (because that's what some of our other tools
-    expectd)
-
-    Return a corpus directory
-    """
-    lconf.pyt("intake/csvtoglozz.py",
-              "-f", seg_path(lconf),
-              "--start", "1000",
-              stderr=log,
-              cwd=lconf.tmp_dir)
-
-    their_stub = lconf.tmp('segmented')
-    unanno_stub = unannotated_stub_path(lconf)
-    makedirs(fp.dirname(unanno_stub))
-    os.rename(their_stub + '.aa', unanno_stub + '.aa')
-    os.rename(their_stub + '.ac', unanno_stub + '.ac')
+    output = build_document(lconf, segment_turns(lconf, read_turns(lconf)))
+    save_glozz(lconf, output)
+    lconf.corpus = {output.key: output.doc}
 
 
-def _postag(lconf, log):
+def _postag(lconf, _):
     """
     Run part of speech tagger on input
+
+    We do this in-process rather than via run-3rd-party so that we
+    keep the same tagger running from one soclog to the next
+    (see `--n-jobs`)
     """
-    corpus_dir = minicorpus_path(lconf)
-    lconf.pyt("run-3rd-party",
-              "--ark-tweet-nlp", lconf.abspath(TAGGER_JAR),
-              corpus_dir, corpus_dir,
-              stderr=log)
+    jar = lconf.abspath(TAGGER_JAR)
+    cache = None if TAGGER_CACHE is None else\
+        tagger.get_tag_cache(lconf.abspath(TAGGER_CACHE),
+                             TAGGER_CACHE_SIZE, jar)
+    tagger.run_tagger(unannotated_corpus(lconf), minicorpus_path(lconf),
+                      jar, cache=cache)
 
 
 def _sentence_parse(lconf, log):
@@ -110,11 +101,14 @@ def _sentence_parse(lconf, log):
     Run sentence parser on input.
     """
     corpus_dir = minicorpus_path(lconf)
+    cache_args = [] if CORENLP_CACHE is None else\
+        ["--corenlp-cache", lconf.abspath(CORENLP_CACHE),
+         "--corenlp-cache-size", str(CORENLP_CACHE_SIZE)]
     lconf.pyt("run-3rd-party",
               "--corenlp-server", lconf.abspath(CORENLP_SERVER_DIR),
-              "--corenlp-address", CORENLP_ADDRESS,
               # "--corenlp", CORENLP_DIR,
               corpus_dir, corpus_dir,
+              *(cache_args + ["--corenlp-address"] + CORENLP_ADDRESSES),
               stderr=log)
 
 
@@ -210,22 +204,44 @@ def _graph(lconf, log):
 
 
 CORE_STAGES = \
-    [Stage("0100-extract_annot", _soclog_to_csv,
-           "Converting (soclog -> stac csv)"),
-     Stage("0150-segmentation", _segment_into_edus,
-           "Segmenting"),
-     Stage("0200-csvtoglozz", _segmented_to_glozz,
-           "Converting (stac csv -> glozz)"),
+    [Stage("0200-glozz", _soclog_to_glozz,
+           "Converting (soclog -> segmented glozz)",
+           inputs=lambda l: [l.soclog],
+           outputs=lambda l: [unannotated_dir_path(l)]),
      Stage("0300-pos-tagging", _postag,
-           "POS tagging"),
+           "POS tagging",
+           inputs=lambda l: [unannotated_dir_path(l)],
+           outputs=lambda l: [pos_tagged_path(l)]),
      Stage("0400-parsing", _sentence_parse,
-           "Sentence parsing (if slow, is starting parser server)"),
+           "Sentence parsing (if slow, is starting parser server)",
+           inputs=lambda l: [unannotated_dir_path(l)],
+           outputs=lambda l: [parsed_path(l)]),
      Stage("0500-unit-annotations", _unit_annotations,
-           "Unit-level annotation (dialogue acts, addressees)"),
+           "Unit-level annotation (dialogue acts, addressees)",
+           inputs=annotation_inputs,
+           outputs=lambda l: [units_path(l)]),
      Stage("0550-resource", _resource_extraction,
-           "Resource extraction"),
+           "Resource extraction",
+           inputs=annotation_inputs,
+           outputs=lambda l: [resource_np_path(l)]),
      Stage("0600-features", _feature_extraction,
-           "Feature extraction")]
+           "Feature extraction",
+           inputs=lambda l: annotation_inputs(l) + [resource_np_path(l)],
+           outputs=features_paths)]
+
+
+OUTPUT_STAGES = \
+    [Stage("0750-formatting", _format_decoder_output,
+           "Formatting output"),
+     Stage("0800-graphs", _graph, "Drawing graphs")]
+
+
+BATCH_STAGES = TURN_STAGES + DOCUMENT_STAGES + OUTPUT_STAGES
+"""
+Stages for each game of a batch: everything up to decoding runs
+in-process on a `ResidentParser` (holding the models for every
+evaluation), so that the games only pay for loading them once
+"""
 
 
 def _pipeline(lconf):
@@ -236,10 +252,8 @@ def _pipeline(lconf):
     stages = CORE_STAGES +\
         [Stage("0700-decoding",
                lambda x, _: decode(x, lconf.evaluations),
-               "Decoding"),
-         Stage("0750-formatting", _format_decoder_output,
-               "Formatting output"),
-         Stage("0800-graphs", _graph, "Drawing graphs")]
+               "Decoding")] +\
+        OUTPUT_STAGES
     run_pipeline(lconf, stages)
 
 
@@ -257,12 +271,18 @@ def config_argparser(psr):
     """
     psr.set_defaults(func=main)
     psr.add_argument("soclog", metavar="FILE",
-                     help="input soclog")
+                     help="input soclog (or a directory or quoted "
+                     "glob of soclogs, to parse them all)")
     psr.add_argument("output", metavar="DIR",
-                     help="output directory")
+                     help="output directory (one subdirectory per "
+                     "game if parsing several soclogs)")
     psr.add_argument("--tmpdir", metavar="DIR",
                      help="put intermediary files here "
                      "(for debugging, default is via mktemp)")
+    psr.add_argument("--n-jobs", type=int,
+                     default=1,
+                     help="number of games to parse at once when "
+                     "parsing several soclogs (-1 for one per CPU)")
 
 
 def _mk_parser_temp(args):
@@ -301,6 +321,86 @@ def _copy_results(lconf, output_dir):
 # pylint: enable=no-member
 
 
+def _soclog_paths(spec):
+    """
+    Input soclogs: the file itself, all the soclogs in a directory
+    (recursively), or the soclogs matching a glob
+    """
+    if fp.isfile(spec):
+        return [spec]
+    elif fp.isdir(spec):
+        return sorted(fp.join(parent, fname)
+                      for parent, _, files in os.walk(spec)
+                      for fname in files
+                      if fname.endswith('.soclog'))
+    else:
+        return sorted(glob.glob(spec))
+
+
+_BATCH = None
+"""
+Resident parser shared by every game in a batch (set before we fork
+the worker processes, which inherit it along with its models)
+"""
+
+
+def _parse_batch_item(job):
+    """
+    Parse one game of a batch; return the soclog along with an error
+    message if parsing failed
+    """
+    soclog, tmp_dir, output_dir = job
+    lconf = _BATCH
+    try:
+        makedirs(tmp_dir)
+        lconf.reset(soclog, tmp_dir)
+        run_pipeline(lconf, BATCH_STAGES)
+        _copy_results(lconf, output_dir)
+    except Exception:  # pylint: disable=broad-except
+        # one bad game should not sink the rest of the batch
+        return soclog, traceback.format_exc()
+    return soclog, None
+
+
+def _batch_main(args, soclogs):
+    """
+    Parse several soclogs, loading the models only once
+    """
+    global _BATCH  # pylint: disable=global-statement
+    stubs = [stub_name(s) for s in soclogs]
+    if len(set(stubs)) < len(stubs):
+        sys.exit("Can't batch parse soclogs with the same name "
+                 "(they would share an output directory)")
+    tmp_root = args.tmpdir or tempfile.mkdtemp(prefix="stac")
+    lconf = ResidentParser(soclog=soclogs[0],
+                           tmp_dir=fp.join(tmp_root, stubs[0]))
+    lconf.parsers = {econf.key: (lconf.parsers[econf.key]
+                                 if econf.key in lconf.parsers
+                                 else load_parser(lconf, econf))
+                     for econf in lconf.evaluations}
+    _BATCH = lconf
+    jobs = [(soclog, fp.join(tmp_root, stub), fp.join(args.output, stub))
+            for soclog, stub in zip(soclogs, stubs)]
+    if args.n_jobs == 1:
+        results = (_parse_batch_item(j) for j in jobs)
+    else:
+        pool = multiprocessing.Pool(None if args.n_jobs < 1 else args.n_jobs)
+        results = pool.imap_unordered(_parse_batch_item, jobs)
+        pool.close()
+    failures = []
+    for soclog, error in results:
+        if error is not None:
+            print("[stac] failed to parse", soclog, file=sys.stderr)
+            print(error, file=sys.stderr)
+            failures.append(soclog)
+    if args.n_jobs != 1:
+        pool.join()
+    print("[stac] parsed {} of {} games (intermediary files in {})".format(
+        len(jobs) - len(failures), len(jobs), tmp_root), file=sys.stderr)
+    if failures:
+        sys.exit("Failed to parse:\n" + "\n".join(failures))
+
+
 def main(args):
     """
     Subcommand main.
@@ -309,6 +409,12 @@ def main(args):
     `config_argparser`
     """
     check_3rd_party()
+    soclogs = _soclog_paths(args.soclog)
+    if not soclogs:
+        sys.exit("No soclog files found: " + args.soclog)
+    elif not fp.isfile(args.soclog):
+        _batch_main(args, soclogs)
+        return
     lconf = StandaloneParser(soclog=args.soclog,
                              tmp_dir=_mk_parser_temp(args))
     _pipeline(lconf)
@@ -7,8 +7,10 @@ server version of parse (soclog in, ??? out)
 
 from __future__ import print_function
 from os import path as fp
+import re
 import sys
 import tempfile
+import time
 import zmq
 
 from attelo.harness.util import makedirs
@@ -19,7 +21,17 @@ from ..pipeline import (StandaloneParser,
                         check_3rd_party,
                         decode,
                         minicorpus_path,
-                        attelo_result_path)
+                        attelo_result_path,
+                        xml_output_path)
+from ..broker import (Broker,
+                      SESSION_TIMEOUT,
+                      ends_session,
+                      read_request,
+                      worker_loop)
+from ..decoding import stop_pool
+from ..incremental import IncrementalSession
+from ..local import serve_ilp_settings
+from ..resident import (ResidentParser, RESIDENT_STAGES)
 
 
 NAME = 'serve'
@@ -30,11 +42,6 @@ _DEBUG = 0
 # ---------------------------------------------------------------------
 
 
-def xml_output_path(lconf):
-    "final output of the server"
-    return attelo_result_path(lconf, lconf.test_evaluation) + ".settlers-xml"
-
-
 def _to_xml(lconf, log):
     """
     Convert to Settlers XML format
@@ -71,7 +78,12 @@ def config_argparser(psr):
     psr.add_argument("--incremental",
                      action='store_true',
                      help="each connection builds up the current "
-                     "input; restart parser for new input")
+                     "input; restart parser for new input "
+                     "(implies --resident)")
+    psr.add_argument("--resident",
+                     action='store_true',
+                     help="load models once and run every stage "
+                     "in-process (much lower latency per message)")
     psr.add_argument("--tmpdir", metavar="DIR",
                      help="put intermediary files here "
                      "(for debugging, default is via mktemp)")
@@ -79,36 +91,128 @@ def config_argparser(psr):
                      type=int,
                      required=True,
                      help="port to listen on")
+    psr.add_argument("--workers",
+                     type=int,
+                     metavar="N",
+                     help="parse in a pool of N worker processes, "
+                     "each game always going to the same worker "
+                     "(default: parse in the server process)")
 
 
-def _mk_server_temp(args):
+def _mk_server_temp(args, subdir=None):
     """
     Create a temporary directory to save intermediary parser files
     in (may be specified from args but defaults to some mktemp recipe)
+
+    If `subdir` is given, we use a directory by that name within the
+    temporary directory
     """
     if args.tmpdir is None:
         tmp_dir = fp.join(tempfile.mkdtemp(prefix="stac"))
     else:
         tmp_dir = args.tmpdir
+    if subdir is not None:
+        tmp_dir = fp.join(tmp_dir, subdir)
     makedirs(tmp_dir)
     return tmp_dir
 
 
-def _reset_parser(args):
+def _reset_parser(args, lconf=None, subdir=None):
     """
     Reset the parser and return the corresponding loop configuariton
+
+    Resident parsers are reused (pointed at the new input) rather
+    than recreated
     """
-    tmp_dir = _mk_server_temp(args)
+    tmp_dir = _mk_server_temp(args, subdir)
     soclog = fp.join(tmp_dir, "soclog")
     open(soclog, 'wb').close()
-    hconf = StandaloneParser(soclog=soclog,
-                             tmp_dir=tmp_dir)
+    if lconf is not None and args.resident:
+        lconf.reset(soclog, tmp_dir)
+        return lconf
+    elif args.resident:
+        hconf = ResidentParser(soclog=soclog,
+                               tmp_dir=tmp_dir,
+                               fork_decoders=True)
+    else:
+        hconf = StandaloneParser(soclog=soclog,
+                                 tmp_dir=tmp_dir)
     if hconf.test_evaluation is None:
         sys.exit("Can't run server: you didn't specify a test "
                  "evaluation in the local configuration")
     return hconf
 
 
+class _RequestHandler(object):
+    """
+    Parses the requests that come to a server process (holding on to
+    the parser and, in incremental mode, the state of each session)
+    """
+
+    def __init__(self, args, subdir=None):
+        self.args = args
+        self.subdir = subdir
+        self.lconf = _reset_parser(args, subdir=subdir)
+        self.sessions = {}
+        self.session_seen = {}
+
+    def _session_path(self, session):
+        "scratch directory for an incremental session"
+        name = re.sub(r'\W', '_', session.decode('utf-8'))
+        if self.subdir is not None:
+            name = fp.join(self.subdir, name)
+        return _mk_server_temp(self.args, name)
+
+    def _expire(self, now):
+        "drop the sessions that have been idle for too long"
+        for session, seen in list(self.session_seen.items()):
+            if now - seen > SESSION_TIMEOUT:
+                del self.sessions[session]
+                del self.session_seen[session]
+
+    def __call__(self, session, incoming):
+        """
+        Parse a request for the given session, and return the Settlers
+        XML output (bytes)
+        """
+        if self.args.incremental:
+            now = time.time()
+            self._expire(now)
+            if session not in self.sessions:
+                self.sessions[session] =\
+                    IncrementalSession(self.lconf,
+                                       self._session_path(session))
+            self.session_seen[session] = now
+            output_path = self.sessions[session].feed(
+                incoming.decode('utf-8'))
+            if ends_session(incoming):
+                del self.sessions[session]
+                del self.session_seen[session]
+            with open(output_path, 'rb') as fin:
+                return fin.read()
+
+        lconf = self.lconf
+        stages = RESIDENT_STAGES if self.args.resident else SERVER_STAGES
+        with open(lconf.soclog, 'ab') as fout:
+            print(incoming.strip(), file=fout)
+        run_pipeline(lconf, stages)
+        with open(xml_output_path(lconf), 'rb') as fin:
+            output = fin.read()
+        self.lconf = _reset_parser(self.args, lconf, subdir=self.subdir)
+        return output
+
+
+def _start_worker(args):
+    """
+    Worker process entry point (for the broker)
+    """
+    def _start(address, identity):
+        "load a parser and serve requests"
+        handler = _RequestHandler(args, subdir=identity.decode('utf-8'))
+        worker_loop(address, identity, handler)
+    return _start
+
+
 def main(args):
     """
     Subcommand main.
@@ -117,19 +221,25 @@ def main(args):
     `config_argparser`
     """
     check_3rd_party()
-
+    # players are waiting: bound the ILP decoders' time and problem size
+    serve_ilp_settings()
+    if args.incremental:
+        args.resident = True
+    address = "tcp://*:{}".format(args.port)
+    if args.workers is not None:
+        return Broker(address, args.workers, _start_worker(args)).run()
+
+    # load the parser (forking its decoding workers) before we open
+    # the socket, which the workers would otherwise inherit
+    handler = _RequestHandler(args)
 # pylint: disable=no-member
     context = zmq.Context()
     socket = context.socket(zmq.REP)
 # pylint: enable=no-member
-    socket.bind("tcp://*:{}".format(args.port))
-    lconf = _reset_parser(args)
-    while True:
-        incoming = socket.recv()
-        with open(lconf.soclog, 'ab') as fout:
-            print(incoming.strip(), file=fout)
-        run_pipeline(lconf, SERVER_STAGES)
-        with open(xml_output_path(lconf), 'rb') as fin:
-            socket.send(fin.read())
-        if not args.incremental:
-            lconf = _reset_parser(args)
+    socket.bind(address)
+    try:
+        while True:
+            session, incoming = read_request([socket.recv()])
+            socket.send(handler(session, incoming))
+    finally:
+        stop_pool()
@@ -9,7 +9,7 @@ from __future__ import print_function
 from attelo.harness.util import call
 import zmq
 
-from ..local import LEX_DIR, CORENLP_ADDRESS
+from ..local import LEX_DIR, CORENLP_ADDRESSES
 
 NAME = 'stop'
 
@@ -32,8 +32,13 @@ def main(_):
     `config_argparser`
     """
     context = zmq.Context()
-    socket = context.socket(zmq.REQ)
-    socket.connect(CORENLP_ADDRESS)
-    socket.send("stop")
-    message = socket.recv()
-    print("Received reply [%s]" % message)
+    for address in CORENLP_ADDRESSES:
+        socket = context.socket(zmq.REQ)
+        socket.connect(address)
+        socket.send("stop")
+        if socket.poll(5000):
+            message = socket.recv()
+            print("%s: received reply [%s]" % (address, message))
+        else:
+            print("%s: no reply (not running?)" % address)
+        socket.close(linger=0)
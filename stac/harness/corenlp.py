@@ -8,87 +8,634 @@ overhead from the server
 # License: CeCILL-B (French BSD3)
 
 from __future__ import print_function
-from collections import namedtuple
+from collections import deque, namedtuple
+from contextlib import contextmanager
 from os import path as fp
+import errno
+import fcntl
 import os
-import signal
+import socket as sockets
 import subprocess
 import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
 
 import zmq
 import educe.stac
 from educe.stac.corenlp import turn_id_text, parsed_file_name
 
+from .cache import TextCache
+
+# pylint: disable=no-member
+
 
 ServerConfig = namedtuple("ServerConfig", "address directory output")
+"""
+How to reach the corenlp server. The address may also be a list of
+addresses, to spread the work over several servers (see `ServerPool`
+for how they are launched)
+"""
+
+CHUNK_SIZE = 100
+"""
+Number of turns we try to send to a server in one go (we cut the
+documents between dialogues, so chunks can be bigger than this)
+"""
+
+ANNOTATORS = ["tokenize", "ssplit", "pos", "lemma", "ner", "parse"]
+"""
+Corenlp annotators the server runs. We don't read coreference chains
+anywhere, so we leave out `dcoref`; if you add it, documents are sent
+to the server whole (no chunks, no cached turns, see `run_pipeline`)
+"""
+
+SERVER_COMMAND = ["java",
+                  "-jar",
+                  "target/corenlp-server-0.1.jar",
+                  "-annotators", ",".join(ANNOTATORS),
+                  "-ssplit.eolonly", "true"]
+"""
+How we launch the server (run from the server directory); this is
+also part of the key for cached parses
+"""
+
+READY_TIMEOUT = 300
+"""
+Seconds we give a freshly launched server to answer pings
+"""
+
+PING_TIMEOUT = 2
+"""
+Seconds we wait for a server to answer a ping before deciding that
+it is not ready (a server busy with a parse may not answer in time,
+so we also check if anything is listening on its port)
+"""
+
+REQUEST_TIMEOUT = 300
+"""
+Seconds we wait for any reply from the servers before checking on
+them (relaunching the ones that died) and sending our pending
+requests again
+"""
+
+MAX_RETRIES = 3
+"""
+Number of times we send requests again (see `REQUEST_TIMEOUT`) before
+giving up
+"""
+
+LAUNCH_LOCK = fp.join(tempfile.gettempdir(), 'stac-corenlp-launch.lock')
+"""
+Lock file that processes hold while launching servers and waiting for
+them to come up (so that they don't launch two on the same port)
+"""
+
+MAX_IN_FLIGHT = 2
+"""
+Number of requests we keep queued up on each server (so that it can
+move on to the next one without waiting for us)
+"""
+
+
+class CoreNlpError(Exception):
+    """
+    Trouble talking to the corenlp server
+    """
+    pass
+
+
+def server_addresses(config):
+    """
+    List of server addresses in a configuration
+    """
+    if isinstance(config.address, (list, tuple)):
+        return list(config.address)
+    else:
+        return [config.address]
 
 
-class ServerStatus:
+def ping(address, timeout=PING_TIMEOUT):
     """
-    What is the status of our current attempt at launching the
-    server
+    True if there is a server answering at the address (within the
+    timeout, in seconds)
     """
-    def __init__(self):
-        self.tried_to_launch = False
+    socket = zmq.Context.instance().socket(zmq.REQ)
+    try:
+        socket.connect(address)
+        socket.send(b"ping")
+        return bool(socket.poll(timeout * 1000))
+    finally:
+        socket.close(linger=0)
+
 
+def _port(address):
+    "port number in a tcp address"
+    return int(address.rsplit(':', 1)[1])
 
-def _launch(config, status):
+
+def port_in_use(address):
+    """
+    True if something on this machine is listening on the port of a
+    tcp address
     """
-    Fork off an instance of the corenlp server.
-    This stays running in the background for future use
+    sock = sockets.socket(sockets.AF_INET, sockets.SOCK_STREAM)
+    try:
+        sock.setsockopt(sockets.SOL_SOCKET, sockets.SO_REUSEADDR, 1)
+        sock.bind(('', _port(address)))
+    except sockets.error as err:
+        return err.errno == errno.EADDRINUSE
+    finally:
+        sock.close()
+    return False
+
 
-    Note that this sets status.tried_to_launch
-    to True to indicate that we have launched the server
-    (but not necessarily that it is ready to receive anything)
+def _is_up(address):
+    """
+    True if there is a server at the address, which may just be too
+    busy to answer pings
     """
-    subprocess.Popen(["java", 
-                      "-jar",
-                      "target/corenlp-server-0.1.jar",
-                      "-ssplit.eolonly", "true"],
-                     cwd=config.directory,
-                     stdout=config.output)
-    status.tried_to_launch = True
+    return ping(address) or port_in_use(address)
+
+
+@contextmanager
+def _launch_lock():
+    "hold the (cross-process) server launch lock"
+    with open(LAUNCH_LOCK, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
 
 
-def _ping_timeout(config, status):
+def server_command(port):
     """
-    What to do if ping fails.
-    Launch the server and ping with indefinite wait
+    Command line to launch a server listening on the given port
+    """
+    return SERVER_COMMAND + ["-port", str(port)]
+
+
+class ServerPool(object):
+    """
+    Corenlp servers for a list of addresses, which we launch and look
+    after ourselves (servers that someone else is already running at
+    an address are just used, even if they are too busy to answer
+    pings)
+
+    Servers stay up after we are done (so that later parses need not
+    wait for the JVM to warm up) unless we `stop` them.
+
+    :param command: command line to launch a server on a port with
+                    (`server_command` unless you are using a stand-in,
+                    see `stac.harness.corenlp_stub`)
+    :type command: `int -> [string]`
+    """
+
+    def __init__(self, addresses, directory, output,
+                 command=server_command,
+                 ready_timeout=READY_TIMEOUT):
+        self.addresses = addresses
+        self.directory = directory
+        self.output = output
+        self.command = command
+        self.ready_timeout = ready_timeout
+        self.processes = {}
+
+    def _launch(self, address):
+        "fork off a server for an address"
+        print("launching corenlp-server for", address, file=sys.stderr)
+        self.processes[address] =\
+            subprocess.Popen(self.command(_port(address)),
+                             cwd=self.directory,
+                             stdout=self.output)
 
-    (ServerConfig, ServerStatus) -> (signum, frame) -> io ()
+    def _wait_ready(self, addresses):
+        """
+        Wait for the servers at each address to answer pings, or give
+        up with a `CoreNlpError` if any of ours dies or fails to come up
+        before the deadline
+
+        One of ours that exits while some other server takes the
+        address (eg. because it could not get the port) counts as
+        ready; we just use the other one
+        """
+        deadline = time.time() + self.ready_timeout
+        waiting = list(addresses)
+        while waiting:
+            for address in list(waiting):
+                process = self.processes.get(address)
+                if process is not None and process.poll() is not None:
+                    if _is_up(address):
+                        del self.processes[address]
+                        waiting.remove(address)
+                        continue
+                    raise CoreNlpError("corenlp-server for {} exited "
+                                       "with code {}".format(
+                                           address, process.returncode))
+                if ping(address):
+                    waiting.remove(address)
+            if waiting and time.time() > deadline:
+                raise CoreNlpError("corenlp-server(s) not ready after "
+                                   "{}s: {}".format(self.ready_timeout,
+                                                    ", ".join(waiting)))
+
+    def crashed(self):
+        """
+        Addresses whose server (launched by us) has died on us
+        (a server exiting normally, eg. when asked to stop, has not
+        crashed)
+        """
+        return [a for a, p in self.processes.items()
+                if p.poll() not in [None, 0]]
+
+    def ensure_ready(self):
+        """
+        Make sure there is a server at every address: relaunch any of
+        ours that has died, and launch one wherever nobody is listening;
+        then wait for them to come up.
+
+        This is done under the launch lock (see `LAUNCH_LOCK`), so a
+        process that comes after us sees our servers rather than
+        launching its own
+        """
+        with _launch_lock():
+            launched = []
+            for address in self.addresses:
+                process = self.processes.get(address)
+                if process is not None and process.poll() is None:
+                    continue
+                if _is_up(address):
+                    # somebody else's (perhaps busy parsing)
+                    self.processes.pop(address, None)
+                    continue
+                self._launch(address)
+                launched.append(address)
+            self._wait_ready(launched)
+
+    def supervise(self, interval=5):
+        """
+        Launch the servers and keep relaunching any that crash, until
+        all of them have exited normally
+        """
+        self.ensure_ready()
+        while any(p.poll() is None for p in self.processes.values()) or\
+                self.crashed():
+            for address in self.crashed():
+                print("corenlp-server for", address, "crashed",
+                      file=sys.stderr)
+                self._launch(address)
+                self._wait_ready([address])
+            time.sleep(interval)
+
+    def stop(self):
+        """
+        Terminate the servers we launched
+        """
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes.values():
+            process.wait()
+        self.processes = {}
+
+
+_POOLS = {}
+
+
+def get_pool(config):
     """
-    def inner(signum, frame):
-        "actual handler"
-        signal.alarm(0)
-        print("No ping response; launching corenlp-server",
-              file=sys.stderr)
+    Server pool for a configuration (one per process, so that we only
+    launch its servers once)
+    """
+    addresses = tuple(server_addresses(config))
+    if addresses not in _POOLS:
+        _POOLS[addresses] = ServerPool(list(addresses),
+                                       config.directory,
+                                       config.output)
+    pool = _POOLS[addresses]
+    pool.output = config.output  # the old one may well be closed
+    return pool
 
-        _launch(config, status)
-        context = zmq.Context()
-        socket = context.socket(zmq.REQ)
-        socket.connect(config.address)
-        socket.send("ping")
-    return inner
 
+def _maybe_launch(config):
+    """
+    Make sure the servers are up, launching them if need be
+    """
+    get_pool(config).ensure_ready()
 
-def _maybe_launch(config, timeout=2):
+
+def _process_many(client, texts, config):
     """
-    Ping the server; if no reply within the timeout (in seconds),
-    launch the server and wait till we can ping it
+    Send texts to the servers of a configuration, relaunching them
+    (and sending the texts again) if we hear nothing for too long
     """
-    context = zmq.Context()
-    socket = context.socket(zmq.REQ)
-    socket.connect(config.address)
-    socket.send("ping")
-    status = ServerStatus()
-    signal.signal(signal.SIGALRM, _ping_timeout(config, status))
-    signal.alarm(timeout)
-    try:
-        socket.recv()
-    except zmq.error.ZMQError as err:
-        if not status.tried_to_launch:
-            raise err
-    signal.alarm(0)  # Disable the alarm
+    return client.process_many(texts,
+                               timeout=REQUEST_TIMEOUT * 1000,
+                               recover=get_pool(config).ensure_ready)
+
+
+class CoreNlpClient(object):
+    """
+    Persistent connections to one or more corenlp servers, with a few
+    requests in flight on each at all times
+
+    We talk to each server over a DEALER socket (the servers are plain
+    REP sockets, which answer a given peer in order), so replies are
+    matched up with requests by their order on each socket.
+    """
+
+    def __init__(self, addresses, max_in_flight=MAX_IN_FLIGHT):
+        self.addresses = addresses
+        self.max_in_flight = max_in_flight
+        self.sockets = [self._connect(a) for a in addresses]
+
+    @staticmethod
+    def _connect(address):
+        "DEALER socket to a server"
+        socket = zmq.Context.instance().socket(zmq.DEALER)
+        socket.connect(address)
+        return socket
+
+    def reconnect(self):
+        """
+        Drop our connections (and any replies still owed to us) and
+        start afresh
+        """
+        for socket in self.sockets:
+            socket.close(linger=0)
+        self.sockets = [self._connect(a) for a in self.addresses]
+
+    def process_many(self, texts, timeout=None, recover=None):
+        """
+        Send each text to the corenlp servers and return their
+        responses (in the same order) ::
+
+            [unicode] -> [bytes]
+
+        :param timeout: milliseconds to wait for any reply before
+                        giving up (`CoreNlpError`); None for ever
+        :param recover: if given, called when we time out (eg. to
+                        relaunch servers that died), after which we
+                        reconnect and send the requests we were still
+                        waiting on again (up to `MAX_RETRIES` times)
+        :type recover: `() -> IO ()`
+        """
+        todo = deque(enumerate(texts))
+        pending = [deque() for _ in self.sockets]
+        results = [None] * len(texts)
+        poller = zmq.Poller()
+        for socket in self.sockets:
+            poller.register(socket, zmq.POLLIN)
+
+        def fill(i):
+            "top up the requests in flight on socket i"
+            while todo and len(pending[i]) < self.max_in_flight:
+                idx, text = todo.popleft()
+                request = ("process " + text).encode("utf-8")
+                self.sockets[i].send_multipart([b"", request])
+                pending[i].append(idx)
+
+        for i in range(len(self.sockets)):
+            fill(i)
+        retries = 0
+        while any(pending):
+            events = dict(poller.poll(timeout))
+            if not events:
+                if recover is None or retries >= MAX_RETRIES:
+                    self.reconnect()
+                    raise CoreNlpError("No reply from corenlp server(s) " +
+                                       ", ".join(self.addresses))
+                retries += 1
+                recover()
+                self.reconnect()
+                lost = sorted(idx for waiting in pending for idx in waiting)
+                todo.extendleft((idx, texts[idx]) for idx in reversed(lost))
+                pending = [deque() for _ in self.sockets]
+                poller = zmq.Poller()
+                for socket in self.sockets:
+                    poller.register(socket, zmq.POLLIN)
+                for i in range(len(self.sockets)):
+                    fill(i)
+                continue
+            for i, socket in enumerate(self.sockets):
+                if socket in events:
+                    frames = socket.recv_multipart()
+                    results[pending[i].popleft()] = frames[-1]
+                    fill(i)
+        return results
+
+
+_CLIENTS = {}
+
+
+def get_client(config):
+    """
+    Connections to the servers in a configuration (reused for the
+    lifetime of the process)
+    """
+    addresses = tuple(server_addresses(config))
+    if addresses not in _CLIENTS:
+        _CLIENTS[addresses] = CoreNlpClient(list(addresses))
+    return _CLIENTS[addresses]
+
+
+def _dialogue_starts(doc):
+    """
+    Positions (in the sorted list of turns) of the turns that start
+    a new dialogue
+    """
+    turns = sorted((u for u in doc.units if educe.stac.is_turn(u)),
+                   key=lambda u: u.text_span())
+    dialogues = sorted(u.text_span() for u in doc.units
+                       if educe.stac.is_dialogue(u))
+    starts = set()
+    for dspan in dialogues:
+        inside = [i for i, t in enumerate(turns)
+                  if dspan.encloses(t.text_span())]
+        if inside:
+            starts.add(inside[0])
+    return starts
+
+
+def _with_coref():
+    """
+    True if the server resolves coreference, which it can only do over
+    a whole document (so we must not cut documents up)
+    """
+    return "dcoref" in ANNOTATORS
+
+
+def chunk_text(doc, chunk_size=CHUNK_SIZE):
+    """
+    Split the (one turn per line) text we send to corenlp for a
+    document into chunks, each of them a run of whole dialogues of at
+    least `chunk_size` turns (bar the last one); concatenated, the
+    chunks make up the text for the whole document ::
+
+        Document -> [unicode]
+    """
+    lines = [ttext + "\n" for _, ttext in turn_id_text(doc)]
+    starts = _dialogue_starts(doc)
+    chunks = []
+    current = []
+    for i, line in enumerate(lines):
+        if len(current) >= chunk_size and i in starts:
+            chunks.append("".join(current))
+            current = []
+        current.append(line)
+    if current:
+        chunks.append("".join(current))
+    return chunks or ["\n"]
+
+
+def _shift_text(elem, offset):
+    "add an offset to the (integer) text of an XML element"
+    elem.text = str(int(elem.text) + offset)
+
+
+def merge_results(responses, chunks):
+    """
+    Combine the corenlp XML output for consecutive chunks of a text
+    into the output we would have had for the whole of it (character
+    offsets and sentence numbers continue from one chunk to the next)
+
+    Coreference chains are renumbered, but chains that would have
+    crossed chunks come out broken up, so don't use this if you care
+    about coreference (see `ANNOTATORS`) ::
+
+        ([bytes], [unicode]) -> bytes
+    """
+    if len(responses) == 1:
+        return responses[0]
+    root = ET.fromstring(responses[0])
+    document = root.find('document')
+    sentences = document.find('sentences')
+    coref = document.find('coreference')
+    n_sentences = len(sentences)
+    char_offset = len(chunks[0])
+    for response, chunk in zip(responses[1:], chunks[1:]):
+        doc2 = ET.fromstring(response).find('document')
+        sentences2 = doc2.find('sentences')
+        for sentence in list(sentences2 if sentences2 is not None else []):
+            sentence.set('id', str(int(sentence.get('id')) + n_sentences))
+            for tag in ['CharacterOffsetBegin', 'CharacterOffsetEnd']:
+                for elem in sentence.iter(tag):
+                    _shift_text(elem, char_offset)
+            sentences.append(sentence)
+        coref2 = doc2.find('coreference')
+        if coref2 is not None:
+            for elem in coref2.iter('sentence'):
+                _shift_text(elem, n_sentences)
+            if coref is None:
+                coref = ET.SubElement(document, 'coreference')
+            coref.extend(list(coref2))
+        n_sentences += len(sentences2) if sentences2 is not None else 0
+        char_offset += len(chunk)
+    return ET.tostring(root, encoding='utf-8')
+
+
+class ParseCache(TextCache):
+    """
+    Persistent cache of corenlp parses for single turns (one sentence
+    each, as we split sentences at line ends only).
+
+    Parses are keyed by turn text (stripped of surrounding whitespace)
+    and by the server command line (see `SERVER_COMMAND`). Each parse
+    is saved as the XML for its sentence, with character offsets
+    counted from the start of the (stripped) turn text.
+    """
+
+    def __init__(self, path, max_size):
+        super(ParseCache, self).__init__(path, max_size,
+                                         " ".join(SERVER_COMMAND))
+
+
+_PARSE_CACHES = {}
+
+
+def get_parse_cache(path, max_size):
+    """
+    Parse cache at the given path (opened once per process)
+    """
+    if path not in _PARSE_CACHES:
+        _PARSE_CACHES[path] = ParseCache(path, max_size)
+    return _PARSE_CACHES[path]
+
+
+def _sentences(response):
+    """
+    Sentence elements in a corenlp XML response
+    """
+    sentences = ET.fromstring(response).find('document/sentences')
+    return list(sentences) if sentences is not None else []
+
+
+def _parse_turns(texts, config):
+    """
+    Parse (stripped, non-empty, distinct) turn texts on their own;
+    return a dictionary from text to sentence XML (offsets from the
+    start of the text).
+
+    Texts are sent a chunk at a time; if a chunk does not come back
+    with exactly one sentence per text, we send its texts one by one,
+    leaving out any that still do not give us exactly one sentence
+    """
+    chunks = [texts[i:i + CHUNK_SIZE]
+              for i in range(0, len(texts), CHUNK_SIZE)]
+    client = get_client(config)
+    responses = _process_many(client, ["\n".join(c) + "\n" for c in chunks],
+                              config)
+    parses = {}
+    retry = []
+    for chunk, response in zip(chunks, responses):
+        sentences = _sentences(response)
+        if len(sentences) != len(chunk):
+            retry.extend(chunk)
+            continue
+        offset = 0
+        for text, sentence in zip(chunk, sentences):
+            for tag in ['CharacterOffsetBegin', 'CharacterOffsetEnd']:
+                for elem in sentence.iter(tag):
+                    _shift_text(elem, -offset)
+            parses[text] = ET.tostring(sentence, encoding='utf-8')
+            offset += len(text) + 1
+    if retry:
+        responses = _process_many(client, [t + "\n" for t in retry], config)
+        for text, response in zip(retry, responses):
+            sentences = _sentences(response)
+            if len(sentences) == 1:
+                parses[text] = ET.tostring(sentences[0], encoding='utf-8')
+    return parses
+
+
+def splice_parses(texts, parses):
+    """
+    Corenlp XML output for a document (given its turn texts) made out
+    of the parses for each of its turns ::
+
+        ([unicode], dict(unicode, bytes)) -> bytes
+
+    Character offsets and sentence numbers are as they would have been
+    for the whole document. There are no coreference chains (turns are
+    parsed on their own), so this is only for when we don't ask for
+    them (see `ANNOTATORS`)
+    """
+    root = ET.Element('root')
+    sentences = ET.SubElement(ET.SubElement(root, 'document'), 'sentences')
+    offset = 0
+    for text in texts:
+        stripped = text.strip()
+        if stripped:
+            sentence = ET.fromstring(parses[stripped])
+            sentence.set('id', str(len(sentences) + 1))
+            lead = len(text) - len(text.lstrip())
+            for tag in ['CharacterOffsetBegin', 'CharacterOffsetEnd']:
+                for elem in sentence.iter(tag):
+                    _shift_text(elem, offset + lead)
+            sentences.append(sentence)
+        offset += len(text) + 1
+    return ET.tostring(root, encoding='utf-8')
 
 
 def _prepare_path(output_dir, k):
@@ -102,7 +649,33 @@ def _prepare_path(output_dir, k):
     return output_path
 
 
-def run_pipeline(corpus, output_dir, config):
+def _save(output_dir, k, response):
+    "save the corenlp output for a document"
+    output_path = _prepare_path(output_dir, k)
+    with open(output_path, "wb") as fout:
+        print(response, file=fout)
+
+
+def _run_documents(corpus, keys, output_dir, config):
+    """
+    Parse whole documents (in chunks, unless we want coreference) and
+    save the results
+    """
+    _maybe_launch(config)
+    if _with_coref():
+        doc_chunks = [["".join(chunk_text(corpus[k]))] for k in keys]
+    else:
+        doc_chunks = [chunk_text(corpus[k]) for k in keys]
+    texts = [c for chunks in doc_chunks for c in chunks]
+    responses = _process_many(get_client(config), texts, config)
+
+    for k, chunks in zip(keys, doc_chunks):
+        doc_responses = responses[:len(chunks)]
+        responses = responses[len(chunks):]
+        _save(output_dir, k, merge_results(doc_responses, chunks))
+
+
+def run_pipeline(corpus, output_dir, config, cache=None):
     """
     Run the standard corenlp pipeline on all the (unannotated) documents in
     the corpus and save the results in the specified directory.
@@ -111,19 +684,42 @@ def run_pipeline(corpus, output_dir, config):
     in which we interact with a server version of corenlp instead of the
     offline variant
 
+    Documents are sent in chunks of a few dialogues (see `chunk_text`),
+    all at once, so that long documents can be spread over several
+    servers, and the servers need not wait on us between chunks.
+
+    If we have a `ParseCache`, we instead look up each turn in it, send
+    only the (distinct) turns it does not have to the server, and splice
+    the documents together from the parses of their turns. We don't
+    launch the server at all if we have every turn already.
+
+    Neither of these would give us coreference chains across chunks or
+    turns, so if the server resolves coreference (see `ANNOTATORS`), we
+    send it whole documents instead (and don't use the cache).
+
     We don't support split mode
     """
+    keys = list(corpus)
+    if cache is None or _with_coref():
+        _run_documents(corpus, keys, output_dir, config)
+        return
 
-    _maybe_launch(config)
-    context = zmq.Context()
-    socket = context.socket(zmq.REQ)
-    socket.connect(config.address)
-
-    for k in corpus:
-        doc = corpus[k]
-        text = "\n".join(ttext for _, ttext in turn_id_text(doc)) + "\n"
-        socket.send(("process " + text).encode("utf-8"))
-        response = socket.recv()
-        output_path = _prepare_path(output_dir, k)
-        with open(output_path, "wb") as fout:
-            print(response, file=fout)
+    doc_texts = {k: [t for _, t in turn_id_text(corpus[k])] for k in keys}
+    wanted = set(t.strip() for k in keys for t in doc_texts[k])
+    wanted.discard("")
+    parses = cache.get_many(wanted)
+    misses = sorted(wanted - set(parses))
+    if misses:
+        _maybe_launch(config)
+        new_parses = _parse_turns(misses, config)
+        cache.put_many(new_parses)
+        parses.update(new_parses)
+
+    leftovers = []
+    for k in keys:
+        if all(t.strip() in parses for t in doc_texts[k] if t.strip()):
+            _save(output_dir, k, splice_parses(doc_texts[k], parses))
+        else:
+            leftovers.append(k)
+    if leftovers:
+        _run_documents(corpus, leftovers, output_dir, config)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# License: CeCILL-B (French BSD3-like)
+
+"""
+Stand-in for corenlp-server, for testing the plumbing around it
+without a JVM (and without waiting for one to start up).
+
+It speaks the same protocol (`ping`, `process <text>`, `stop` over a
+REP socket) and answers `process` requests with CoreNLP-style XML:
+one sentence per non-blank line, whitespace separated tokens (with
+their character offsets), no actual analysis to speak of. Use it with
+`ServerPool`, eg. ::
+
+    ServerPool(addresses, directory, output, command=stub_command)
+"""
+
+from __future__ import print_function
+from os import path as fp
+import argparse
+import re
+import sys
+import xml.etree.ElementTree as ET
+
+import zmq
+
+# pylint: disable=no-member
+
+
+def stub_command(port):
+    """
+    Command line to launch a stub server on the given port
+    (a drop-in for `stac.harness.corenlp.server_command`)
+    """
+    script = fp.splitext(fp.abspath(__file__))[0] + '.py'
+    return [sys.executable, script, "-port", str(port)]
+
+
+def stub_parse(text):
+    """
+    Fake corenlp XML output for a text ::
+
+        unicode -> bytes
+    """
+    root = ET.Element('root')
+    sentences = ET.SubElement(ET.SubElement(root, 'document'), 'sentences')
+    offset = 0
+    for line in text.splitlines(True):
+        words = list(re.finditer(r'\S+', line))
+        if words:
+            sentence = ET.SubElement(sentences, 'sentence',
+                                     id=str(len(sentences) + 1))
+            tokens = ET.SubElement(sentence, 'tokens')
+            for i, match in enumerate(words):
+                token = ET.SubElement(tokens, 'token', id=str(i + 1))
+                for tag, value in [('word', match.group()),
+                                   ('lemma', match.group().lower()),
+                                   ('CharacterOffsetBegin',
+                                    offset + match.start()),
+                                   ('CharacterOffsetEnd',
+                                    offset + match.end()),
+                                   ('POS', 'NN')]:
+                    ET.SubElement(token, tag).text = str(value)
+        offset += len(line)
+    return ET.tostring(root, encoding='utf-8')
+
+
+def main():
+    "serve until told to stop"
+    psr = argparse.ArgumentParser(description="corenlp-server stand-in")
+    psr.add_argument("-port", type=int, default=5900)
+    args = psr.parse_args()
+
+    socket = zmq.Context.instance().socket(zmq.REP)
+    socket.bind("tcp://*:{}".format(args.port))
+    while True:
+        message = socket.recv()
+        if message == b"stop":
+            socket.send(b"stopping")
+            break
+        elif message.startswith(b"process "):
+            text = message[len(b"process "):].decode('utf-8')
+            socket.send(stub_parse(text))
+        else:
+            socket.send(b"pong")
+    socket.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# License: CeCILL-B (French BSD3-like)
+
+"""
+Decoding the standalone parser's input, one dialogue at a time
+
+attelo decodes each document of a multipack into a fragment file next
+to the output, and we would then glue the fragments together. Here
+every (parser, dialogue) pair is a job of its own, so that even a
+single evaluation config keeps all the cores busy. The predictions
+for each dialogue are written straight into the output of its parser,
+in the same order as `attelo.harness.parse.concatenate_outputs` would
+put them.
+
+The worker pool is started the first time we need it (or ahead of
+time, see `start_pool`) and kept until `stop_pool`, so that a server
+does not fork a new one for every message. The workers inherit the
+parsers by forking; only the datapacks are sent over to them.
+Daemonic processes (eg. the workers of a batch parse or of the server
+broker) can't fork, so they decode one dialogue after the other.
+"""
+
+from __future__ import print_function
+import multiprocessing
+import os
+import tempfile
+
+from attelo.decoding.util import (prediction_to_triples)
+from attelo.io import (write_predictions_output)
+
+# parsers for the worker processes of the pool (set before we fork,
+# so that they don't need to be pickled)
+_PARSERS = None
+
+# worker pool, along with the parsers and number of jobs it was
+# started for (see `_get_pool`)
+_POOL = None
+
+
+def _decode_with(parsers, job):
+    """
+    Decode a dialogue with one of the parsers (job: parser index,
+    dialogue key, datapack); return the parser index and key along with
+    the predictions output for the dialogue (bytes)
+    """
+    i, key, dpack = job
+    dpack = parsers[i].transform(dpack)
+    # we write through a temporary file so that the output is exactly
+    # what attelo would have written
+    fd, tmp_path = tempfile.mkstemp(prefix='stac-decode-')
+    os.close(fd)
+    try:
+        write_predictions_output(dpack, prediction_to_triples(dpack),
+                                 tmp_path)
+        with open(tmp_path, 'rb') as fin:
+            return i, key, fin.read()
+    finally:
+        os.remove(tmp_path)
+
+
+def _decode_dialogue(job):
+    "decode a dialogue in a worker process (see `_decode_with`)"
+    return _decode_with(_PARSERS, job)
+
+
+def _can_fork():
+    "if we can start worker processes from this one"
+    return not multiprocessing.current_process().daemon
+
+
+def _get_pool(parsers, n_jobs):
+    """
+    Worker pool for the given parsers, reused from one call to the next
+    as long as we are decoding with the same parsers (we start a new
+    one otherwise)
+    """
+    global _PARSERS, _POOL  # pylint: disable=global-statement
+    if _POOL is not None:
+        pool, old_parsers, old_n_jobs = _POOL
+        if old_n_jobs == n_jobs and len(old_parsers) == len(parsers) and\
+                all(p is q for p, q in zip(old_parsers, parsers)):
+            return pool
+        stop_pool()
+    _PARSERS = list(parsers)
+    pool = multiprocessing.Pool(None if n_jobs < 1 else n_jobs)
+    _POOL = pool, _PARSERS, n_jobs
+    return pool
+
+
+def start_pool(parsers, n_jobs=-1):
+    """
+    Fork the workers for decoding with the given parsers now (if we
+    would use any), rather than on the first call to `decode_multipack`
+    with them; so that they don't inherit any sockets, databases or
+    subprocesses we go on to open
+    """
+    if n_jobs not in [0, 1] and _can_fork():
+        _get_pool(parsers, n_jobs)
+
+
+def stop_pool():
+    """
+    Let the worker pool (if any) finish what it was doing and wait for
+    its workers to exit
+    """
+    global _PARSERS, _POOL  # pylint: disable=global-statement
+    if _POOL is not None:
+        pool = _POOL[0]
+        _POOL = None
+        _PARSERS = None
+        pool.close()
+        pool.join()
+
+
+def decode_multipack(mpack, parsers, output_paths, n_jobs=-1):
+    """
+    Decode every dialogue in a multipack with each of the parsers, and
+    write the predictions of each parser to the corresponding output
+    path, with at most `n_jobs` dialogues at a time (-1 for one per
+    CPU; 0 or 1 for sequential)
+
+    Jobs for the earlier parsers go first (so put the slow ones first)
+    and, for each parser, the bigger dialogues. Each dialogue is
+    written out as soon as the ones before it are.
+
+    :type parsers: [Parser]
+    :type output_paths: [FilePath]
+    """
+    keys = sorted(mpack.keys())
+    jobs = sorted(((i, k, mpack[k]) for i in range(len(parsers))
+                   for k in keys),
+                  key=lambda j: (j[0], -len(j[2].edus)))
+    waiting = [{} for _ in parsers]  # decoded but not written yet
+    written = [0 for _ in parsers]  # dialogues written, in key order
+    outputs = [open(p, 'wb') for p in output_paths]
+    try:
+        if n_jobs in [0, 1] or len(jobs) < 2 or not _can_fork():
+            results = (_decode_with(parsers, j) for j in jobs)
+        else:
+            results = _get_pool(parsers, n_jobs).imap_unordered(
+                _decode_dialogue, jobs)
+        for i, key, output in results:
+            waiting[i][key] = output
+            while written[i] < len(keys) and keys[written[i]] in waiting[i]:
+                outputs[i].write(waiting[i].pop(keys[written[i]]))
+                written[i] += 1
+            if written[i] == len(keys):
+                outputs[i].close()
+    finally:
+        for fout in outputs:
+            fout.close()
@@ -0,0 +1,119 @@
+# License: CeCILL-B (French BSD3-like)
+
+"""
+From soclog to (unannotated) educe documents, in memory
+
+The command line tools get there in several hops: soclog to CSV
+(`intake/soclogtocsv.py`), CSV to segmented CSV
+(`segmentation/simple-segments`), segmented CSV to Glozz files
+(`intake/csvtoglozz.py`), and Glozz files to educe documents (via
+`educe.stac.Reader`). Here we call the same functions directly, with
+turns and XML elements in between, and never touch the disk unless
+asked to (`save_glozz`).
+"""
+
+from __future__ import print_function
+from collections import namedtuple
+from os import path as fp
+import codecs
+
+from educe.corpus import FileId
+import educe.glozz
+import educe.stac
+
+from attelo.harness.util import makedirs
+
+from .local import SOCLOG_GENERATION
+from .pipeline import (minicorpus_path,
+                       stub_name,
+                       unannotated_stub_path)
+
+DEFAULT_ID_START = 1000
+"first Glozz identifier (fake timestamp) we hand out"
+
+
+class GlozzOutput(namedtuple('GlozzOutput', 'key doc text root id_count')):
+    """
+    An unannotated document, along with its text and Glozz XML (which
+    is what we would save), and the number of Glozz identifiers it used
+    """
+    pass
+
+
+def read_turns(lconf, soclog=None):
+    """
+    The turns of a soclog file (default: that of the parser)
+    """
+    soclogtocsv = lconf.script("intake/soclogtocsv.py")
+    with codecs.open(soclog or lconf.soclog, 'r', 'utf-8') as fin:
+        return list(soclogtocsv.soclog_to_turns(fin,
+                                                sel_gen=SOCLOG_GENERATION))
+
+
+def segment_turns(lconf, turns):
+    """
+    Segmented version of the given turns (segments are separated with
+    '&', as in the segmented CSV files)
+    """
+    segmentation = lconf.script("segmentation/segmentation.py")
+    texts = [t.rawtext for t in turns]
+    spans = segmentation.segment_many(texts)
+    return [t._replace(rawtext="&".join(segmentation.span_text(text, span)
+                                        for span in text_spans))
+            for t, text, text_spans in zip(turns, texts, spans)]
+
+
+def unannotated_key(lconf):
+    """
+    Corpus key for the unannotated document of the minicorpus
+    (matching `unannotated_stub_path`)
+    """
+    return FileId(doc=stub_name(lconf),
+                  subdoc='0',
+                  stage='unannotated',
+                  annotator=None)
+
+
+def build_document(lconf, turns, id_start=DEFAULT_ID_START):
+    """
+    Unannotated document for some segmented turns, with Glozz
+    identifiers counting from `id_start` ::
+
+        (StandaloneParser, [Turn], Int) -> GlozzOutput
+    """
+    csvtoglozz = lconf.script("intake/csvtoglozz.py")
+    csvtoglozz.init_mk_id(id_start)
+    text, root = csvtoglozz.process_turns(turns, SOCLOG_GENERATION)
+    key = unannotated_key(lconf)
+    doc = educe.glozz.read_node(root, text)
+    doc.set_origin(key)
+    return GlozzOutput(key=key,
+                       doc=doc,
+                       text=text,
+                       root=root,
+                       id_count=csvtoglozz.mk_id.counter)
+
+
+def save_glozz(lconf, output):
+    """
+    Save an unannotated document as a Glozz file pair in the
+    minicorpus (for the tools that read the corpus from there, or
+    just to look at it)
+    """
+    csvtoglozz = lconf.script("intake/csvtoglozz.py")
+    unanno_stub = unannotated_stub_path(lconf)
+    makedirs(fp.dirname(unanno_stub))
+    csvtoglozz.save_output(unanno_stub, output.text, output.root)
+
+
+def unannotated_corpus(lconf):
+    """
+    The unannotated documents of the minicorpus: the ones we built
+    in memory if we have them, else read from disk (once per input)
+    """
+    if lconf.corpus is None:
+        reader = educe.stac.Reader(minicorpus_path(lconf))
+        anno_files = reader.filter(reader.files(),
+                                   lambda k: k.stage == 'unannotated')
+        lconf.corpus = reader.slurp(anno_files)
+    return lconf.corpus
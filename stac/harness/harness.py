@@ -6,10 +6,12 @@ from os import path as fp
 import sys
 
 from attelo.fold import (make_n_fold)
-from attelo.harness import Harness
+from attelo.harness import (ClusterStage, Harness)
+from attelo.harness.config import (DataConfig)
 from attelo.harness.evaluate import (evaluate_corpus,
                                      prepare_dirs)
 from attelo.io import (load_fold_dict,
+                       load_multipack,
                        save_fold_dict)
 from attelo.parser.intra import (IntraInterPair)
 from attelo.util import (mk_rng)
@@ -23,6 +25,7 @@ from .local import (CONFIG_FILE,
                     TEST_CORPUS,
                     TEST_EVALUATION_KEY,
                     TRAINING_CORPUS)
+from .training import (run_jobs, training_plan)
 from .util import (latest_tmp, exit_ungathered)
 
 
@@ -37,6 +40,7 @@ class IritHarness(Harness):
         testset = None if TEST_CORPUS is None\
             else fp.basename(TEST_CORPUS)
         super(IritHarness, self).__init__(dataset, testset)
+        self._fold_dict = None
         self.sanity_check_config()
 
     def run(self, runcfg):
@@ -50,8 +54,36 @@ class IritHarness(Harness):
         evidence_of_gathered = self.mpack_paths(False)[0]
         if not fp.exists(evidence_of_gathered):
             exit_ungathered()
+        if runcfg.stage in [None,
+                            ClusterStage.main,
+                            ClusterStage.combined_models]:
+            # evaluate_corpus loads the multipack again for itself;
+            # we let go of ours first so as not to hold both
+            self.prefit(runcfg)
         evaluate_corpus(self)
 
+    def prefit(self, runcfg):
+        """
+        Learn the models the evaluation will need, each distinct model
+        once and in parallel (see `stac.harness.training`), so that
+        the evaluation proper only has to load them
+        """
+        mpack = load_multipack(*self.mpack_paths(False), verbose=True)
+        if runcfg.stage == ClusterStage.combined_models:
+            fold_dict = None
+            folds = [None]
+        else:
+            if runcfg.stage == ClusterStage.main or runcfg.mode == 'resume':
+                fold_dict = load_fold_dict(self.fold_file)
+            else:
+                fold_dict = self.create_folds(mpack)
+            folds = runcfg.folds or sorted(set(fold_dict.values()))
+            if runcfg.stage is None:
+                folds = list(folds) + [None]
+        dconf = DataConfig(pack=mpack, folds=fold_dict)
+        jobs = [j for f in folds for j in training_plan(self, f)]
+        run_jobs(self, dconf, jobs, runcfg.n_jobs)
+
     # ------------------------------------------------------
     # local settings
     # ------------------------------------------------------
@@ -94,14 +126,18 @@ class IritHarness(Harness):
     def create_folds(self, mpack):
         """
         Generate the folds file; return the resulting folds
+
+        We only do this once per harness (the folds we learn models
+        for in `prefit` are the ones we evaluate on)
         """
-        if FIXED_FOLD_FILE is None:
-            rng = mk_rng()
-            fold_dict = make_n_fold(mpack, 10, rng)
-        else:
-            fold_dict = load_fold_dict(FIXED_FOLD_FILE)
-        save_fold_dict(fold_dict, self.fold_file)
-        return fold_dict
+        if self._fold_dict is None:
+            if FIXED_FOLD_FILE is None:
+                rng = mk_rng()
+                self._fold_dict = make_n_fold(mpack, 10, rng)
+            else:
+                self._fold_dict = load_fold_dict(FIXED_FOLD_FILE)
+        save_fold_dict(self._fold_dict, self.fold_file)
+        return self._fold_dict
 
     # ------------------------------------------------------
     # paths
@@ -1,8 +1,10 @@
 """ ILP decoding """
 from __future__ import print_function
 
+from collections import OrderedDict
 import os
 import re
+import time
 import itertools as itr
 from os import path as fp
 import numpy as np
@@ -10,6 +12,13 @@ from tempfile import mkdtemp
 from shutil import rmtree
 from subprocess import call
 
+import scipy.sparse
+try:
+    from scipy.optimize import (Bounds, LinearConstraint, milp)
+except ImportError:
+    # scipy < 1.9
+    milp = None
+
 from attelo.table import UNRELATED
 from attelo.decoding import Decoder
 
@@ -22,6 +31,29 @@ SCIP_BIN_DIR = os.path.abspath(os.path.join(
 "Folder containing the SCIP binary files (ILP parser)"
 # end WIP
 
+if fp.isdir(SCIP_BIN_DIR):
+    ILP_BACKEND = 'scip'
+elif milp is not None:
+    ILP_BACKEND = 'milp'
+else:
+    ILP_BACKEND = None
+"""
+How we solve ILP problems by default: 'scip' (ZIMPL and SCIP binaries,
+see `SCIP_BIN_DIR`), 'milp' (in-process, with HiGHS via
+`scipy.optimize.milp`, which needs scipy >= 1.9 and so Python 3; not
+the Python 2.7 of environment.yml) or None if we have neither
+"""
+
+# The constants of template.zpl (keep in sync with it)
+RSUB_LABELS = [4, 5, 7, 8, 10, 13, 15, 18, 19]
+"(one-based) indices of the subordinating labels"
+SUB_LABEL_COUNT = 9
+EDGE_CAP_RATIO = 1.1
+"we allow at most this many edges per EDU (bar one)"
+MAX_OUT_DEGREE = 7
+TIME_LIMIT = 3600
+"seconds (see scip.parameters)"
+
 
 def pos_indexes(dpack):
     """ Returns indices of EDUs for each pairing
@@ -38,7 +70,8 @@ def pos_indexes(dpack):
         of pairings in attachment/label matrices
     """
     edu_pos = dict((e, i) for i, e in enumerate(dpack.edus))
-    pair_pos = np.vstack((edu_pos[u], edu_pos[v]) for u, v in dpack.pairings)
+    pair_pos = np.vstack([(edu_pos[u], edu_pos[v])
+                          for u, v in dpack.pairings])
 
     return tuple(pair_pos.transpose())
 
@@ -49,9 +82,12 @@ def dump_scores_to_dat_files(dpack, tgt_dir=None, prefix='default', decoded=Fals
     Default behavior is a dump of dpack.attach and dpack.label
     If decoded is True, dpack.prediction will be converted
 
-    This creates two files:
+    This creates two files, in sparse form (one line per candidate
+    pairing, EDU indexes starting from 1, read with a default of 0):
     ``attach.dat`` contains the attachment prediction scores
-    ``label.dat`` contains the label prediction scores
+        (``i j score`` lines)
+    ``label.dat`` contains the (non zero) label prediction scores
+        (``i j r score`` lines)
 
     Parameters
     ----------
@@ -73,50 +109,40 @@ def dump_scores_to_dat_files(dpack, tgt_dir=None, prefix='default', decoded=Fals
     path
         Directory receiving the dump files (see tgt_dir argument)
     """
-    n_edus = len(dpack.edus)
-    n_labels = len(dpack.labels)
     unrelated = dpack.label_number(UNRELATED)
 
-    pair_pos = pos_indexes(dpack)
+    pair_i, pair_j = pos_indexes(dpack)
 
     tmpdir = mkdtemp() if tgt_dir is None else tgt_dir
     format_str = '{0:.0f}' if decoded else '{0:.2f}'
 
     # Attachments
     att_file = os.path.join(tmpdir, '{0}.attach.dat'.format(prefix))
-    att_mat = np.zeros((n_edus, n_edus), dtype=float)
     if decoded:
-        att_mat[pair_pos] = (
-            np.array(dpack.graph.prediction != unrelated, dtype=int))
+        att_scores = np.array(dpack.graph.prediction != unrelated, dtype=int)
     else:
-        att_mat[pair_pos] = dpack.graph.attach
+        att_scores = dpack.graph.attach
 
     with open(att_file, 'w') as f:
-        f.write('\n'.join(
-                    ':'.join(format_str.format(p)
-                    for p in row)
-                for row in att_mat))
-        f.write('\n')
+        for i, j, p in zip(pair_i + 1, pair_j + 1, att_scores):
+            print(i, j, format_str.format(p), file=f)
 
     # Labels
     lab_file = os.path.join(tmpdir, '{0}.label.dat'.format(prefix))
-    lab_tsr = np.zeros((n_edus, n_edus, n_labels), dtype=float)
     if decoded:
-        attached_mask = (dpack.graph.prediction != unrelated)
-        lab_tsr[pair_pos[0][attached_mask],
-                pair_pos[1][attached_mask],
-                dpack.graph.prediction[attached_mask]] = 1
+        attached = np.flatnonzero(dpack.graph.prediction != unrelated)
+        lab_entries = zip(attached,
+                          dpack.graph.prediction[attached],
+                          itr.repeat(1))
     else:
-        lab_tsr[pair_pos] = dpack.graph.label
+        rounded = np.round(dpack.graph.label, 2)
+        lab_entries = ((k, r, rounded[k, r])
+                       for k, r in zip(*np.nonzero(rounded)))
 
     with open(lab_file, 'w') as f:
-        f.write('\n'.join(
-                    ' '.join(
-                        ':'.join(format_str.format(p)
-                        for p in tube)
-                    for tube in row)
-                for row in lab_tsr))
-        f.write('\n')
+        for k, r, p in lab_entries:
+            print(pair_i[k] + 1, pair_j[k] + 1, r + 1,
+                  format_str.format(p), file=f)
 
     return tmpdir
 
@@ -140,6 +166,144 @@ def pretty_data(data):
                 ' '.join(str(e) for e in lis)
             for lis in data)
 
+DIALOGUE_CACHE_SIZE = 256
+"how many dialogues we keep turn and speaker information for"
+
+# per dialogue information (see turn_info and speaker_info), least
+# recently used first
+_DIALOGUES = OrderedDict()
+
+# vocabulary (by id) and the indices of its speaker features
+_SPEAKER_FEATURES = {}
+
+
+def _cached(key, compute):
+    """ Value for a key in the dialogue cache, computed (and evicting
+    the least recently used entries) if need be """
+    if key in _DIALOGUES:
+        value = _DIALOGUES.pop(key)
+    else:
+        value = compute()
+        while len(_DIALOGUES) >= DIALOGUE_CACHE_SIZE:
+            _DIALOGUES.popitem(last=False)
+    _DIALOGUES[key] = value
+    return value
+
+
+def _dialogue_key(dpack):
+    """ Cache key for the dialogue of a datapack (so that datapacks
+    with different pairings over the same EDUs, eg. turn constrained
+    ones, share it) """
+    return tuple(e.id for e in dpack.edus)
+
+
+def _textual_order(dpack):
+    "EDU indexes sorted by span"
+    spans = np.array([e.span() for e in dpack.edus],
+                     dtype=np.int64).reshape(-1, 2)
+    return np.lexsort((spans[:, 1], spans[:, 0]))
+
+
+def turn_info(dpack):
+    """ Turn lengths, offsets and (one-based) indexes for each EDU
+
+    EDUs are taken in textual order, and grouped into turns by their
+    grouping and subgrouping. This is computed once per dialogue.
+
+    Parameters
+    ----------
+    dpack: DataPack
+
+    Returns
+    -------
+    tuple ([int], [int], [int])
+        Turn lengths, turn offsets and turn indexes of the EDUs
+    """
+    def compute():
+        "turn information from scratch"
+        edus = [dpack.edus[i] for i in _textual_order(dpack)]
+        groups = [(e.grouping, e.subgrouping) for e in edus]
+        starts = np.flatnonzero([i == 0 or groups[i] != groups[i - 1]
+                                 for i in range(len(groups))])
+        turn_len = np.diff(np.r_[starts, len(groups)])
+        # 1 1 1 1, then 2 2 2, for turns of lengths 4 & 3 resp.
+        edu_ind = np.repeat(np.arange(1, len(starts) + 1), turn_len)
+        return (tuple(turn_len.tolist()),
+                tuple(starts.tolist()),
+                tuple(edu_ind.tolist()))
+    return _cached(('turns', _dialogue_key(dpack)), compute)
+
+
+def _speaker_features(vocab):
+    "indices of the speaker (of the first EDU) features of a vocabulary"
+    if id(vocab) not in _SPEAKER_FEATURES or\
+            _SPEAKER_FEATURES[id(vocab)][0] is not vocab:
+        _SPEAKER_FEATURES.clear()  # we only see one vocabulary anyway
+        _SPEAKER_FEATURES[id(vocab)] = (
+            vocab,
+            np.array([i for i, e in enumerate(vocab)
+                      if e.startswith('speaker_id_DU1=')], dtype=np.int64))
+    return _SPEAKER_FEATURES[id(vocab)][1]
+
+
+def speaker_info(dpack):
+    """ Speakers and MLAST matrix of a datapack
+
+    The speaker of an EDU is read off the speaker features of the first
+    pairing it is the source of (EDUs that are not the source of any
+    pairing are left out of MLAST). In MLAST, `[i, j]` is 1 if `i` is
+    the last EDU (in textual order) before `j` for its speaker.
+
+    This is computed once per dialogue and set of source EDUs.
+
+    Parameters
+    ----------
+    dpack: DataPack
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Indices of the speaker features in the vocabulary, and the
+        MLAST matrix (over EDUs in textual order)
+    """
+    speakers = _speaker_features(dpack.vocab)
+    order = _textual_order(dpack)
+    n_edus = len(order)
+    rank = np.empty(n_edus, dtype=np.int64)
+    rank[order] = np.arange(n_edus)
+    src = rank[pos_indexes(dpack)[0]] if len(dpack.pairings)\
+        else np.zeros(0, dtype=np.int64)
+    sources, first_row = np.unique(src, return_index=True)
+
+    def compute():
+        "speakers and MLAST from scratch"
+        feats = dpack.data[first_row][:, speakers]
+        feats = feats.toarray() if scipy.sparse.issparse(feats)\
+            else np.asarray(feats)
+        hits = feats.reshape(len(sources), len(speakers)) == 1
+        # sources without speaker features all count as one (-1)
+        spk = np.where(hits.any(axis=1),
+                       speakers[np.argmax(hits, axis=1)] if len(speakers)
+                       else -1,
+                       -1)
+        # each source is the last one for its speaker up to (and
+        # including) the next EDU by the same speaker
+        by_spk = np.lexsort((sources, spk))
+        same_next = np.r_[spk[by_spk][1:] == spk[by_spk][:-1], False]
+        until = np.full(len(sources), n_edus - 1, dtype=np.int64)
+        until[by_spk[same_next]] = sources[by_spk[np.flatnonzero(same_next)
+                                                  + 1]]
+        marks = np.zeros((n_edus, n_edus + 1), dtype=int)
+        marks[sources, np.minimum(sources + 1, n_edus)] += 1
+        marks[sources, until + 1] -= 1
+        mlast = np.cumsum(marks, axis=1)[:, :n_edus]
+        mlast.flags.writeable = False
+        return mlast
+    mlast = _cached(('speakers', _dialogue_key(dpack), sources.tobytes()),
+                    compute)
+    return speakers, mlast
+
+
 def mk_zimpl_input(dpack, data_dir):
     """ Create ZIMPL input files tuned to a datapack
 
@@ -165,61 +329,21 @@ def mk_zimpl_input(dpack, data_dir):
     """
 
     # Create turn information
-    edus = sorted(dpack.edus, key=lambda x: x.span())
-    turn_len = []   # Turn lengths
-    turn_off = []   # Turn offsets
-    edu_ind = []    # Turn indexes for EDUs
-    c_off = 0
-    turn_groups = itr.groupby(edus, lambda e: (e.grouping, e.subgrouping))
-    for i, (k, turn) in enumerate(turn_groups):
-        turn = list(turn)
-        turn_len.append(len(turn))
-        turn_off.append(c_off)
-        c_off += len(turn)
-        # Appends 1 1 1 1, then 2 2 2, for turns of lengths 4 & 3 resp.
-        edu_ind.extend(itr.repeat(i + 1, len(turn)))
+    turn_len, turn_off, edu_ind = turn_info(dpack)
 
     data_path = fp.join(data_dir, 'turn.dat')
     with open(data_path, 'w') as f_data:
         print(pretty_data([turn_len, turn_off, edu_ind]), file=f_data)
 
     # Create speaker information
-    speakers = []
-    for i, e in enumerate(dpack.vocab):
-        m = re.match('speaker_id_DU1=.*', e)
-        if m:
-            speakers.append(i)
-    speakers = list(set(speakers))
-
-    edu_speakers = dict()
-    for (edu, _), feats in zip(dpack.pairings, dpack.data):
-        if edu in edu_speakers:
-            continue
-        for si in speakers:
-            if feats[0, si] == 1:
-                edu_speakers[edu] = si
-                break
-        else:
-            edu_speakers[edu] = -1
-
-    sids = dict((s, i) for i, s in enumerate(speakers))
-    current_last = dict()
-    last_mat = np.zeros((len(edus), len(edus)), dtype=int)
-
-    for i, edu in enumerate(edus):
-        for plast in current_last.values():
-            last_mat[plast][i] = 1;
-        try:
-            current_last[edu_speakers[edu]] = i
-        except KeyError:
-            pass
+    speakers, last_mat = speaker_info(dpack)
 
     data_path = fp.join(data_dir, 'mlast.dat')
     with open(data_path, 'w') as f_data:
         print(pretty_data(last_mat), file=f_data)
 
     header = '\n'.join((
-        "param EDU_COUNT := {0} ;".format(len(edus)),
+        "param EDU_COUNT := {0} ;".format(len(dpack.edus)),
         "param TURN_COUNT := {0} ;".format(len(turn_off)),
         "param PLAYER_COUNT := {0} ;".format(len(speakers)),
         "param LABEL_COUNT := {0} ;".format(len(dpack.labels)),
@@ -290,30 +414,444 @@ def load_scip_output(dpack, output_path):
 
     # Build labels
     unrelated = dpack.label_number(UNRELATED)
-    prediction = np.full(len(dpack), unrelated, dtype=np.int)
+    prediction = np.full(len(dpack), unrelated, dtype=int)
     prediction[index_attached] = output_labels
 
     return prediction
 
 
-class ILPDecoder(Decoder):
-    """ Use ILP to generate constrained structures
+class _Constraints(object):
+    """ Linear constraints ``lb <= A.x <= ub`` built a block at a time """
+
+    def __init__(self):
+        self.rows = []
+        self.cols = []
+        self.vals = []
+        self.lbs = []
+        self.ubs = []
+        self.count = 0
+
+    def add(self, n_rows, rows, cols, vals, lb, ub):
+        """ Add a block of `n_rows` constraints
+
+        `rows`, `cols` and `vals` are the coefficients (rows counted
+        from 0 within the block); `lb` and `ub` are scalars or one per
+        row
+        """
+        self.rows.append(np.asarray(rows, dtype=np.int64) + self.count)
+        self.cols.append(np.asarray(cols, dtype=np.int64))
+        self.vals.append(np.broadcast_to(np.asarray(vals, dtype=float),
+                                         np.shape(cols)))
+        self.lbs.append(np.broadcast_to(np.asarray(lb, dtype=float),
+                                        (n_rows,)))
+        self.ubs.append(np.broadcast_to(np.asarray(ub, dtype=float),
+                                        (n_rows,)))
+        self.count += n_rows
+
+    def copy(self):
+        """ Constraints we can add to without changing these ones """
+        res = _Constraints()
+        for attr in ['rows', 'cols', 'vals', 'lbs', 'ubs']:
+            setattr(res, attr, list(getattr(self, attr)))
+        res.count = self.count
+        return res
+
+    def matrix(self, n_vars):
+        """ The constraint coefficients, as a sparse matrix """
+        mat = scipy.sparse.coo_matrix((np.concatenate(self.vals),
+                                       (np.concatenate(self.rows),
+                                        np.concatenate(self.cols))),
+                                      shape=(self.count, n_vars))
+        return mat.tocsr()
+
+    def satisfied_by(self, solution):
+        """ True if the solution satisfies all the constraints """
+        values = self.matrix(len(solution)).dot(solution)
+        return bool(np.all(values >= np.concatenate(self.lbs) - 1e-6) and
+                    np.all(values <= np.concatenate(self.ubs) + 1e-6))
+
+    def linear_constraint(self, n_vars):
+        """ All the constraints, for `scipy.optimize.milp` """
+        return LinearConstraint(self.matrix(n_vars),
+                                np.concatenate(self.lbs),
+                                np.concatenate(self.ubs))
+
+
+class MilpProblem(object):
+    """ The ILP problem of template.zpl for a datapack, in a form that
+    `scipy.optimize.milp` can solve
+
+    Only the candidate pairings (with non zero scores, rounded as they
+    are when we dump them for ZIMPL) get variables.
+
+    The right frontier constraint, which accounts for the cubic part
+    of the template (`f`, `rs`, `ch`), is left out to begin with: we
+    add it one target EDU at a time, for the EDUs that a solution
+    attaches to from off their right frontier (see `rfc_violations`,
+    `add_rfc`), and solve again. Once no attachment breaks it, the
+    solution is also one of the complete problem.
+
+    Parameters
+    ----------
+    dpack: DataPack
+    """
 
-    Uses third-party tools (SCIP/ZIMPL)
+    def __init__(self, dpack):
+        n_edus = len(dpack.edus)
+        self.n_edus = n_edus
+        self.n_labels = len(dpack.labels)
+        self.unrelated = dpack.label_number(UNRELATED)
+        pair_i, pair_j = pos_indexes(dpack)
+        att = np.round(dpack.graph.attach, 2)
+        lab = np.round(dpack.graph.label, 2)
+        turn_len, turn_off, edu_ind = turn_info(dpack)
+        edu_ind = np.asarray(edu_ind)
+        self.edu_ind = edu_ind
+
+        # a[i, j]: the pairings we may attach (no_zero_att, no_diagonal,
+        # no_back)
+        may = ((att != 0) & (pair_i != pair_j) &
+               ~((pair_j < pair_i) & (edu_ind[pair_i] != edu_ind[pair_j])))
+        self.a_pair = np.flatnonzero(may)
+        self.a_i = pair_i[may]
+        self.a_j = pair_j[may]
+        n_a = len(self.a_pair)
+        a_index = np.full((n_edus, n_edus), -1, dtype=np.int64)
+        a_index[self.a_i, self.a_j] = np.arange(n_a)
+        # and those we must (last_intra)
+        must = np.concatenate([np.arange(off, off + t_len - 1)
+                               for t_len, off in zip(turn_len, turn_off)] +
+                              [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+        must = a_index[must, must + 1]
+        self.infeasible = bool(np.any(must < 0))
+
+        # x[i, j, r]: labels with non zero scores (no_zero_lab)
+        x_a, self.x_r = np.nonzero(lab[self.a_pair] != 0)
+        self.x_a = x_a
+        n_x = len(x_a)
+
+        # subordinating label variables for forward pairs (rs), by pair
+        is_sub = np.zeros(len(dpack.labels), dtype=bool)
+        is_sub[[r - 1 for r in RSUB_LABELS if r <= len(dpack.labels)]] = True
+        sub = np.flatnonzero(is_sub[self.x_r] &
+                             (self.a_i[x_a] < self.a_j[x_a]))
+        self.sub_x = sub
+        self.sub_pair, self.sub_x_pair = np.unique(x_a[sub],
+                                                   return_inverse=True)
+
+        # solution vector layout: x, a, h, c (c[t, i] at TOFF[t] + i - 1),
+        # then the right frontier variables
+        self.x_0 = 0
+        self.a_0 = n_x
+        self.h_0 = self.a_0 + n_a
+        self.c_0 = self.h_0 + n_edus
+        self.n_base = self.c_0 + n_edus
+
+        self.lower = np.zeros(self.n_base)
+        self.upper = np.ones(self.n_base)
+        self.lower[self.a_0 + must[must >= 0]] = 1
+        for t_len, t_off in zip(turn_len, turn_off):
+            # cyc_bounds
+            self.lower[self.c_0 + t_off:self.c_0 + t_off + t_len] = 1
+            self.upper[self.c_0 + t_off:self.c_0 + t_off + t_len] = t_len
+
+        # maximize score
+        self.objective = np.zeros(self.n_base)
+        self.objective[self.x_0:self.a_0] = -lab[self.a_pair[x_a], self.x_r]
+        self.objective[self.a_0:self.h_0] = -att[self.a_pair]
+
+        a_vars = self.a_0 + np.arange(n_a)
+        cons = _Constraints()
+        # attachment
+        cons.add(n_a,
+                 np.concatenate([np.arange(n_a), x_a]),
+                 np.concatenate([a_vars, self.x_0 + np.arange(n_x)]),
+                 np.concatenate([np.ones(n_a), -np.ones(n_x)]),
+                 0, 0)
+        # edge_cap
+        cons.add(1, np.zeros(n_a), a_vars, 1,
+                 -np.inf, EDGE_CAP_RATIO * (n_edus - 1))
+        # fakeroot_cap
+        root = np.flatnonzero(self.a_i == 0)
+        cons.add(1, np.zeros(len(root)), self.a_0 + root, 1, 1, 1)
+        # out_degree_cap
+        cons.add(n_edus, self.a_i, a_vars, 1, -np.inf, MAX_OUT_DEGREE)
+        # cyc_transition (only where we may attach; it holds trivially
+        # elsewhere)
+        same_turn = np.flatnonzero(edu_ind[self.a_i] == edu_ind[self.a_j])
+        n_cyc = len(same_turn)
+        c_pos = np.zeros(n_edus, dtype=np.int64)
+        for t_len, t_off in zip(turn_len, turn_off):
+            c_pos[t_off:t_off + t_len] = np.arange(t_off, t_off + t_len)
+        cons.add(n_cyc,
+                 np.tile(np.arange(n_cyc), 3),
+                 np.concatenate([self.c_0 + c_pos[self.a_j[same_turn]],
+                                 self.c_0 + c_pos[self.a_i[same_turn]],
+                                 a_vars[same_turn]]),
+                 np.concatenate([np.ones(n_cyc), -np.ones(n_cyc),
+                                 n_edus * np.ones(n_cyc)]),
+                 -np.inf, n_edus - 1)
+        # unique_head
+        cons.add(1, np.zeros(n_edus), self.h_0 + np.arange(n_edus), 1, 1, 1)
+        # find_heads
+        cons.add(n_edus,
+                 np.concatenate([self.a_j, np.arange(n_edus)]),
+                 np.concatenate([a_vars, self.h_0 + np.arange(n_edus)]),
+                 np.concatenate([np.ones(n_a), n_edus * np.ones(n_edus)]),
+                 1, n_edus)
+        self.constraints = cons
+        self.rfc = {}  # target EDU to lowest constrained source EDU
+
+    def add_rfc(self, k, i):
+        """ Constrain the attachments to EDU `k` from EDUs `i` and up
+        (to `k`) to come from its right frontier """
+        self.rfc[k] = min(i, self.rfc.get(k, i))
+
+    def _rfc_block(self, cons, k, lo, var_0):
+        """ Add the right frontier constraints (rfc_core, rfc_sub,
+        rfc_chain, rfc_iff) for attachments to EDU `k` from EDUs `lo`
+        to `k - 2`, with new variables from `var_0`; return the
+        number of variables we used
+
+        Only the halves of rfc_chain and rfc_iff that bound `f` from
+        above matter: `f` (and `ch`) only ever bound the attachments
+        from above. Likewise, `rs` is just the sum of the subordinating
+        label variables of its pair, so we use that sum directly.
+        """
+        n_f = k - 1 - lo
+        f_vars = var_0 + np.arange(n_f)  # f[j, k] for j in lo..k-2
+        # ch[j, jj, k] for the subordinating pairs (j, jj), lo <= j,
+        # jj <= k - 1
+        pairs = np.flatnonzero((self.a_i[self.sub_pair] >= lo) &
+                               (self.a_j[self.sub_pair] <= k - 1))
+        ch_i = self.a_i[self.sub_pair[pairs]]
+        ch_j = self.a_j[self.sub_pair[pairs]]
+        n_ch = len(pairs)
+        ch_vars = var_0 + n_f + np.arange(n_ch)
+        # rfc_core
+        core = np.flatnonzero((self.a_j == k) &
+                              (self.a_i >= lo) & (self.a_i <= k - 2))
+        cons.add(len(core),
+                 np.tile(np.arange(len(core)), 2),
+                 np.concatenate([self.a_0 + core,
+                                 f_vars[self.a_i[core] - lo]]),
+                 np.concatenate([np.ones(len(core)), -np.ones(len(core))]),
+                 -np.inf, 0)
+        # rfc_iff: f[j, k] <= sum of ch[j, jj, k]
+        cons.add(n_f,
+                 np.concatenate([np.arange(n_f), ch_i - lo]),
+                 np.concatenate([f_vars, ch_vars]),
+                 np.concatenate([np.ones(n_f), -np.ones(n_ch)]),
+                 -np.inf, 0)
+        # rfc_chain and rfc_sub: ch[j, jj, k] <= rs[j, jj]
+        ch_pos = np.full(len(self.sub_pair), -1, dtype=np.int64)
+        ch_pos[pairs] = np.arange(n_ch)
+        sub = np.flatnonzero(ch_pos[self.sub_x_pair] >= 0)
+        cons.add(n_ch,
+                 np.concatenate([np.arange(n_ch),
+                                 ch_pos[self.sub_x_pair[sub]]]),
+                 np.concatenate([ch_vars, self.x_0 + self.sub_x[sub]]),
+                 np.concatenate([np.ones(n_ch), -np.ones(len(sub))]),
+                 -np.inf, 0)
+        # rfc_chain: ch[j, jj, k] <= f[jj, k] (f[k - 1, k] is free)
+        inner = np.flatnonzero(ch_j <= k - 2)
+        cons.add(len(inner),
+                 np.tile(np.arange(len(inner)), 2),
+                 np.concatenate([ch_vars[inner], f_vars[ch_j[inner] - lo]]),
+                 np.concatenate([np.ones(len(inner)),
+                                 -np.ones(len(inner))]),
+                 -np.inf, 0)
+        return n_f + n_ch
+
+    def milp_args(self):
+        """ Keyword arguments for `scipy.optimize.milp` (the problem,
+        with the right frontier constraints we have added so far) """
+        cons = self.constraints.copy()
+        n_vars = self.n_base
+        for k, lo in sorted(self.rfc.items()):
+            n_vars += self._rfc_block(cons, k, lo, n_vars)
+        n_rfc = n_vars - self.n_base
+        return dict(c=np.concatenate([self.objective, np.zeros(n_rfc)]),
+                    constraints=cons.linear_constraint(n_vars),
+                    integrality=np.ones(n_vars),
+                    bounds=Bounds(np.concatenate([self.lower,
+                                                  np.zeros(n_rfc)]),
+                                  np.concatenate([self.upper,
+                                                  np.ones(n_rfc)])))
+
+    def solution_of(self, prediction):
+        """ The (base) solution vector for a prediction (label for each
+        pairing), if it satisfies all the constraints; None otherwise
+
+        The right frontier variables are left out; we check that the
+        attachments come from the right frontier directly
+        """
+        a_of_pair = np.full(len(prediction), -1, dtype=np.int64)
+        a_of_pair[self.a_pair] = np.arange(len(self.a_pair))
+        attached = np.flatnonzero(prediction != self.unrelated)
+        a_idx = a_of_pair[attached]
+        if self.infeasible or np.any(a_idx < 0):
+            return None
+        # label variables, by (attachment, label) key
+        x_keys = self.x_a * self.n_labels + self.x_r
+        x_order = np.argsort(x_keys, kind='mergesort')
+        wanted = a_idx * self.n_labels + prediction[attached]
+        pos = np.searchsorted(x_keys[x_order], wanted)
+        pos = np.minimum(pos, len(x_order) - 1)
+        if len(wanted) and (not len(x_order) or
+                            np.any(x_keys[x_order][pos] != wanted)):
+            return None
+        solution = np.zeros(self.n_base)
+        solution[self.x_0 + x_order[pos]] = 1
+        solution[self.a_0 + a_idx] = 1
+        # heads: EDUs nothing attaches to
+        indegree = np.bincount(self.a_j[a_idx], minlength=self.n_edus)
+        solution[self.h_0:self.c_0] = indegree == 0
+        # cycle counters: 1 + the longest path from the EDU within its
+        # turn (there is no such thing if the turn has a cycle)
+        intra = a_idx[self.edu_ind[self.a_i[a_idx]] ==
+                      self.edu_ind[self.a_j[a_idx]]]
+        src, tgt = self.a_i[intra], self.a_j[intra]
+        counter = np.ones(self.n_edus)
+        for _ in range(self.n_edus + 1):
+            new_counter = counter.copy()
+            np.maximum.at(new_counter, src, counter[tgt] + 1)
+            if np.array_equal(new_counter, counter):
+                break
+            counter = new_counter
+        else:
+            return None
+        solution[self.c_0:self.n_base] = counter
+        if np.any(solution < self.lower) or np.any(solution > self.upper):
+            return None
+        if not self.constraints.satisfied_by(solution):
+            return None
+        if self.rfc_violations(solution):
+            return None
+        return solution
+
+    def rfc_violations(self, solution):
+        """ Attachments (source, target EDU) of a solution that do not
+        come from the right frontier of their target
+
+        The right frontier of `k` is `k - 1` and, recursively, any EDU
+        with a subordinating relation to an EDU on the frontier that
+        comes before `k`
+        """
+        attached = solution[self.a_0:self.h_0] > 0.5
+        forward = attached & (self.a_j - self.a_i >= 2)
+        if not np.any(forward):
+            return []
+        chosen_sub = self.sub_x[solution[self.x_0 + self.sub_x] > 0.5]
+        sub_i = self.a_i[self.x_a[chosen_sub]]
+        sub_j = self.a_j[self.x_a[chosen_sub]]
+        order = np.argsort(-sub_i, kind='mergesort')
+        sub_i, sub_j = sub_i[order], sub_j[order]
+        violations = []
+        for k in np.unique(self.a_j[forward]):
+            frontier = np.zeros(self.n_edus, dtype=bool)
+            frontier[k - 1] = True
+            # sources in decreasing order, so that the targets of
+            # their subordinating relations are done by the time we
+            # get to them
+            for i, j in zip(sub_i, sub_j):
+                if j < k and frontier[j]:
+                    frontier[i] = True
+            sources = self.a_i[forward & (self.a_j == k)]
+            bad = sources[~frontier[sources]]
+            if len(bad):
+                violations.append((k, bad.min()))
+        return violations
+
+
+def solve_milp(dpack, time_limit=TIME_LIMIT, fallback=None):
+    """ Solve the ILP problem for a datapack in-process (see
+    `MilpProblem`), adding right frontier constraints until the
+    solution respects them (or until we run out of time, in which case
+    we return the last solution we had)
 
-    See ZPL_TEMPLATE_DIR for constraint set description
+    Parameters
+    ----------
+    dpack: DataPack
+
+    time_limit: float
+        Seconds we give the solver, all rounds included
+
+    fallback: numpy.ndarray
+        Prediction to return instead if we find no solution, or run
+        out of time before the right frontier constraints hold
+
+    Returns
+    -------
+    numpy.ndarray
+        Predicted label for each pairing (UNRELATED if not attached)
     """
+    unrelated = dpack.label_number(UNRELATED)
+    prediction = np.full(len(dpack), unrelated, dtype=int)
+    if len(dpack.pairings) == 0:
+        return prediction
+    problem = MilpProblem(dpack)
+    if problem.infeasible:
+        # must attach some EDUs we may not (last_intra vs no_zero_att)
+        return prediction
+    deadline = time.time() + time_limit
+    res = None
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            # the right frontier constraints don't hold yet
+            if fallback is not None or res is None:
+                return prediction if fallback is None else fallback
+            break
+        res = milp(options={'time_limit': remaining},
+                   **problem.milp_args())
+        if res.x is None:
+            # no solution (SCIP would not give us any triplets either)
+            return prediction if fallback is None else fallback
+        violations = problem.rfc_violations(res.x)
+        if not violations:
+            break
+        for k, i in violations:
+            problem.add_rfc(k, i)
+
+    chosen = res.x[problem.x_0:problem.a_0] > 0.5
+    prediction[problem.a_pair[problem.x_a[chosen]]] = problem.x_r[chosen]
+    return prediction
 
-    def decode(self, dpack, nonfixed_pairs=None):
-        # TODO integrate nonfixed_pairs, maybe?
-        tmpdir = mkdtemp()
 
+def solve_scip(dpack, time_limit=TIME_LIMIT):
+    """ Solve the ILP problem for a datapack with ZIMPL and SCIP (see
+    ZPL_TEMPLATE_DIR)
+
+    Parameters
+    ----------
+    dpack: DataPack
+
+    time_limit: float
+        Seconds we give SCIP (it returns the best solution it has found
+        by then)
+
+    Returns
+    -------
+    numpy.ndarray
+        Predicted label for each pairing (UNRELATED if not attached)
+    """
+    tmpdir = mkdtemp(prefix='ilp-')
+    try:
         # Prepare ZIMPL template and data
         dump_scores_to_dat_files(dpack, tmpdir, 'raw')
         input_path = mk_zimpl_input(dpack, tmpdir)
 
+        # SCIP parameters, with our time limit
+        param_path = fp.join(tmpdir, 'scip.parameters')
+        with open(fp.join(ZPL_TEMPLATE_DIR, 'scip.parameters')) as f_in:
+            params = [l for l in f_in
+                      if not l.startswith('limits/time')]
+        with open(param_path, 'w') as f_out:
+            f_out.writelines(params)
+            print('limits/time = {0}'.format(time_limit), file=f_out)
+
         # Run SCIP
-        param_path = fp.join(ZPL_TEMPLATE_DIR, 'scip.parameters')
         output_path = fp.join(tmpdir, 'output.scip')
         with open(output_path, 'w') as f_out:
             call([os.path.join(SCIP_BIN_DIR, 'scip'),
@@ -322,9 +860,180 @@ class ILPDecoder(Decoder):
                  stdout=f_out, cwd=tmpdir)
 
         # Gather results
-        prediction = load_scip_output(dpack, output_path)
-        graph = dpack.graph.tweak(prediction=prediction)
-        dpack = dpack.set_graph(graph)
+        return load_scip_output(dpack, output_path)
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
+
+
+def prune_scores(dpack, top_k=None, min_prob=None):
+    """ Zero out the low scores of a datapack, so that the ILP problem
+    leaves out the corresponding variables (see no_zero_att and
+    no_zero_lab in template.zpl)
 
-        rmtree(tmpdir)
-        return dpack
+    Attachments that the problem forces (last_intra) are kept, along
+    with those of the last baseline (so that the problem keeps a
+    solution if it had one), as is the best label of any attachment we
+    keep and the label the last baseline gives its attachments
+
+    Parameters
+    ----------
+    dpack: DataPack
+
+    top_k: int
+        Only keep the `top_k` best scoring attachments to each EDU
+
+    min_prob: float
+        Only keep the attachments and labels that score at least this
+
+    Returns
+    -------
+    DataPack
+        Copy of the datapack, with the pruned scores
+    """
+    pair_i, pair_j = pos_indexes(dpack)
+    attach = np.array(dpack.graph.attach, dtype=float)
+    label = np.array(dpack.graph.label, dtype=float)
+    keep = np.ones(len(attach), dtype=bool)
+    if min_prob is not None:
+        keep &= attach >= min_prob
+    if top_k is not None:
+        # rank of each pairing among those to the same EDU
+        order = np.lexsort((-attach, pair_j))
+        starts = np.flatnonzero(np.r_[True, np.diff(pair_j[order]) != 0])
+        group = np.cumsum(np.r_[False, np.diff(pair_j[order]) != 0])
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - starts[group]
+        keep &= rank < top_k
+    turn_len, turn_off, _ = turn_info(dpack)
+    forced = np.zeros((len(dpack.edus), len(dpack.edus)), dtype=bool)
+    for t_len, t_off in zip(turn_len, turn_off):
+        idx = np.arange(t_off, t_off + t_len - 1)
+        forced[idx, idx + 1] = True
+    keep |= forced[pair_i, pair_j] | (pair_j == pair_i + 1)
+
+    best = np.zeros(label.shape, dtype=bool)
+    if len(label):
+        best[np.arange(len(label)), np.argmax(label, axis=1)] = True
+        # the best label may be UNRELATED; the last baseline's isn't
+        last = np.flatnonzero(pair_j == pair_i + 1)
+        best[last, last_baseline(dpack)[last]] = True
+    if min_prob is not None:
+        label[(label < min_prob) & ~best] = 0
+    attach[~keep] = 0
+    label[~keep] = 0
+    return dpack.set_graph(dpack.graph.tweak(attach=attach, label=label))
+
+
+def last_baseline(dpack):
+    """ Attach every EDU to the one before it, with its best scoring
+    label other than UNRELATED (a solution of the ILP problem, if the
+    scores allow it)
+
+    Returns
+    -------
+    numpy.ndarray
+        Predicted label for each pairing (UNRELATED if not attached)
+    """
+    unrelated = dpack.label_number(UNRELATED)
+    prediction = np.full(len(dpack), unrelated, dtype=int)
+    pair_i, pair_j = pos_indexes(dpack)
+    last = np.flatnonzero(pair_j == pair_i + 1)
+    scores = np.array(dpack.graph.label, dtype=float)[last]
+    scores[:, unrelated] = -np.inf
+    if len(last) and scores.shape[1] > 1:
+        prediction[last] = np.argmax(scores, axis=1)
+    return prediction
+
+
+def prediction_score(dpack, prediction):
+    """ Objective value of a prediction in the ILP problem (sum of the
+    rounded scores of its attachments and labels) """
+    attached = np.flatnonzero(prediction != dpack.label_number(UNRELATED))
+    return (np.round(dpack.graph.attach, 2)[attached].sum() +
+            np.round(dpack.graph.label, 2)[attached,
+                                           prediction[attached]].sum())
+
+
+def is_ilp_solution(dpack, prediction):
+    """ True if a prediction satisfies all the constraints of the ILP
+    problem for the datapack """
+    return MilpProblem(dpack).solution_of(prediction) is not None
+
+
+class ILPDecoder(Decoder):
+    """ Use ILP to generate constrained structures
+
+    Uses third-party tools (SCIP/ZIMPL), or solves the same problem
+    in-process with `scipy.optimize.milp` (backend 'milp', which needs
+    scipy >= 1.9, and so Python 3)
+
+    See ZPL_TEMPLATE_DIR for constraint set description
+
+    Parameters
+    ----------
+    backend: string
+        'scip' or 'milp' (default: `ILP_BACKEND`)
+
+    top_k: int
+        Only consider the `top_k` best scoring attachments to each EDU
+        (see `prune_scores`)
+
+    min_prob: float
+        Only consider attachments and labels scoring at least this
+
+    time_limit: float
+        Seconds we give the solver for each dialogue; past that, we
+        take the best solution it has found
+
+    warm_start: 'last', Decoder or None
+        Where to get a starting solution from (the last baseline, or
+        another decoder). If it satisfies the constraints, we fall back
+        to it when the solver doesn't find anything better in time
+    """
+
+    def __init__(self, backend=None, top_k=None, min_prob=None,
+                 time_limit=TIME_LIMIT, warm_start=None):
+        self.backend = backend or ILP_BACKEND
+        if self.backend is None:
+            raise ValueError("No ILP solver: we need either the SCIP "
+                             "binaries in " + SCIP_BIN_DIR + " or "
+                             "scipy.optimize.milp (scipy >= 1.9, Python 3)")
+        elif self.backend == 'milp' and milp is None:
+            raise ValueError("The 'milp' ILP backend needs "
+                             "scipy.optimize.milp (scipy >= 1.9, Python 3)")
+        elif self.backend not in ['scip', 'milp']:
+            raise ValueError("Unknown ILP backend: " + str(self.backend))
+        self.top_k = top_k
+        self.min_prob = min_prob
+        self.time_limit = time_limit
+        self.warm_start = warm_start
+
+    def _starting_solution(self, dpack):
+        """ The warm start solution for a datapack, if we have one and
+        it satisfies the constraints (None otherwise) """
+        if self.warm_start is None or len(dpack.pairings) == 0:
+            return None
+        elif self.warm_start == 'last':
+            prediction = last_baseline(dpack)
+        else:
+            prediction = self.warm_start.decode(dpack).graph.prediction
+        return prediction if is_ilp_solution(dpack, prediction) else None
+
+    def decode(self, dpack, nonfixed_pairs=None):
+        # TODO integrate nonfixed_pairs, maybe?
+        pruned = dpack
+        if self.top_k is not None or self.min_prob is not None:
+            pruned = prune_scores(dpack, self.top_k, self.min_prob)
+        start = self._starting_solution(pruned)
+
+        if self.backend == 'milp':
+            prediction = solve_milp(pruned, self.time_limit, fallback=start)
+        else:
+            prediction = solve_scip(pruned, self.time_limit)
+        if start is not None and\
+                prediction_score(pruned, start) >\
+                prediction_score(pruned, prediction):
+            prediction = start
+
+        graph = dpack.graph.tweak(prediction=prediction)
+        return dpack.set_graph(graph)
@@ -0,0 +1,162 @@
+# License: CeCILL-B (French BSD3-like)
+
+"""
+Incremental parsing for the server
+
+A game is a sequence of dialogues, each one closed off by a dice roll.
+Once a dialogue is closed (and we have seen the server messages that
+follow its dice roll), nothing that happens later in the game can
+change its parse. So rather than reparsing the whole game on every
+new soclog line, we keep the parses of the closed dialogues around,
+and only ever (re)parse the dialogue in progress.
+"""
+
+from __future__ import print_function
+from os import path as fp
+import codecs
+
+from educe.annotation import Span
+
+from attelo.harness.util import makedirs
+
+from .documents import segment_turns
+from .local import SOCLOG_GENERATION
+from .pipeline import run_pipeline
+from .resident import (DOCUMENT_STAGES,
+                       read_chat_messages,
+                       write_settlers_xml)
+
+# pylint: disable=too-many-instance-attributes
+
+
+def _is_server(turn):
+    "if a turn was emitted by the server"
+    return turn.emitter in ['Server', 'UI']
+
+
+def closed_dialogues(turns):
+    """
+    Given the turns since the start of the dialogue in progress, return
+    a pair `(closed, restart)` such that `turns[:closed]` only contains
+    dialogues that later turns cannot affect anymore, and the dialogue
+    in progress is to be read from `turns[restart:]` ::
+
+        [Turn] -> (Int, Int)
+
+    This mirrors the (1st and 2nd generation) dialogue boundaries in
+    `intake/csvtoglozz.py`: a dialogue ends with a dice roll, but its
+    events are read from the server turns which follow the roll, so
+    it is only closed once the next player turn comes in. The server
+    turns from the roll on are shared by both sides of the split (they
+    contribute no text).
+
+    We return `(0, 0)` if no dialogue can be closed yet, which is
+    always the case for 3rd generation (situated) turns.
+    """
+    closed, restart = 0, 0
+    if SOCLOG_GENERATION >= 3:
+        return closed, restart
+    last_roll = None
+    for i, turn in enumerate(turns):
+        if not _is_server(turn):
+            if last_roll is not None:
+                closed, restart = i, last_roll
+                last_roll = None
+        elif "rolled a" in turn.rawtext:
+            last_roll = i
+    return closed, restart
+
+
+def _shift_message(message, offset):
+    """
+    Chat message with its EDU spans shifted by the given offset
+    """
+    edus = [e._replace(span=Span(e.span.char_start + offset,
+                                 e.span.char_end + offset))
+            for e in message.edus]
+    return message._replace(edus=edus)
+
+
+class IncrementalSession(object):
+    """
+    Parsing state for a game that we receive a few soclog lines at a
+    time.
+
+    We keep the soclog conversion state (so that we only ever read new
+    lines, see `SoclogStream`), the segmented turns of the dialogue in
+    progress, and the final output (Settlers XML chat messages) of the
+    dialogues that are closed.
+
+    Each dialogue (or group of dialogues closed at once) is parsed as
+    a document of its own, with its Glozz identifiers and text offsets
+    continuing from where the previous one left off, so that the
+    combined output reads as if we had parsed the whole game at once.
+
+    :param lconf: parser to run the document stages with (we point it
+                  at our own scratch directories)
+    :type lconf: ResidentParser
+
+    :param tmp_dir: scratch directory for this session
+    """
+
+    def __init__(self, lconf, tmp_dir):
+        soclogtocsv = lconf.script("intake/soclogtocsv.py")
+        self.lconf = lconf
+        self.tmp_dir = tmp_dir
+        self.soclog = fp.join(tmp_dir, "soclog")
+        self.output_path = fp.join(tmp_dir, "output.settlers-xml")
+        self.stream = soclogtocsv.SoclogStream(sel_gen=SOCLOG_GENERATION)
+        self.pending = []
+        self.messages = []
+        self.id_start = 1000
+        self.text_offset = 0
+        self.chunks = 0
+        makedirs(tmp_dir)
+
+    def _parse(self, turns, close=False):
+        """
+        Parse some turns as a single document and return the chat
+        messages for it. If `close` is set, we are done with these
+        turns for good; the next document picks up after them.
+        """
+        if all(_is_server(t) for t in turns):
+            return []
+        lconf = self.lconf
+        lconf.reset(self.soclog,
+                    fp.join(self.tmp_dir, "dialogues-%04d" % self.chunks))
+        lconf.id_start = self.id_start
+        lconf.turns = turns
+        run_pipeline(lconf, DOCUMENT_STAGES)
+        messages = [_shift_message(m, self.text_offset)
+                    for m in read_chat_messages(lconf)]
+        if close:
+            self.id_start += lconf.id_count
+            # each document text starts with a space (that only the
+            # first one keeps in the whole game)
+            self.text_offset += lconf.text_length - 1
+            self.chunks += 1
+        return messages
+
+    def feed(self, text):
+        """
+        Extend the game with the soclog lines in the given (unicode)
+        text, and save the Settlers XML output for the whole game so
+        far; return the path to this output
+        """
+        lines = text.splitlines()
+        with codecs.open(self.soclog, 'a', 'utf-8') as fout:
+            for line in lines:
+                print(line, file=fout)
+        turns = self.stream.push_lines(lines)
+        self.pending.extend(segment_turns(self.lconf, turns))
+
+        closed, restart = closed_dialogues(self.pending)
+        if closed:
+            self.messages.extend(self._parse(self.pending[:closed],
+                                             close=True))
+            self.pending = self.pending[restart:]
+        current = self._parse(self.pending)
+
+        write_settlers_xml(self.lconf, self.messages + current,
+                           self.output_path)
+        return self.output_path
@@ -51,7 +51,7 @@ from .config.common import (ORACLE,
                             mk_post,
                             )
 
-from .ilp import (ILPDecoder, SCIP_BIN_DIR)
+from .ilp import (ILPDecoder, ILP_BACKEND, TIME_LIMIT)
 from .turn_constraint import (tc_decoder,
                               tc_learner)
 # PATHS
@@ -137,8 +137,56 @@ def decoder_mst():
     return Keyed('mst', MstDecoder(MstRootStrategy.fake_root, True))
 
 
+ILP_TOP_K = None
+"""
+Only let the ILP decoder consider this many of the best scoring
+attachments to each EDU (None for all of them)
+"""
+
+ILP_MIN_PROB = None
+"""
+Only let the ILP decoder consider attachments and labels scoring at
+least this (None for all of them)
+"""
+
+ILP_TIME_LIMIT = TIME_LIMIT
+"""
+Seconds the ILP decoder may spend on a dialogue before settling for
+the best solution it has (or the last baseline)
+"""
+
+SERVE_ILP_TOP_K = 5
+"like `ILP_TOP_K`, for the live server (see `serve_ilp_settings`)"
+
+SERVE_ILP_MIN_PROB = 0.01
+"like `ILP_MIN_PROB`, for the live server"
+
+SERVE_ILP_TIME_LIMIT = 10
+"like `ILP_TIME_LIMIT`, for the live server (players are waiting)"
+
+# the ILP decoders in our evaluations (see `serve_ilp_settings`)
+_ILP_DECODERS = []
+
+
 def decoder_ilp():
-    return Keyed('ilp', ILPDecoder())
+    "our instantiation of the ILP decoder"
+    decoder = ILPDecoder(top_k=ILP_TOP_K,
+                         min_prob=ILP_MIN_PROB,
+                         time_limit=ILP_TIME_LIMIT,
+                         warm_start='last')
+    _ILP_DECODERS.append(decoder)
+    return Keyed('ilp', decoder)
+
+
+def serve_ilp_settings():
+    """
+    Switch the ILP decoders of our evaluations over to the `SERVE_ILP_*`
+    settings (call this before loading the parsers for the server)
+    """
+    for decoder in _ILP_DECODERS:
+        decoder.top_k = SERVE_ILP_TOP_K
+        decoder.min_prob = SERVE_ILP_MIN_PROB
+        decoder.time_limit = SERVE_ILP_TIME_LIMIT
 
 
 def attach_learner_maxent():
@@ -236,14 +284,15 @@ def _core_parsers(klearner):
     ]
 
     # ILP decoders
-    if fp.isdir(SCIP_BIN_DIR):
+    if ILP_BACKEND is not None:
         bypass = [
             mk_bypass(klearner, decoder_ilp()),
             mk_bypass(klearner, tc_decoder(decoder_ilp())),
         ]
     else:
         # you need to install SCIP and provide the path to its
-        # binaries in SCIP_BIN_DIR in ilp.py
+        # binaries in SCIP_BIN_DIR in ilp.py (or have a scipy with
+        # scipy.optimize.milp)
         bypass = []
 
     if klearner.attach.payload.can_predict_proba:
@@ -413,9 +462,28 @@ DIALOGUE_ACT_LEARNER = Keyed('maxent', LogisticRegression())
 Classifier to use for dialogue acts
 """
 
+SOCLOG_GENERATION = 1
+"""
+Generation of soclog events to read in the resident parser
+(see `intake/soclogtocsv.py`); our models are trained on first
+generation (chat and basic server) turns
+"""
+
 TAGGER_JAR = 'lib/ark-tweet-nlp-0.3.2.jar'
 "POS tagger jar file"
 
+TAGGER_CACHE = fp.join(LOCAL_TMP, 'tagger-cache.sqlite')
+"""
+Database of part of speech tags for individual turns, which we reuse
+across documents and runs (set to None to always run the tagger)
+"""
+
+TAGGER_CACHE_SIZE = 128 * 1024 ** 2
+"""
+Size (bytes) beyond which we evict the least recently used tags from
+the tagger cache
+"""
+
 
 CORENLP_DIR = 'lib/stanford-corenlp-full-2013-06-20'
 "CoreNLP directory"
@@ -428,6 +496,46 @@ CORENLP_SERVER_DIR = "lib/corenlp-server"
 CORENLP_ADDRESS = "tcp://localhost:5900"
 "0mq address to server"
 
+CORENLP_ADDRESSES = [CORENLP_ADDRESS]
+"""
+0mq addresses of the servers to spread sentence parsing over (we
+launch a server at each one where nobody is listening yet, see
+`stac.harness.corenlp.ServerPool`)
+"""
+
+CORENLP_CACHE = fp.join(LOCAL_TMP, 'corenlp-cache.sqlite')
+"""
+Database of sentence parses for individual turns, which we reuse
+across documents and runs (set to None to always ask the server)
+"""
+
+CORENLP_CACHE_SIZE = 512 * 1024 ** 2
+"""
+Size (bytes) beyond which we evict the least recently used parses
+from the corenlp cache
+"""
+
+STAGE_CACHE_DIR = fp.join(LOCAL_TMP, 'stage-cache')
+"""
+Where the standalone parser keeps the outputs of its pipeline stages,
+so that it can skip them for inputs it has seen before (set to None
+to always run every stage)
+"""
+
+STAGE_CACHE_SIZE = 2 * 1024 ** 3
+"""
+Size (bytes) beyond which we evict the least recently used entries
+of the stage cache
+"""
+
+DECODE_JOBS = -1
+"""
+Number of dialogues the standalone parser (parse, serve) decodes at
+once (-1 for one per CPU; 1 to decode them one after the other).
+Parsers that run in worker processes (batch parse, server with
+`--workers`) always decode one dialogue at a time
+"""
+
 # -------------------------------------------------------------------------------
 # nothing to edit below :-)
 # -------------------------------------------------------------------------------
@@ -5,26 +5,31 @@
 Support for parser pipeline
 """
 
+from __future__ import print_function
 from collections import namedtuple
 from os import path as fp
+import imp
 import os
 import re
 import sys
 
-from joblib import Parallel
-
 from attelo.harness import (RuntimeConfig)
 from attelo.harness.interface import (HarnessException)
 from attelo.harness.util import call, makedirs
 from attelo.io import (Torpor, load_multipack)
-import attelo.harness.parse as ath_parse
 
+from .cache import (StageCache, stamp_paths)
+from .decoding import (decode_multipack, stop_pool)
 from .harness import (IritHarness)
-from .local import (EVALUATIONS,
+from .local import (CORENLP_SERVER_DIR,
+                    DECODE_JOBS,
+                    EVALUATIONS,
                     SNAPSHOTS,
+                    STAGE_CACHE_DIR,
+                    STAGE_CACHE_SIZE,
+                    LEX_DIR,
                     TEST_EVALUATION_KEY,
                     TAGGER_JAR)
-from .util import (concat_i)
 
 # pylint: disable=too-few-public-methods
 
@@ -36,8 +41,7 @@ class StandaloneParser(IritHarness):
     """
 
     def __init__(self, soclog, tmp_dir):
-        self.soclog = soclog
-        self.tmp_dir = fp.abspath(tmp_dir)
+        self.reset(soclog, tmp_dir)
         harness_dir = fp.dirname(fp.dirname(fp.abspath(__file__)))
         self.root_dir = fp.dirname(harness_dir)
         self.snap_dir = fp.abspath(latest_snap())
@@ -45,6 +49,35 @@ class StandaloneParser(IritHarness):
         super(StandaloneParser, self).load(RuntimeConfig.empty(),
                                            self.snap_dir,
                                            self.snap_dir)
+        if STAGE_CACHE_DIR is None:
+            self.stage_cache = None
+        else:
+            # the stage outputs depend on the models in the snapshot
+            # (eg. retrained in place) and on the tools we run
+            identity = stamp_paths([self.snap_dir,
+                                    self.abspath(TAGGER_JAR),
+                                    self.abspath(CORENLP_SERVER_DIR)])
+            self.stage_cache = StageCache(self.abspath(STAGE_CACHE_DIR),
+                                          STAGE_CACHE_SIZE,
+                                          identity)
+
+    def reset(self, soclog, tmp_dir):
+        """
+        Point the parser at a new input file and temporary directory
+        (so that we can parse several inputs with the same parser)
+        """
+        self._set_input(soclog, tmp_dir)
+        # we reload the models for each input, and the decoding workers
+        # (if any) would only have the ones they were forked with
+        stop_pool()
+
+    def _set_input(self, soclog, tmp_dir):
+        "point at a new input file and temporary directory"
+        self.soclog = soclog
+        self.tmp_dir = fp.abspath(tmp_dir)
+        # unannotated minicorpus, if we have it in memory
+        # (see `stac.harness.documents`)
+        self.corpus = None
 
     @property
     def test_evaluation(self):
@@ -78,17 +111,40 @@ class StandaloneParser(IritHarness):
         cmd = ["python", abs_script] + list(args)
         call(cmd, **kwargs)
 
+    def script(self, relpath):
+        """
+        Import one of our scripts (path relative to the STAC root dir)
+        as a module, so that we can call its functions directly.
+        Each script is only loaded once.
+        """
+        name = '_stac_' + re.sub(r'\W', '_', fp.splitext(relpath)[0])
+        if name not in sys.modules:
+            imp.load_source(name, self.abspath(relpath))
+        return sys.modules[name]
+
 
 class Stage(namedtuple('Stage',
                        ['logname',
                         'function',
-                        'description'])):
+                        'description',
+                        'inputs',
+                        'outputs'])):
     """
     Individual pipeline stage
 
+    Stages that declare the files (or directories) they read and
+    write can be skipped if we have already seen their inputs (see
+    `stac.harness.cache`). Stages that communicate through anything
+    else than those files should not declare them.
+
     :type function: `(LoopConfig, FilePath) -> IO ()`
+    :type inputs: `LoopConfig -> [FilePath]`
+    :type outputs: `LoopConfig -> [FilePath]`
     """
-    pass
+    def __new__(cls, logname, function, description,
+                inputs=None, outputs=None):
+        return super(Stage, cls).__new__(cls, logname, function,
+                                         description, inputs, outputs)
 
 
 def stac_msg(msg, **kwargs):
@@ -105,15 +161,28 @@ def run_pipeline(lconf, stages):
     They don't feed into each other (yet); communication between stages is
     based on assumed side effects (ie. writing into files at conventional
     locations).
+
+    If the configuration has a stage cache, stages whose inputs we have
+    already seen are skipped (their outputs are copied from the cache)
     """
     logdir = lconf.tmp("logs")
     makedirs(logdir)
+    cache = lconf.stage_cache
     for stage in stages:
         msg = stage.description
         logpath = fp.join(logdir, stage.logname + ".txt")
+        key = cache.key(lconf, stage) if cache is not None else None
+        cached = key is not None and cache.fetch(lconf, stage, key)
+        if cached and msg is not None:
+            msg += " (cached)"
         with stac_msg(msg or "", quiet=msg is None):
             with open(logpath, 'w') as log:
-                stage.function(lconf, log)
+                if cached:
+                    print("outputs copied from cache entry", key, file=log)
+                else:
+                    stage.function(lconf, log)
+        if key is not None and not cached:
+            cache.store(lconf, stage, key)
 
 # ---------------------------------------------------------------------
 # pipeline paths
@@ -202,6 +271,21 @@ def unannotated_stub_path(lconf):
                    stub_name(lconf) + "_0")
 
 
+def pos_tagged_path(lconf):
+    "path to the part of speech tagger output"
+    return minicorpus_stage_path(lconf, "pos-tagged")
+
+
+def parsed_path(lconf):
+    "path to the sentence parser output"
+    return minicorpus_stage_path(lconf, "parsed")
+
+
+def units_path(lconf):
+    "path to the unit-level (dialogue act) annotations"
+    return minicorpus_stage_path(lconf, "units")
+
+
 def resource_np_path(lconf):
     """
     path to temporary minicorpus dir mimicking structure
@@ -210,6 +294,23 @@ def resource_np_path(lconf):
     return lconf.tmp('resource-nps.conll')
 
 
+def features_paths(lconf):
+    """
+    paths to the features we decode from
+    (edu inputs, pairings, features)
+    """
+    fpath = minicorpus_path(lconf) + '.relations.sparse'
+    return [fpath + '.edu_input', fpath + '.pairings', fpath]
+
+
+def annotation_inputs(lconf):
+    """
+    what unit annotation and feature extraction read: the minicorpus
+    document (so far) and the lexicons
+    """
+    return [minicorpus_doc_path(lconf), lconf.abspath(LEX_DIR)]
+
+
 def parsed_bname(lconf, econf):
     """
     short name for virtual author consisting of dataset used to
@@ -233,39 +334,54 @@ def attelo_result_path(lconf, econf):
     return result_path(lconf, econf)
 
 
+def xml_output_path(lconf):
+    "final output of the server"
+    return attelo_result_path(lconf, lconf.test_evaluation) + ".settlers-xml"
+
+
 # ---------------------------------------------------------------------
 # decoding
 # ---------------------------------------------------------------------
 
 
-def _get_decoding_jobs(mpack, lconf, econf):
+def load_parser(lconf, econf):
     """
-    Run the decoder on a single config and convert the output
+    Return the parser for a config, with its models loaded from the
+    snapshot (we assume everything is cached)
     """
-    makedirs(lconf.tmp("parsed"))
-    output_path = attelo_result_path(lconf, econf)
     cache = lconf.model_paths(econf.learner,
-                              None)
+                              None,
+                              econf.parser)
     parser = econf.parser.payload
-    parser.fit([], [], cache=cache)  # we assume everything is cached
-    return ath_parse.jobs(mpack, parser, output_path)
+    parser.fit([], [], cache=cache)
+    return parser
 
 
-def decode(lconf, evaluations):
-    "Decode the input using all the model/learner combos we know"
+def decode(lconf, evaluations, parsers=None):
+    """
+    Decode the input using all the model/learner combos we know,
+    spreading the dialogues over `DECODE_JOBS` processes (see
+    `stac.harness.decoding`)
 
-    fpath = minicorpus_path(lconf) + '.relations.sparse'
+    If `parsers` (dict from evaluation key to parser) is supplied, we
+    use those parsers as they are instead of loading their models
+    """
+    parsers = parsers or {}
+    edu_input_path, pairings_path, features_path = features_paths(lconf)
     vocab_path = lconf.mpack_paths(test_data=False)[3]
-    mpack = load_multipack(fpath + '.edu_input',
-                           fpath + '.pairings',
-                           fpath,
+    mpack = load_multipack(edu_input_path,
+                           pairings_path,
+                           features_path,
                            vocab_path)
-    decoder_jobs = concat_i(_get_decoding_jobs(mpack, lconf, econf)
-                            for econf in evaluations)
-    Parallel(n_jobs=lconf.runcfg.n_jobs, verbose=True)(decoder_jobs)
-    for econf in evaluations:
-        output_path = attelo_result_path(lconf, econf)
-        ath_parse.concatenate_outputs(mpack, output_path)
+    # ILP decoding takes the longest by far, so we start on those
+    # dialogues first rather than have them trail behind the rest
+    ordered = sorted(evaluations, key=lambda e: 'ilp' not in e.parser.key)
+    loaded = [parsers[e.key] if e.key in parsers else load_parser(lconf, e)
+              for e in ordered]
+    makedirs(lconf.tmp("parsed"))
+    decode_multipack(mpack, loaded,
+                     [attelo_result_path(lconf, e) for e in ordered],
+                     n_jobs=DECODE_JOBS)
 
 
 # ---------------------------------------------------------------------
@@ -0,0 +1,339 @@
+# License: CeCILL-B (French BSD3-like)
+
+"""
+In-process variant of the parsing pipeline
+
+The standalone parser runs most of its stages as separate scripts
+(`StandaloneParser.pyt`), so each stage pays for a fresh interpreter,
+for re-importing educe/attelo/sklearn, and for reloading the tokenizer
+and models. The resident parser loads all of these once and runs every
+stage as a plain function call, which makes it suitable for the server.
+"""
+
+from __future__ import print_function
+import argparse
+
+from educe.stac.learning.cmd import SUBCOMMANDS as LEARNING_SUBCOMMANDS
+from educe.stac.util import prettifyxml
+import educe.stac
+
+from .corenlp import ServerConfig
+from .decoding import start_pool
+from .local import (CORENLP_SERVER_DIR, CORENLP_ADDRESSES,
+                    CORENLP_CACHE, CORENLP_CACHE_SIZE,
+                    DECODE_JOBS,
+                    DIALOGUE_ACT_LEARNER,
+                    LEX_DIR,
+                    TAGGER_CACHE, TAGGER_CACHE_SIZE,
+                    TAGGER_JAR)
+from .documents import (build_document,
+                        read_turns,
+                        save_glozz,
+                        segment_turns,
+                        unannotated_corpus)
+from .pipeline import (StandaloneParser,
+                       Stage,
+                       annotation_inputs,
+                       attelo_result_path,
+                       dact_features_path,
+                       dact_model_path,
+                       decode,
+                       features_paths,
+                       load_parser,
+                       minicorpus_path,
+                       parsed_path,
+                       pos_tagged_path,
+                       resource_np_path,
+                       unannotated_dir_path,
+                       units_path,
+                       xml_output_path)
+from . import corenlp
+from . import tagger
+import stac.unit_annotations as stac_unit
+
+# pylint: disable=too-many-instance-attributes
+
+
+class ResidentParser(StandaloneParser):
+    """
+    A standalone parser that holds on to its models (dialogue acts and
+    the test evaluation), feature vocabulary, tokenizer and helper
+    scripts, so that it can be pointed at new inputs (see `reset`)
+    without reloading anything.
+
+    Stages also share in-memory intermediary results through this
+    object (see `RESIDENT_STAGES`)
+
+    :param fork_decoders: start the decoding workers right away (see
+                          `stac.harness.decoding.start_pool`), before the
+                          tagger, so that they don't inherit it; for the
+                          server, which keeps them from one input to the
+                          next
+    """
+
+    def __init__(self, soclog, tmp_dir, fork_decoders=False):
+        super(ResidentParser, self).__init__(soclog, tmp_dir)
+        d_features_path = dact_features_path(self)
+        self.dact_model, self.dact_vocab, self.dact_labels =\
+            stac_unit.load_model(dact_model_path(self, DIALOGUE_ACT_LEARNER),
+                                 d_features_path + '.vocab',
+                                 d_features_path)
+        self.parsers = {}
+        if self.test_evaluation is not None:
+            econf = self.test_evaluation
+            self.parsers[econf.key] = load_parser(self, econf)
+        if fork_decoders:
+            start_pool(list(self.parsers.values()), DECODE_JOBS)
+        # warm up the scripts we call (the segmenter loads the NLTK
+        # sentence tokenizer on import), and the tagger JVM
+        for script in _SCRIPTS:
+            self.script(script)
+        tagger.get_tagger(self.abspath(TAGGER_JAR)).start()
+        self.reset(soclog, tmp_dir)
+
+    def reset(self, soclog, tmp_dir):
+        """
+        Point the parser at a new input file and temporary directory,
+        forgetting any intermediary results from the previous one
+
+        Attributes set by the stages: `turns` (segmented turns),
+        `corpus` (unannotated minicorpus), `id_count` and `text_length`
+        (number of Glozz identifiers used and length of the document
+        text, counting from `id_start`)
+        """
+        # unlike the standalone parser, we keep our models (and the
+        # decoding workers that have them)
+        self._set_input(soclog, tmp_dir)
+        self.turns = None
+        self.id_start = 1000
+        self.id_count = 0
+        self.text_length = 0
+
+
+_SCRIPTS = ["intake/soclogtocsv.py",
+            "segmentation/segmentation.py",
+            "intake/csvtoglozz.py",
+            "parser/to_settlers_xml"]
+"scripts the resident pipeline calls into"
+
+
+def learning_command(name, argv):
+    """
+    Run one of the `stac-learning` subcommands in-process, as if it
+    had been called with the given command line arguments
+    """
+    modules = [m for m in LEARNING_SUBCOMMANDS if m.NAME == name]
+    if not modules:
+        raise ValueError("Unknown stac-learning subcommand: " + name)
+    psr = argparse.ArgumentParser(prog="stac-learning " + name)
+    modules[0].config_argparser(psr)
+    modules[0].main(psr.parse_args(argv))
+
+
+def tag_cache(lconf):
+    """
+    The part of speech tag cache (None if we don't have one)
+    """
+    if TAGGER_CACHE is None:
+        return None
+    return tagger.get_tag_cache(lconf.abspath(TAGGER_CACHE),
+                                TAGGER_CACHE_SIZE,
+                                lconf.abspath(TAGGER_JAR))
+
+
+# ---------------------------------------------------------------------
+# pipeline stages
+# ---------------------------------------------------------------------
+
+
+def read_chat_messages(lconf):
+    """
+    Settlers XML chat messages for the unit-annotated minicorpus and
+    the output of the test evaluation decoder
+    """
+    to_settlers_xml = lconf.script("parser/to_settlers_xml")
+    reader = educe.stac.Reader(minicorpus_path(lconf))
+    anno_files = reader.filter(reader.files(),
+                               lambda k: k.stage == 'units')
+    corpus = reader.slurp(anno_files)
+    with open(attelo_result_path(lconf, lconf.test_evaluation),
+              'rb') as fin:
+        predictions = list(to_settlers_xml.read_tsv(fin))
+    return to_settlers_xml.chat_messages(corpus, predictions)
+
+
+def write_settlers_xml(lconf, messages, output_path):
+    """
+    Save chat messages as a Settlers XML game fragment
+    """
+    to_settlers_xml = lconf.script("parser/to_settlers_xml")
+    with open(output_path, 'wb') as fout:
+        print(prettifyxml.prettify(to_settlers_xml.to_xml(messages),
+                                   indent=" "),
+              file=fout)
+
+
+def _soclog_to_turns(lconf, _):
+    """
+    Read the turns from the soclog file
+    """
+    lconf.turns = read_turns(lconf)
+
+
+def _segment_into_edus(lconf, _):
+    """
+    Segment the turn texts
+    """
+    lconf.turns = segment_turns(lconf, lconf.turns)
+
+
+def _turns_to_glozz(lconf, _):
+    """
+    Convert the segmented turns to an unannotated document (Glozz
+    identifiers start from `lconf.id_start`), which the tagger and
+    sentence parser read from memory
+
+    We still save it in the minicorpus, because unit annotation and
+    feature extraction read their corpus from there (as does the
+    stage cache)
+    """
+    output = build_document(lconf, lconf.turns, id_start=lconf.id_start)
+    save_glozz(lconf, output)
+    lconf.id_count = output.id_count
+    lconf.text_length = len(output.text)
+    lconf.corpus = {output.key: output.doc}
+
+
+def _postag(lconf, _):
+    """
+    Run part of speech tagger on input (with the tagger process we
+    keep running)
+    """
+    tagger.run_tagger(unannotated_corpus(lconf),
+                      minicorpus_path(lconf),
+                      lconf.abspath(TAGGER_JAR),
+                      cache=tag_cache(lconf))
+
+
+def _sentence_parse(lconf, log):
+    """
+    Run sentence parser on input.
+    """
+    config = ServerConfig(address=CORENLP_ADDRESSES,
+                          directory=lconf.abspath(CORENLP_SERVER_DIR),
+                          output=log)
+    if CORENLP_CACHE is None:
+        cache = None
+    else:
+        cache = corenlp.get_parse_cache(lconf.abspath(CORENLP_CACHE),
+                                        CORENLP_CACHE_SIZE)
+    corenlp.run_pipeline(unannotated_corpus(lconf),
+                         minicorpus_path(lconf),
+                         config,
+                         cache=cache)
+
+
+def _unit_annotations(lconf, _):
+    """
+    Guess dialogue acts and addressees for all the EDUs
+    (with the preloaded model)
+    """
+    corpus_dir = minicorpus_path(lconf)
+    inputs = stac_unit.read_inputs(corpus_dir, lconf.abspath(LEX_DIR))
+    stac_unit.annotate_edus(lconf.dact_model,
+                            lconf.dact_vocab,
+                            lconf.dact_labels,
+                            inputs)
+    stac_unit.save_annotations(inputs, corpus_dir)
+
+
+def _resource_extraction(lconf, _):
+    """
+    Extract resource NPs
+    """
+    learning_command("resource-nps",
+                     [minicorpus_path(lconf),
+                      lconf.abspath(LEX_DIR),
+                      "--output", resource_np_path(lconf)])
+
+
+def _feature_extraction(lconf, _):
+    """
+    Extract features from our input glozz file
+    """
+    vocab_path = lconf.mpack_paths(test_data=False)[3]
+    learning_command("extract",
+                     ["--parsing",
+                      "--vocab", vocab_path,
+                      minicorpus_path(lconf),
+                      lconf.abspath(LEX_DIR),
+                      lconf.tmp_dir])
+
+
+def _decode(lconf, _):
+    """
+    Decode with the preloaded parsers (just the test evaluation,
+    unless we were given more, see `stac.harness.cmd.parse`)
+    """
+    decode(lconf,
+           [e for e in lconf.evaluations if e.key in lconf.parsers],
+           parsers=lconf.parsers)
+
+
+def _to_xml(lconf, _):
+    """
+    Convert to Settlers XML format
+    """
+    write_settlers_xml(lconf, read_chat_messages(lconf),
+                       xml_output_path(lconf))
+
+
+TURN_STAGES = \
+    [Stage("0100-extract_annot", _soclog_to_turns,
+           "Converting (soclog -> turns)"),
+     Stage("0150-segmentation", _segment_into_edus,
+           "Segmenting")]
+"""
+Stages from the soclog to segmented turns (`lconf.turns`)
+"""
+
+DOCUMENT_STAGES = \
+    [Stage("0200-csvtoglozz", _turns_to_glozz,
+           "Converting (turns -> glozz)"),
+     Stage("0300-pos-tagging", _postag,
+           "POS tagging",
+           inputs=lambda l: [unannotated_dir_path(l)],
+           outputs=lambda l: [pos_tagged_path(l)]),
+     Stage("0400-parsing", _sentence_parse,
+           "Sentence parsing (if slow, is starting parser server)",
+           inputs=lambda l: [unannotated_dir_path(l)],
+           outputs=lambda l: [parsed_path(l)]),
+     Stage("0500-unit-annotations", _unit_annotations,
+           "Unit-level annotation (dialogue acts, addressees)",
+           inputs=annotation_inputs,
+           outputs=lambda l: [units_path(l)]),
+     Stage("0550-resource", _resource_extraction,
+           "Resource extraction",
+           inputs=annotation_inputs,
+           outputs=lambda l: [resource_np_path(l)]),
+     Stage("0600-features", _feature_extraction,
+           "Feature extraction",
+           inputs=lambda l: annotation_inputs(l) + [resource_np_path(l)],
+           outputs=features_paths),
+     Stage("0700-decoding", _decode,
+           "Decoding")]
+"""
+Stages from segmented turns (`lconf.turns`) to decoder output
+
+The turns are only read by the first stage; the ones that follow
+communicate through files, so they are skipped for documents we have
+already parsed (see `stac.harness.cache`)
+"""
+
+RESIDENT_STAGES = TURN_STAGES + DOCUMENT_STAGES +\
+    [Stage("0800-xml", _to_xml,
+           "Converting (-> settlers xml)")]
+"""
+Server pipeline (soclog to Settlers XML), with every stage running
+in-process on a `ResidentParser`
+"""
@@ -0,0 +1,186 @@
+# License: CeCILL-B (French BSD3-like)
+
+"""
+Part of speech tagging with a long-lived ark-tweet-nlp process
+
+`educe.stac.postag.run_tagger` launches the tagger (and so a fresh
+JVM) for every document it tags. Here we keep the tagger running and
+feed it turns over a pipe, as many at a time as we have, and we only
+ever tag a given turn text once (see `TagCache`).
+
+The output files are the same as educe's, so they can be read back
+with the usual educe functions.
+"""
+
+from __future__ import print_function
+from os import path as fp
+import codecs
+import os
+import subprocess
+import threading
+
+from educe.stac.postag import extract_turns, tagger_file_name
+
+from attelo.harness.util import makedirs
+
+from .cache import TextCache
+
+# pylint: disable=too-few-public-methods
+
+
+def tagger_command(jar):
+    """
+    Command line for a tagger reading one text per line from its
+    standard input, and writing CoNLL output
+    """
+    return ["java", "-XX:ParallelGCThreads=2", "-Xmx500m",
+            "-jar", jar,
+            "--input-format", "text",
+            "--output-format", "conll"]
+
+
+class TaggerError(Exception):
+    """
+    The tagger died on us
+    """
+    pass
+
+
+class Tagger(object):
+    """
+    A tagger process that we keep running for as long as we need it
+    (relaunched if it dies)
+    """
+
+    def __init__(self, jar):
+        self.jar = jar
+        self.process = None
+
+    def start(self):
+        "launch the tagger if it is not running already"
+        if self.process is None or self.process.poll() is not None:
+            self.process = subprocess.Popen(tagger_command(self.jar),
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+
+    def _read_block(self):
+        """
+        Read the tagger output for one text: CoNLL lines up to (and
+        including) the blank line that ends them
+        """
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise TaggerError("ark-tweet-nlp exited with code {}".format(
+                    self.process.wait()))
+            line = line.decode('utf-8')
+            lines.append(line)
+            if not line.strip():
+                return "".join(lines)
+
+    def tag_many(self, texts):
+        """
+        Tag each of the given (one line, non blank) texts and return the
+        CoNLL output for each one ::
+
+            [unicode] -> [unicode]
+        """
+        if not texts:
+            return []
+        self.start()
+        stdin = self.process.stdin
+
+        def feed():
+            "write the texts (while we read the output)"
+            try:
+                for text in texts:
+                    stdin.write((text + "\n").encode('utf-8'))
+                stdin.flush()
+            except IOError:
+                pass  # the tagger died; the reader will say so
+
+        writer = threading.Thread(target=feed)
+        writer.daemon = True
+        writer.start()
+        try:
+            return [self._read_block() for _ in texts]
+        except TaggerError:
+            self.process = None
+            raise
+        finally:
+            writer.join()
+
+    def close(self):
+        "stop the tagger process"
+        if self.process is not None and self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+
+class TagCache(TextCache):
+    """
+    Persistent cache of tagger output (CoNLL) for turn texts, keyed by
+    the text (stripped of surrounding whitespace) and the tagger jar
+    """
+
+    def __init__(self, path, max_size, jar):
+        super(TagCache, self).__init__(path, max_size,
+                                       " ".join(tagger_command(jar)))
+
+
+_TAGGERS = {}
+_TAG_CACHES = {}
+
+
+def get_tagger(jar):
+    """
+    Tagger process for a jar file (one per process, launched when we
+    first need it; a forked process does not share its parent's)
+    """
+    key = os.getpid(), jar
+    if key not in _TAGGERS:
+        _TAGGERS[key] = Tagger(jar)
+    return _TAGGERS[key]
+
+
+def get_tag_cache(path, max_size, jar):
+    """
+    Tag cache at the given path (opened once per process)
+    """
+    if path not in _TAG_CACHES:
+        _TAG_CACHES[path] = TagCache(path, max_size, jar)
+    return _TAG_CACHES[path]
+
+
+def run_tagger(corpus, outdir, jar, cache=None):
+    """
+    Run the tagger on all the (unannotated) documents in the corpus and
+    save the results in the specified directory (a drop-in replacement
+    for `educe.stac.postag.run_tagger`)
+
+    The turns of all the documents are tagged together, each distinct
+    turn text once, and only if it is not already in the cache
+    """
+    doc_lines = {k: extract_turns(corpus[k]).split("\n") for k in corpus}
+    wanted = set(l.strip() for lines in doc_lines.values() for l in lines)
+    wanted.discard("")
+    tags = {}
+    if cache is not None:
+        tags.update((t, v.decode('utf-8'))
+                    for t, v in cache.get_many(wanted).items())
+    misses = sorted(wanted - set(tags))
+    if misses:
+        new_tags = dict(zip(misses, get_tagger(jar).tag_many(misses)))
+        if cache is not None:
+            cache.put_many({t: v.encode('utf-8')
+                            for t, v in new_tags.items()})
+        tags.update(new_tags)
+
+    for k, lines in doc_lines.items():
+        tagged_file = tagger_file_name(k, outdir)
+        makedirs(fp.dirname(tagged_file))
+        with codecs.open(tagged_file, 'w', 'utf-8') as fout:
+            for line in lines:
+                fout.write(tags.get(line.strip(), "\n"))
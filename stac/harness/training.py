@@ -0,0 +1,168 @@
+# License: CeCILL-B (French BSD3-like)
+
+"""
+Learning the models for all the evaluation configs, each model once
+
+Most of our evaluation configs differ only in their decoders and
+share their attach/label learners. The model files are named after
+the learner, the task, the fold and (for the inter-sentential models)
+the edges we train on (see `IritHarness.model_paths`), so two configs
+that would write the same file need the same fit. We plan the
+training around those files: each one is fitted by exactly one job,
+and configs that only need files fitted elsewhere are left out (when
+attelo gets around to them, it just loads the models).
+
+Jobs run in parallel, biggest first. The data config (with its
+multipack) is handed to the worker processes by forking, so that it
+is not copied over pickles.
+"""
+
+from __future__ import print_function
+from collections import namedtuple
+from os import path as fp
+import multiprocessing
+
+from attelo.harness.parse import (learn)
+from attelo.harness.util import (makedirs)
+from attelo.parser.intra import (IntraInterPair)
+
+# pylint: disable=too-few-public-methods
+
+LEARNER_COSTS = {
+    'oracle': 0,
+    'maxent': 1,
+    'perc': 2,
+    'pa': 2,
+    'dectree': 4,
+    'rndforest': 8,
+}
+"""
+Rough relative cost of fitting a model with each kind of learner
+(looked up by the dash separated parts of the learner key; 1 if none
+match)
+"""
+
+
+class TrainingJob(namedtuple('TrainingJob', 'cost task args')):
+    """
+    Something to learn: `task(hconf, dconf, *args)` where `task` is a
+    module level function (so that it can be sent to the workers)
+    and `cost` says how long we expect it to take (no unit in
+    particular; only good for comparing jobs)
+    """
+    pass
+
+
+# harness and data config for the worker processes of run_jobs
+# (set before we fork, so that they don't need to be pickled)
+_TRAINING = None
+
+
+def learner_cost(klearner):
+    "estimated cost of fitting a (keyed) learner"
+    parts = klearner.key.split('-')
+    costs = [LEARNER_COSTS[p] for p in parts if p in LEARNER_COSTS]
+    return max(costs) if costs else 1
+
+
+def model_learners(hconf, econf, fold):
+    """
+    The model files an evaluation config needs for the given fold
+    (None for the combined models), and the (keyed) learner that fits
+    each one ::
+
+        (Harness, EvaluationConfig, Fold) -> Dict(FilePath, Keyed)
+    """
+    res = {}
+    paths = hconf.model_paths(econf.learner, fold, econf.parser)
+    for name, path in paths.items():
+        if isinstance(econf.learner, IntraInterPair):
+            part, task = name.split(':')
+            rconf = getattr(econf.learner, part)
+        else:
+            task = name
+            rconf = econf.learner
+        res[path] = rconf.attach if task == 'attach' else rconf.label
+    return res
+
+
+def learn_evaluations(hconf, dconf, fold, indices):
+    """
+    Learn the models for some of the evaluation configs (by index in
+    `hconf.evaluations`), in order
+    """
+    makedirs(hconf.fold_dir_path(fold) if fold is not None
+             else hconf.combined_dir_path())
+    for i in indices:
+        learn(hconf, hconf.evaluations[i], dconf, fold)
+
+
+def training_plan(hconf, fold):
+    """
+    Jobs that fit each model file the evaluations need for a fold
+    exactly once (files that already exist don't count).
+
+    A config that shares some files with another one goes in the same
+    job (after it), so that it loads them rather than fitting them
+    again (and we never have two processes writing the same file).
+    A config that has nothing new to fit is left out.
+
+    :rtype: [TrainingJob]
+    """
+    owner = {}  # model file to group
+    groups = []  # lists of evaluation indices
+    costs = []
+    for i, econf in enumerate(hconf.evaluations):
+        learners = model_learners(hconf, econf, fold)
+        wanted = [p for p in learners if not fp.exists(p)]
+        fresh = [p for p in wanted if p not in owner]
+        if not fresh:
+            continue
+        group = []
+        cost = 0
+        for old in sorted(set(owner[p] for p in wanted if p in owner)):
+            group.extend(groups[old])
+            cost += costs[old]
+            groups[old] = []
+            costs[old] = 0
+        group.append(i)
+        groups.append(group)
+        costs.append(cost + sum(learner_cost(learners[p]) for p in fresh))
+        for j in group:
+            for path in model_learners(hconf, hconf.evaluations[j], fold):
+                if path in owner or path in fresh:
+                    owner[path] = len(groups) - 1
+    return [TrainingJob(cost=cost,
+                        task=learn_evaluations,
+                        args=(fold, group))
+            for cost, group in zip(costs, groups) if group]
+
+
+def _run_job(job):
+    "run a job with the harness and data config from `_TRAINING`"
+    hconf, dconf = _TRAINING
+    job.task(hconf, dconf, *job.args)
+
+
+def run_jobs(hconf, dconf, jobs, n_jobs):
+    """
+    Run training jobs, most expensive first, over as many processes
+    as `n_jobs` says (-1 for one per CPU; 0 or 1 for sequential)
+    """
+    global _TRAINING  # pylint: disable=global-statement
+    jobs = sorted(jobs, key=lambda j: j.cost, reverse=True)
+    _TRAINING = hconf, dconf
+    try:
+        if n_jobs in [0, 1]:
+            for job in jobs:
+                _run_job(job)
+        else:
+            pool = multiprocessing.Pool(None if n_jobs < 1 else n_jobs)
+            try:
+                for _ in pool.imap_unordered(_run_job, jobs):
+                    pass
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _TRAINING = None
@@ -9,7 +9,10 @@ We rely on there being a feature 'same_speaker'
 '''
 # pylint: disable=too-few-public-methods
 
+import weakref
+
 import numpy as np
+import scipy.sparse
 
 from attelo.harness.config import (Keyed)
 from attelo.parser import (Parser)
@@ -19,22 +22,62 @@ SAME_SPEAKER = 'same_speaker=True'
 'boolean feature for if two EDUs share a speaker'
 
 
+# indices of the turn constraint safe edges of the datapacks we have
+# seen, by datapack id (along with a weak reference to the datapack,
+# which takes the entry with it when it goes)
+_TC_SAFE = {}
+
+
+def _same_speaker(dpack):
+    """
+    Boolean array telling if the EDUs of each pair share a speaker
+    """
+    column = dpack.data[:, dpack.vocab.index(SAME_SPEAKER)]
+    if scipy.sparse.issparse(column):
+        column = column.toarray()
+    return np.asarray(column).ravel() != 0
+
+
+def _forwards(dpack):
+    """
+    Boolean array telling if each pair points forwards (ie. if the span
+    of its second EDU comes after that of the first one)
+    """
+    spans = np.array([edu1.span() + edu2.span()
+                      for edu1, edu2 in dpack.pairings],
+                     dtype=np.int64).reshape(-1, 4)
+    start1, end1, start2, end2 = spans.T
+    return (start2 > start1) | ((start2 == start1) & (end2 > end1))
+
+
 def turn_constraint_safe(dpack):
     """Get the indices of edges that respect the turn constraint.
 
+    The result is computed once per datapack (and shared by all
+    callers, so please don't modify it).
+
     Parameters
     ----------
     dpack: DataPack
         DataPack that contains the edges.
     Returns
     -------
-    res: list of int
+    res: array of int
         Indices of selected edges.
     """
-    spkr_idx = dpack.vocab.index(SAME_SPEAKER)
-    return [i for i, (edu1, edu2) in enumerate(dpack.pairings)
-            if edu2.span() > edu1.span() or
-            dpack.data[i, spkr_idx]]
+    key = id(dpack)
+    if key in _TC_SAFE:
+        ref, idxes = _TC_SAFE[key]
+        if ref() is dpack:
+            return idxes
+    idxes = np.flatnonzero(_forwards(dpack) | _same_speaker(dpack))
+    idxes.setflags(write=False)
+    try:
+        ref = weakref.ref(dpack, lambda _: _TC_SAFE.pop(key, None))
+    except TypeError:
+        return idxes  # can't tell when it goes, so don't keep it
+    _TC_SAFE[key] = ref, idxes
+    return idxes
 
 
 def apply_turn_constraint(dpack, target):
@@ -10,11 +10,21 @@ Learn and predict dialogue acts from EDU feature vectors
 from os import path as fp
 import argparse
 import copy
+import multiprocessing
 import os
+import shutil
+import tempfile
 
 import joblib
-from scipy.sparse import lil_matrix
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
 from sklearn.datasets import load_svmlight_file
+from sklearn.linear_model import (LogisticRegression,
+                                  PassiveAggressiveClassifier,
+                                  Perceptron,
+                                  RidgeClassifier,
+                                  SGDClassifier)
+from sklearn.svm import LinearSVC
 from attelo.io import (load_labels,
                        load_vocab)
 
@@ -44,6 +54,115 @@ def learn_and_save(learner, feature_path, output_path):
     if not fp.exists(output_dir):
         os.makedirs(output_dir)
     joblib.dump(model, output_path)
+    compiled_path = compiled_model_path(output_path)
+    if is_compilable(model):
+        compile_model(model, compiled_path)
+    elif fp.exists(compiled_path):
+        # stale
+        shutil.rmtree(compiled_path)
+
+
+# ---------------------------------------------------------------------
+# compiled models
+# ---------------------------------------------------------------------
+
+# Linear models can be saved as a few plain arrays, which we can
+# memory-map instead of unpickling the whole sklearn object (faster
+# to load, and the pages are shared by all processes that use them)
+
+_COMPILED_ARRAYS = ['coef', 'intercept', 'classes']
+
+_COMPILABLE = (LinearSVC,
+               LogisticRegression,
+               PassiveAggressiveClassifier,
+               Perceptron,
+               RidgeClassifier,
+               SGDClassifier)
+"""
+Classifiers that predict the class with the highest (or, with two
+classes, the sign of the) score `X . coef^T + intercept`, which is all
+`CompiledModel` knows how to do (unlike, say, `SVC` with a linear
+kernel, which votes one against one, or naive Bayes)
+"""
+
+
+def compiled_model_path(model_path):
+    """
+    Directory for the compiled version of a model
+    """
+    return fp.splitext(model_path)[0] + '.compiled'
+
+
+def is_compilable(model):
+    """
+    True if we know how to compile the (fitted) model, ie. if it's a
+    (one vs rest) linear classifier (see `_COMPILABLE`)
+    """
+    return isinstance(model, _COMPILABLE) and\
+        all(hasattr(model, a + '_') for a in _COMPILED_ARRAYS)
+
+
+def compile_model(model, output_dir):
+    """
+    Save the weights, intercepts and classes of a linear classifier as
+    .npy files in the output directory
+
+    The files are written to a scratch directory which then replaces
+    the output directory, so that readers never see a mix of old and
+    new arrays (or half written ones)
+    """
+    parent = fp.dirname(fp.abspath(output_dir))
+    scratch = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+    for name in _COMPILED_ARRAYS:
+        array = getattr(model, name + '_')
+        if issparse(array):
+            array = array.toarray()
+        np.save(fp.join(scratch, name + '.npy'), np.asarray(array))
+    if fp.exists(output_dir):
+        stale = tempfile.mkdtemp(prefix='.old-', dir=parent)
+        os.rename(output_dir, fp.join(stale, 'compiled'))
+        os.rename(scratch, output_dir)
+        shutil.rmtree(stale)
+    else:
+        os.rename(scratch, output_dir)
+
+
+def is_compiled(model_path):
+    """
+    True if a model has a compiled version that is at least as recent
+    as the model itself
+    """
+    compiled_path = compiled_model_path(model_path)
+    arrays = [fp.join(compiled_path, a + '.npy') for a in _COMPILED_ARRAYS]
+    return all(fp.isfile(a) for a in arrays) and\
+        min(fp.getmtime(a) for a in arrays) >= fp.getmtime(model_path)
+
+
+class CompiledModel(object):
+    """
+    Linear classifier read from the output of `compile_model`, which
+    predicts the same classes as the original one
+    """
+    def __init__(self, model_dir):
+        def load(name):
+            "memory map an array"
+            return np.load(fp.join(model_dir, name + '.npy'), mmap_mode='r')
+        self.coef, self.intercept, self.classes =\
+            [load(a) for a in _COMPILED_ARRAYS]
+
+    def decision_function(self, data):
+        "scores for each sample (and class, if more than two)"
+        scores = np.asarray(data.dot(self.coef.T)) + self.intercept
+        return scores.ravel() if scores.shape[1] == 1 else scores
+
+    def predict(self, data):
+        "predicted class for each sample"
+        scores = self.decision_function(data)
+        if scores.ndim == 1:
+            indices = (scores > 0).astype(int)
+        else:
+            indices = scores.argmax(axis=1)
+        return np.asarray(self.classes)[indices]
 
 
 # ---------------------------------------------------------------------
@@ -79,29 +198,94 @@ def get_edus_plus(inputs):
                 yield env, contexts, unit
 
 
-def extract_features(vocab, edus_plus):
+def _edu_row(vocab, env, edu):
     """
-    Return a sparse matrix of features for all edus in the corpus
+    Feature vector for a single EDU, as sorted column indices and
+    their (non-zero) values
     """
-    matrix = lil_matrix((len(edus_plus), len(vocab)))
     # this unfortunately duplicates stac_features.extract_single_features
     # but it's the price we pay to ensure we get the edus and vectors in
     # the same order
-    for row, (env, _, edu) in enumerate(edus_plus):
-        vec = stac_features.SingleEduKeys(env.inputs)
-        vec.fill(env.current, edu)
-        for feat, val in vec.one_hot_values_gen():
-            if feat in vocab:
-                matrix[row, vocab[feat]] = val
-    return matrix.tocsr()
+    vec = stac_features.SingleEduKeys(env.inputs)
+    vec.fill(env.current, edu)
+    row = {}
+    for feat, val in vec.one_hot_values_gen():
+        if feat in vocab:
+            row[vocab[feat]] = val  # last value wins
+    cols = sorted(c for c, v in row.items() if v != 0)
+    return cols, [row[c] for c in cols]
+
+
+def _featurise(vocab, edus_plus):
+    """
+    CSR arrays (row lengths, column indices, values) for some EDUs
+    """
+    lengths = []
+    indices = []
+    data = []
+    for env, _, edu in edus_plus:
+        cols, vals = _edu_row(vocab, env, edu)
+        lengths.append(len(cols))
+        indices.extend(cols)
+        data.extend(vals)
+    return lengths, indices, data
+
+
+# vocabulary and edus for the worker processes of extract_features
+# (set before we fork, so that they don't need to be pickled)
+_FEATURISE = None
 
 
-def annotate_edus(model, vocab, labels, inputs):
+def _featurise_slice(bounds):
+    "`_featurise` on a slice of the `_FEATURISE` edus"
+    vocab, edus_plus = _FEATURISE
+    start, end = bounds
+    return _featurise(vocab, edus_plus[start:end])
+
+
+def extract_features(vocab, edus_plus, n_jobs=1):
+    """
+    Return a sparse matrix of features for all edus in the corpus
+
+    With `n_jobs` other than 1, the edus are featurised in as many
+    slices, each in its own process (-1 for one per CPU)
+    """
+    global _FEATURISE
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = max(1, min(n_jobs, len(edus_plus)))
+    if n_jobs == 1:
+        chunks = [_featurise(vocab, edus_plus)]
+    else:
+        step = -(-len(edus_plus) // n_jobs)
+        bounds = [(i, i + step) for i in range(0, len(edus_plus), step)]
+        _FEATURISE = (vocab, edus_plus)
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            chunks = pool.map(_featurise_slice, bounds)
+        finally:
+            pool.close()
+            pool.join()
+            _FEATURISE = None
+    lengths = np.concatenate([np.asarray(c[0], dtype=np.int64)
+                              for c in chunks])
+    indptr = np.zeros(len(edus_plus) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    indices = np.concatenate([np.asarray(c[1], dtype=np.int64)
+                              for c in chunks])
+    data = np.concatenate([np.asarray(c[2], dtype=np.float64)
+                           for c in chunks])
+    return csr_matrix((data, indices, indptr),
+                      shape=(len(edus_plus), len(vocab)))
+
+
+def annotate_edus(model, vocab, labels, inputs, n_jobs=1):
     """
     Annotate each EDU with its dialogue act and addressee
+    (see `extract_features` for `n_jobs`)
     """
     edus_plus = list(get_edus_plus(inputs))
-    feats = extract_features(vocab, edus_plus)
+    feats = extract_features(vocab, edus_plus, n_jobs=n_jobs)
     predictions = model.predict(feats)
     for (env, contexts, edu), da_num in zip(edus_plus, predictions):
         da_label = labels[int(da_num) - 1]
@@ -112,30 +296,64 @@ def annotate_edus(model, vocab, labels, inputs):
         edu.type = da_label
 
 
+def load_model(model_path, vocab_path, labels_path):
+    """
+    Return the dialogue act model along with its feature vocabulary
+    (as a dictionary from feature to column) and labels
+
+    We use the compiled version of the model if there is one (and it
+    is not older than the model)
+    """
+    if is_compiled(model_path):
+        model = CompiledModel(compiled_model_path(model_path))
+    else:
+        model = joblib.load(model_path)
+    vocab = {f: i for i, f in
+             enumerate(load_vocab(vocab_path))}
+    labels = load_labels(labels_path)
+    return model, vocab, labels
+
+
+def read_inputs(corpus_dir, resources_dir):
+    """
+    Read the (live) corpus and resources needed to annotate its EDUs
+    """
+    # FIXME strip_mode should not be specified here
+    args = argparse.Namespace(corpus=corpus_dir,
+                              resources=resources_dir,
+                              ignore_cdus=False,
+                              parsing=True,
+                              single=True,
+                              strip_mode='head')
+    return stac_features.read_corpus_inputs(args)
+
+
+def save_annotations(inputs, output_dir):
+    """
+    Save the (in-memory annotated) corpus to the output directory
+    """
+    for key in inputs.corpus:
+        key2 = _output_key(key)
+        doc = inputs.corpus[key]
+        save_document(output_dir, key2, doc)
+
+
 def command_annotate(args):
     """
     Top-level command: given a dialogue act model, and a corpus with some
     Glozz documents, perform dialogue act annotation on them, and simple
     addressee detection, and dump Glozz documents in the output directory
     """
-    args.ignore_cdus = False
-    args.parsing = True
-    args.single = True
-    args.strip_mode = 'head'  # FIXME should not be specified here
-    inputs = stac_features.read_corpus_inputs(args)
-    model = joblib.load(args.model)
-    vocab = {f: i for i, f in
-             enumerate(load_vocab(args.vocabulary))}
-    labels = load_labels(args.labels)
+    inputs = read_inputs(args.corpus, args.resources)
+    model, vocab, labels = load_model(args.model,
+                                      args.vocabulary,
+                                      args.labels)
 
     # add dialogue acts and addressees
-    annotate_edus(model, vocab, labels, inputs)
+    annotate_edus(model, vocab, labels, inputs, n_jobs=args.n_jobs)
 
     # corpus has been modified in-memory, now save to disk
-    for key in inputs.corpus:
-        key2 = _output_key(key)
-        doc = inputs.corpus[key]
-        save_document(args.output, key2, doc)
+    save_annotations(inputs, args.output)
 
 
 def main():
@@ -157,6 +375,9 @@ def main():
                      default=None,
                      required=True,
                      help="output directory")
+    psr.add_argument("--n-jobs", type=int, default=1,
+                     help="extract EDU features with this many "
+                     "processes (-1 for one per CPU)")
     psr.set_defaults(func=command_annotate)
 
     args = psr.parse_args()